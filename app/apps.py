@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class PomaAppConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "app"
+
+    def ready(self):
+        from poma import tracing
+
+        tracing.setup()
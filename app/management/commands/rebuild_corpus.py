@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand
+from app.models import CorpusRebuild
+from app.tasks import REBUILD_BATCH_SIZE, REBUILD_CONCURRENCY, rebuild_corpus
+
+
+class Command(BaseCommand):
+    help = "Re-feeds a workspace corpus from the stored documents and sections"
+
+    def add_arguments(self, parser):
+        parser.add_argument("workspace_ids", nargs="+", type=int)
+        group = parser.add_mutually_exclusive_group()
+        group.add_argument(
+            "--reset", action="store_true", help="Empty the existing corpus first"
+        )
+        group.add_argument(
+            "--create", action="store_true", help="Index into a brand new corpus"
+        )
+        parser.add_argument(
+            "--restart",
+            action="store_true",
+            help="Ignore the checkpoint of an unfinished rebuild",
+        )
+        parser.add_argument("--batch-size", type=int, default=REBUILD_BATCH_SIZE)
+        parser.add_argument("--concurrency", type=int, default=REBUILD_CONCURRENCY)
+        parser.add_argument(
+            "--async",
+            action="store_true",
+            dest="run_async",
+            help="Queue the rebuild on the celery workers",
+        )
+
+    def handle(self, *args, **options):
+        for workspace_id in options["workspace_ids"]:
+            kwargs = {
+                "reset": options["reset"],
+                "create": options["create"],
+                "restart": options["restart"],
+                "batch_size": options["batch_size"],
+                "concurrency": options["concurrency"],
+            }
+            if options["run_async"]:
+                rebuild_corpus.delay(workspace_id, **kwargs)
+                self.stdout.write(f"Queued rebuild of workspace {workspace_id}")
+                continue
+            rebuild_id = rebuild_corpus(workspace_id, **kwargs)
+            if rebuild_id is None:
+                self.stderr.write(f"Rebuild of workspace {workspace_id} failed")
+                continue
+            rebuild = CorpusRebuild.objects.get(pk=rebuild_id)
+            self.stdout.write(
+                f"Workspace {workspace_id}: {rebuild.documents_indexed} documents "
+                f"({rebuild.sections_indexed} sections) indexed, "
+                f"{rebuild.documents_failed} failed, "
+                f"{rebuild.documents_per_second:.1f} docs/s"
+            )
@@ -0,0 +1,86 @@
+import json
+
+from celery import current_app
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from app.models import FailedTask, PendingIndex
+from poma import spool
+
+
+class Command(BaseCommand):
+    help = (
+        "Sends dead-lettered indexing tasks to the celery workers again, and the"
+        " spooled documents Vectara rejected back to Vectara"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "ids", nargs="*", type=int, help="Only these failed tasks, no documents"
+        )
+        parser.add_argument("--task", help="Only tasks of this name, no documents")
+        parser.add_argument(
+            "--workspace", type=int, help="Only tasks of this workspace"
+        )
+        parser.add_argument(
+            "--retryable",
+            action="store_true",
+            help="Only tasks that ran out of retries, not permanent failures"
+            " (which rejected documents are)",
+        )
+        parser.add_argument(
+            "--again",
+            action="store_true",
+            help="Include tasks that were already replayed",
+        )
+        parser.add_argument("--limit", type=int)
+        parser.add_argument(
+            "--dry-run", action="store_true", help="List the tasks without sending them"
+        )
+
+    def handle(self, *args, **options):
+        failed = FailedTask.objects.order_by("id")
+        if options["ids"]:
+            failed = failed.filter(id__in=options["ids"])
+        if options["task"]:
+            failed = failed.filter(task=options["task"])
+        if options["workspace"]:
+            failed = failed.filter(workspace_id=options["workspace"])
+        if options["retryable"]:
+            failed = failed.filter(retryable=True)
+        if not options["again"]:
+            failed = failed.filter(replayed_at=None)
+        if options["limit"]:
+            failed = failed[: options["limit"]]
+        rejected = PendingIndex.objects.exclude(failed_at=None).order_by("id")
+        if options["ids"] or options["task"] or options["retryable"]:
+            rejected = rejected.none()
+        if options["workspace"]:
+            rejected = rejected.filter(workspace_id=options["workspace"])
+        if options["limit"]:
+            rejected = rejected[: options["limit"]]
+
+        if options["dry_run"]:
+            for failed_task in failed:
+                self.stdout.write(
+                    f"{failed_task.id} {failed_task.task} {failed_task.error}"
+                )
+            for entry in rejected:
+                self.stdout.write(f"document {entry.document_id} {entry.error}")
+            return
+        replayed = []
+        for failed_task in failed:
+            task_args, task_kwargs = json.loads(failed_task.arguments)
+            current_app.signature(
+                failed_task.task, args=task_args, kwargs=task_kwargs
+            ).apply_async()
+            replayed.append(failed_task.id)
+        FailedTask.objects.filter(id__in=replayed).update(replayed_at=timezone.now())
+        self.stdout.write(f"Replayed {len(replayed)} failed tasks")
+
+        entries = dict(rejected.values_list("id", "workspace_id"))
+        PendingIndex.objects.filter(id__in=entries).update(
+            failed_at=None, error="", attempts=0
+        )
+        for workspace_id in set(entries.values()):
+            spool.drain.delay(workspace_id)
+        self.stdout.write(f"Respooled {len(entries)} rejected documents")
@@ -1,12 +1,27 @@
+import asyncio
 import os
 from django.core.management.base import BaseCommand
-from poma.sources.slack import socket_app
+from prometheus_client import start_http_server
+from poma.sources.slack import async_socket_app, socket_app
 from app.tasks import index_channel, index_message
 
+SLACK_METRICS_PORT = int(os.getenv("SLACK_METRICS_PORT", 9809))
+
 
 class Command(BaseCommand):
     help = "Starts the slack bot"
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--async",
+            action="store_true",
+            dest="run_async",
+            help="Use the asyncio runner with several socket connections",
+        )
+        parser.add_argument("--connections", type=int, default=2)
+        parser.add_argument("--queue-size", type=int, default=1000)
+        parser.add_argument("--workers", type=int, default=8)
+
     def handle(self, *args, **options):
         for env in [
             "USER_TOKEN",
@@ -16,4 +31,16 @@ class Command(BaseCommand):
             "SLACK_SIGNING_SECRET",
         ]:
             os.environ.pop(env, "")
-        socket_app(index_channel.delay, index_message.delay)
+        if not options["run_async"]:
+            socket_app(index_channel.delay, index_message.delay)
+            return
+        start_http_server(SLACK_METRICS_PORT)
+        asyncio.run(
+            async_socket_app(
+                index_channel.delay,
+                index_message.delay,
+                connections=options["connections"],
+                queue_size=options["queue_size"],
+                workers=options["workers"],
+            )
+        )
@@ -0,0 +1,43 @@
+# Generated by Django 4.1.7 on 2026-10-19 01:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0012_remove_workspace_slack_client_id_and_more"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CorpusRebuild",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("finished_at", models.DateTimeField(default=None, null=True)),
+                ("last_document_id", models.PositiveBigIntegerField(default=0)),
+                ("documents_indexed", models.PositiveIntegerField(default=0)),
+                ("documents_failed", models.PositiveIntegerField(default=0)),
+                ("sections_indexed", models.PositiveIntegerField(default=0)),
+                ("elapsed", models.FloatField(default=0)),
+                (
+                    "workspace",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="rebuilds",
+                        to="app.workspace",
+                    ),
+                ),
+            ],
+        ),
+    ]
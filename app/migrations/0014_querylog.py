@@ -0,0 +1,48 @@
+# Generated by Django 4.1.7 on 2026-10-19 01:45
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0013_corpusrebuild"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="QueryLog",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("query", models.CharField(max_length=255)),
+                ("count", models.PositiveIntegerField(default=1)),
+                (
+                    "last_searched",
+                    models.DateTimeField(
+                        db_index=True, default=django.utils.timezone.now
+                    ),
+                ),
+                (
+                    "workspace",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="queries",
+                        to="app.workspace",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("workspace", "query")},
+            },
+        ),
+    ]
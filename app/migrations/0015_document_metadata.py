@@ -0,0 +1,65 @@
+# Generated by Django 4.1.7 on 2026-10-19 01:47
+
+import datetime
+import re
+
+from django.db import migrations, models
+
+SLACK_TITLE = re.compile(r"^@(?P<author>.+) in #")
+SLACK_IDENTIFIER = re.compile(r"^(?P<channel>[A-Z0-9]+)-(?P<ts>\d+\.\d+)$")
+
+
+def backfill_metadata(apps, schema_editor):
+    """Recover what existing titles and identifiers tell about a document."""
+    Document = apps.get_model("app", "Document")
+    for document in Document.objects.iterator():
+        title = SLACK_TITLE.match(document.title)
+        identifier = SLACK_IDENTIFIER.match(document.identifier)
+        if title and identifier:
+            document.source = "slack"
+            document.author = title["author"]
+            document.channel_id = identifier["channel"]
+            document.created = datetime.datetime.fromtimestamp(
+                float(identifier["ts"]), tz=datetime.timezone.utc
+            )
+        elif "docs.google.com" in document.link:
+            document.source = "drive"
+        else:
+            continue
+        document.save(update_fields=["source", "author", "channel_id", "created"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0014_querylog"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="document",
+            name="author",
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name="document",
+            name="channel_id",
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name="document",
+            name="created",
+            field=models.DateTimeField(default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name="document",
+            name="mimetype",
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name="document",
+            name="source",
+            field=models.CharField(blank=True, db_index=True, max_length=16),
+        ),
+        migrations.RunPython(backfill_metadata, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.1.7 on 2026-10-19 01:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0015_document_metadata"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="workspace",
+            name="recency_weight",
+            field=models.FloatField(
+                default=0, help_text="Score added per year a document is more recent"
+            ),
+        ),
+        migrations.AddField(
+            model_name="workspace",
+            name="slack_weight",
+            field=models.FloatField(
+                default=0,
+                help_text="Score added to Slack messages, negative favors Drive",
+            ),
+        ),
+    ]
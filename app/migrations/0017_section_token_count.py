@@ -0,0 +1,18 @@
+# Generated by Django 4.1.7 on 2026-10-19 01:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0016_workspace_search_weights"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="section",
+            name="token_count",
+            field=models.PositiveIntegerField(default=None, null=True),
+        ),
+    ]
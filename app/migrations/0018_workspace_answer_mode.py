@@ -0,0 +1,26 @@
+# Generated by Django 4.1.7 on 2026-10-19 01:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0017_section_token_count"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="workspace",
+            name="answer_mode",
+            field=models.CharField(
+                choices=[
+                    ("gpt", "GPT"),
+                    ("extractive", "Extractive"),
+                    ("extractive+gpt", "Extractive, then GPT"),
+                ],
+                default="gpt",
+                max_length=16,
+            ),
+        ),
+    ]
@@ -0,0 +1,65 @@
+# Generated by Django 4.1.7 on 2026-10-19 01:55
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0018_workspace_answer_mode"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="document",
+            name="canonical",
+            field=models.ForeignKey(
+                default=None,
+                null=True,
+                on_delete=django.db.models.deletion.DO_NOTHING,
+                related_name="aliases",
+                to="app.document",
+            ),
+        ),
+        migrations.AddField(
+            model_name="document",
+            name="signature",
+            field=models.BinaryField(default=None, null=True),
+        ),
+        migrations.CreateModel(
+            name="LshBucket",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("key", models.BigIntegerField()),
+                (
+                    "document",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="lsh_buckets",
+                        to="app.document",
+                    ),
+                ),
+                (
+                    "workspace",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, to="app.workspace"
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="lshbucket",
+            index=models.Index(
+                fields=["workspace", "key"], name="app_lshbuck_workspa_1ebf56_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 4.1.7 on 2026-10-19 02:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0020_ingestionjob"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="workspace",
+            name="schedule_weight",
+            field=models.PositiveSmallIntegerField(
+                default=1, help_text="Share of the indexing workers, e.g. by plan"
+            ),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 4.1.7 on 2026-10-19 02:19
+
+from django.db import migrations, models
+import django.db.models.deletion
+import fernet_fields.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0021_workspace_schedule_weight"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="FailedTask",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("task", models.CharField(db_index=True, max_length=255)),
+                ("arguments", fernet_fields.fields.EncryptedTextField()),
+                ("error", models.TextField()),
+                ("retryable", models.BooleanField()),
+                ("attempts", models.PositiveIntegerField()),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "replayed_at",
+                    models.DateTimeField(blank=True, default=None, null=True),
+                ),
+                (
+                    "workspace",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="failed_tasks",
+                        to="app.workspace",
+                    ),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 4.1.7 on 2026-10-19 02:22
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0022_failedtask"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PendingIndex",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("attempts", models.PositiveIntegerField(default=0)),
+                (
+                    "failed_at",
+                    models.DateTimeField(blank=True, default=None, null=True),
+                ),
+                ("error", models.TextField(blank=True)),
+                (
+                    "document",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, to="app.document"
+                    ),
+                ),
+                (
+                    "workspace",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="pending_indexes",
+                        to="app.workspace",
+                    ),
+                ),
+            ],
+        ),
+    ]
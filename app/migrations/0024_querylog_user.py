@@ -0,0 +1,34 @@
+# Generated by Django 4.1.7 on 2026-10-19 03:00
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("app", "0023_pendingindex"),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name="querylog",
+            unique_together=set(),
+        ),
+        migrations.AddField(
+            model_name="querylog",
+            name="user",
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="queries",
+                to=settings.AUTH_USER_MODEL,
+            ),
+        ),
+        migrations.AlterUniqueTogether(
+            name="querylog",
+            unique_together={("workspace", "user", "query")},
+        ),
+    ]
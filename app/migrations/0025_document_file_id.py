@@ -0,0 +1,40 @@
+# Generated by Django 4.1.7 on 2026-10-19 03:24
+
+import re
+
+from django.db import migrations, models
+
+DRIVE_LINK = re.compile(r"/d/(?P<file_id>[\w-]+)")
+
+
+def backfill_file_id(apps, schema_editor):
+    """Read the file id of Drive documents from their link, aliases stored it
+    as identifier and now take the identifier of their canonical document."""
+    Document = apps.get_model("app", "Document")
+    documents = Document.objects.filter(source="drive").select_related("canonical")
+    for document in documents.iterator():
+        link = DRIVE_LINK.search(document.link)
+        if document.canonical is not None:
+            document.file_id = document.identifier
+            document.identifier = document.canonical.identifier
+        elif link:
+            document.file_id = link["file_id"]
+        else:
+            continue
+        document.save(update_fields=["file_id", "identifier"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0024_querylog_user"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="document",
+            name="file_id",
+            field=models.CharField(blank=True, db_index=True, max_length=255),
+        ),
+        migrations.RunPython(backfill_file_id, migrations.RunPython.noop),
+    ]
@@ -1,6 +1,9 @@
 import ast
+from functools import lru_cache
 
 import logging
+import os
+import threading
 from django.db import models
 from django.urls import reverse
 from django.contrib.auth.models import User
@@ -9,15 +12,47 @@ from django.utils import timezone
 from fernet_fields import EncryptedTextField, EncryptedIntegerField
 
 from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from googleapiclient.http import build_http
 from django_resized import ResizedImageField
 
-from poma.search.semantic import create_corpus, search
+from poma import metrics
+from poma.search import lexical
+from poma.search.semantic import create_corpus, document_metadata
+from poma.search.suggest import normalize
+from poma.search.windows import PAGE_SIZE, get_page
 from poma.sources.nango import get_token
 
 
 User._meta.get_field("email")._unique = True
 
+GOOGLE_DRIVE_API_URL = os.getenv("GOOGLE_DRIVE_API_URL")
+GOOGLE_TOKEN_URI = os.getenv("GOOGLE_TOKEN_URI")
+
+# Drive clients of this worker, per thread as httplib2 is not thread safe
+_drive_services = threading.local()
+
+
+@lru_cache
+def _drive_discovery():
+    """Discovery document bundled with googleapiclient, read once."""
+    return get_static_doc("drive", "v3")
+
+
+class WorkspaceCredentials(Credentials):
+    """Google credentials saving refreshed tokens to their workspace."""
+
+    workspace_id = None
+
+    def refresh(self, request):
+        super().refresh(request)
+        if self.workspace_id is not None:
+            Workspace.objects.filter(pk=self.workspace_id).update(
+                google_token=self.token, google_refresh_token=self.refresh_token
+            )
+
 
 def is_ascii(value):
     try:
@@ -27,6 +62,15 @@ def is_ascii(value):
 
 
 class Workspace(models.Model):
+    GPT = "gpt"
+    EXTRACTIVE = "extractive"
+    EXTRACTIVE_THEN_GPT = "extractive+gpt"
+    ANSWER_MODES = [
+        (GPT, "GPT"),
+        (EXTRACTIVE, "Extractive"),
+        (EXTRACTIVE_THEN_GPT, "Extractive, then GPT"),
+    ]
+
     owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name="workspaces")
     name = models.CharField(max_length=255, validators=[is_ascii])
     logo = ResizedImageField(
@@ -46,6 +90,17 @@ class Workspace(models.Model):
         max_length=255, default=None, null=True, db_index=True
     )
     corpus_id = EncryptedIntegerField(default=None, null=True)
+    # Query time weights of the corpus' custom dimensions, see CUSTOM_DIMENSIONS
+    recency_weight = models.FloatField(
+        default=0, help_text="Score added per year a document is more recent"
+    )
+    slack_weight = models.FloatField(
+        default=0, help_text="Score added to Slack messages, negative favors Drive"
+    )
+    answer_mode = models.CharField(max_length=16, choices=ANSWER_MODES, default=GPT)
+    schedule_weight = models.PositiveSmallIntegerField(
+        default=1, help_text="Share of the indexing workers, e.g. by plan"
+    )
 
     def get_absolute_url(self):
         return reverse("workspace-update", kwargs={"pk": self.pk})
@@ -103,15 +158,62 @@ class Workspace(models.Model):
                 response.get("status", {}).get("statusDetail", "No reasons found"),
             )
 
-    def _search(self, query: str):
-        if self.corpus_id:
-            return search(query, self.corpus_id)
-        return None, "workplace has not been indexed yet", False
+    @property
+    def search_dims(self):
+        weights = {"recency": self.recency_weight, "slack": self.slack_weight}
+        return {name: weight for name, weight in weights.items() if weight}
+
+    def _search(self, query: str, page: int = 1, metadata_filter: str = None):
+        return search_workspaces([self], query, page, metadata_filter)
 
     def get_google_drive_service(self):
+        """Drive client of the workspace, built once per worker thread and kept
+        until the workspace is connected to Google again."""
+        services = getattr(_drive_services, "services", None)
+        if services is None:
+            services = _drive_services.services = {}
+        key = (self.id, self.google_refresh_token, self.google_client_id)
+        if key in services:
+            return services[key]
+
         raw_creds = self.google_credentials
-        creds = Credentials.from_authorized_user_info(raw_creds, raw_creds["scopes"])
-        return build("drive", "v3", credentials=creds)
+        creds = WorkspaceCredentials.from_authorized_user_info(
+            raw_creds, raw_creds["scopes"]
+        )
+        if GOOGLE_TOKEN_URI:
+            creds = creds.with_token_uri(GOOGLE_TOKEN_URI)
+        creds.workspace_id = self.id
+        client_options = None
+        if GOOGLE_DRIVE_API_URL:
+            client_options = {"api_endpoint": GOOGLE_DRIVE_API_URL}
+        # The transport refreshes expired tokens and keeps its connections open
+        service = build_from_document(
+            _drive_discovery(),
+            http=AuthorizedHttp(creds, http=build_http()),
+            client_options=client_options,
+        )
+        for stale in [k for k in services if k[0] == self.id]:
+            del services[stale]
+        services[key] = service
+        return service
+
+
+def search_workspaces(workspaces, query: str, page: int = 1, metadata_filter=None):
+    """Search the corpora of several workspaces in one round trip."""
+    corpora = [(w.corpus_id, w.search_dims) for w in workspaces if w.corpus_id]
+    if not corpora:
+        return [], False, "workplace has not been indexed yet", False
+    responses, has_next, error, success = get_page(
+        corpora, query, page, metadata_filter
+    )
+    if not success and page == 1 and not metadata_filter:
+        # Vectara is unavailable, match the stored sections instead
+        responses = lexical.search(workspaces, query, PAGE_SIZE)
+        if responses:
+            logging.warning("Serving lexical search results: %s", error)
+            metrics.search_degraded.labels("lexical").inc()
+            return responses, False, None, True
+    return responses, has_next, error, success
 
 
 class Profile(models.Model):
@@ -123,6 +225,13 @@ class Profile(models.Model):
         Workspace, related_name="allowed_users"
     )
 
+    def searchable_workspaces(self):
+        workspaces = {self.current_workspace, *self.available_workspaces.all()}
+        return sorted(
+            (workspace for workspace in workspaces if workspace.corpus_id),
+            key=lambda workspace: workspace.id,
+        )
+
     def is_admin(self):
         return self.user == self.current_workspace.owner
 
@@ -138,18 +247,206 @@ class Document(models.Model):
     title = models.TextField(blank=True)
     identifier = models.CharField(max_length=255, db_index=True)
     size = models.PositiveBigIntegerField()  # size in bytes
+    # Filterable metadata, also written to the search backend
+    source = models.CharField(max_length=16, blank=True, db_index=True)
+    channel_id = models.CharField(max_length=255, blank=True)
+    # Drive file the document is a version of. Its identifier is the Vectara
+    # document id, which aliases of a Drive file share with their canonical.
+    file_id = models.CharField(max_length=255, blank=True, db_index=True)
+    author = models.CharField(max_length=255, blank=True)
+    created = models.DateTimeField(default=None, null=True)
+    mimetype = models.CharField(max_length=255, blank=True)
+    # Set on near-duplicates, which are not indexed and have no sections
+    canonical = models.ForeignKey(
+        "self",
+        on_delete=models.DO_NOTHING,
+        null=True,
+        default=None,
+        related_name="aliases",
+    )
+    signature = models.BinaryField(null=True, default=None)  # MinHash
     # TODO ADD DOCUMENT PERMISSIONS FOR VALIDATION
 
+    @property
+    def metadata(self):
+        return document_metadata(
+            self.source, self.channel_id, self.author, self.created, self.mimetype
+        )
+
 
 class Section(models.Model):
     document = models.ForeignKey(
         Document, on_delete=models.DO_NOTHING, related_name="sections"
     )
     word_count = models.PositiveIntegerField()
+    token_count = models.PositiveIntegerField(default=None, null=True)
     section_id = models.PositiveIntegerField(db_index=True)
     text = EncryptedTextField(blank=True)
 
 
+class LshBucket(models.Model):
+    """Band of the MinHash signature of an indexed document."""
+
+    workspace = models.ForeignKey(Workspace, on_delete=models.CASCADE)
+    key = models.BigIntegerField()
+    document = models.ForeignKey(
+        Document, on_delete=models.CASCADE, related_name="lsh_buckets"
+    )
+
+    class Meta:
+        indexes = [models.Index(fields=["workspace", "key"])]
+
+
+class CorpusRebuild(models.Model):
+    """Checkpoint of a corpus rebuild from the locally stored sections."""
+
+    workspace = models.ForeignKey(
+        Workspace, on_delete=models.CASCADE, related_name="rebuilds"
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(default=None, null=True)
+    last_document_id = models.PositiveBigIntegerField(default=0)
+    documents_indexed = models.PositiveIntegerField(default=0)
+    documents_failed = models.PositiveIntegerField(default=0)
+    sections_indexed = models.PositiveIntegerField(default=0)
+    elapsed = models.FloatField(default=0)  # seconds spent indexing
+
+    @property
+    def documents_per_second(self):
+        if not self.elapsed:
+            return 0.0
+        return self.documents_indexed / self.elapsed
+
+
+class PendingIndex(models.Model):
+    """Document stored but not indexed yet, see ``poma.spool``."""
+
+    workspace = models.ForeignKey(
+        Workspace, on_delete=models.CASCADE, related_name="pending_indexes"
+    )
+    document = models.ForeignKey(Document, on_delete=models.CASCADE)
+    created_at = models.DateTimeField(auto_now_add=True)
+    attempts = models.PositiveIntegerField(default=0)
+    # Set when Vectara rejected the document, which is then left out
+    failed_at = models.DateTimeField(default=None, null=True, blank=True)
+    error = models.TextField(blank=True)
+
+
+class FailedTask(models.Model):
+    """Indexing task that failed for good, see ``poma.retries``."""
+
+    task = models.CharField(max_length=255, db_index=True)
+    workspace = models.ForeignKey(
+        Workspace,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name="failed_tasks",
+    )
+    # JSON [args, kwargs], encrypted as they may hold message texts
+    arguments = EncryptedTextField()
+    error = models.TextField()
+    # True when the task ran out of retries rather than failing permanently
+    retryable = models.BooleanField()
+    attempts = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    replayed_at = models.DateTimeField(default=None, null=True, blank=True)
+
+
+class IngestionJob(models.Model):
+    """Progress of indexing one source of a workspace, see ``poma.jobs``."""
+
+    workspace = models.ForeignKey(
+        Workspace, on_delete=models.CASCADE, related_name="ingestion_jobs"
+    )
+    source = models.CharField(max_length=16)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(default=None, null=True)
+    listed = models.BooleanField(default=False)  # every item was enqueued
+    enqueued = models.PositiveIntegerField(default=0)
+    succeeded = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    skipped = models.PositiveIntegerField(default=0)
+    bytes = models.PositiveBigIntegerField(default=0)
+
+    @property
+    def processed(self):
+        return self.succeeded + self.failed + self.skipped
+
+    @property
+    def finished(self):
+        return self.finished_at is not None or (
+            self.listed and self.processed >= self.enqueued
+        )
+
+    @property
+    def elapsed(self):
+        end = self.finished_at or timezone.now()
+        return max((end - self.created_at).total_seconds(), 0.0)
+
+    @property
+    def documents_per_second(self):
+        if not self.elapsed:
+            return 0.0
+        return self.processed / self.elapsed
+
+    @property
+    def eta_seconds(self):
+        """Seconds left at the current rate, None while it is unknown."""
+        if self.finished:
+            return 0.0
+        if not self.listed or not self.documents_per_second:
+            return None
+        return (self.enqueued - self.processed) / self.documents_per_second
+
+    def progress(self):
+        return {
+            "id": self.id,
+            "source": self.source,
+            "created_at": self.created_at.isoformat(),
+            "finished": self.finished,
+            "listed": self.listed,
+            "enqueued": self.enqueued,
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "skipped": self.skipped,
+            "bytes": self.bytes,
+            "documents_per_second": round(self.documents_per_second, 2),
+            "eta_seconds": self.eta_seconds,
+        }
+
+
+class QueryLog(models.Model):
+    """How often a user searched a query in a workspace, feeds the user's
+    suggestions. Queries logged before users were recorded have none and
+    are never suggested."""
+
+    workspace = models.ForeignKey(
+        Workspace, on_delete=models.CASCADE, related_name="queries"
+    )
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name="queries", null=True
+    )
+    query = models.CharField(max_length=255)
+    count = models.PositiveIntegerField(default=1)
+    last_searched = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        unique_together = [["workspace", "user", "query"]]
+
+    @classmethod
+    def record(cls, workspace, user, query: str):
+        query = normalize(query)[:255]
+        if not query:
+            return
+        updated = cls.objects.filter(
+            workspace=workspace, user=user, query=query
+        ).update(count=models.F("count") + 1, last_searched=timezone.now())
+        if not updated:
+            cls.objects.get_or_create(workspace=workspace, user=user, query=query)
+
+
 class SlackChannel(models.Model):
     channel_id = models.CharField(max_length=255, db_index=True, unique=False)
     slack_workspace_id = models.CharField(max_length=255, db_index=True, unique=False)
@@ -1,19 +1,47 @@
+from collections import Counter
+import itertools
 import logging
 
 import os
+import re
+import time
 from celery import shared_task
+from django.db import transaction
+from django.db.models import Prefetch
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
-from app.models import Document, Section, SlackChannel, Workspace
-from poma.search.semantic import store, upload
+from app.models import CorpusRebuild, Document, Section, SlackChannel, Workspace
+from poma import dedup, idempotency, jobs, metrics, retries, scheduling, spool
+from poma.search.context import count_tokens
+from poma.search.semantic import (
+    build_document,
+    delete,
+    document_metadata,
+    index_many,
+    replace_filter_attributes,
+    reset_corpus,
+    upload,
+)
 from poma.sources import slack
-from poma.sources.gdrive import download_file, iter_files
+from poma.sources.gdrive import (
+    MIMETYPES_TO_EXPORT,
+    SPREADSHEET,
+    download_file,
+    iter_files,
+    sheet_sections,
+    stream_csv,
+)
 
 EXTENSION_FROM_MIMETYPE = {
     "application/vnd.openxmlformats-officedocument.wordprocessingml.document": ".docx",
     "application/vnd.openxmlformats-officedocument.presentationml.presentation": ".pptx",
 }
 
+REBUILD_BATCH_SIZE = int(os.getenv("REBUILD_BATCH_SIZE", 200))
+REBUILD_CONCURRENCY = int(os.getenv("REBUILD_CONCURRENCY", 16))
+SHEET_BATCH_SECTIONS = int(os.getenv("SHEET_BATCH_SECTIONS", 50))
+
 
 def get_username(app, user_id: str, slack_token):
     user = app.client.users_info(user=user_id, token=slack_token)
@@ -23,7 +51,7 @@ def get_username(app, user_id: str, slack_token):
 
 
 def ts_to_timestamp(ts: str):
-    return timezone.datetime.fromtimestamp(float(ts))
+    return timezone.datetime.fromtimestamp(float(ts), tz=timezone.utc)
 
 
 @shared_task
@@ -32,24 +60,71 @@ def index_google(workspace_id: int):
     service = workspace.get_google_drive_service()
     if workspace.corpus_id is None:
         workspace.create_corpus()
+    job = jobs.start(workspace, "drive")
     for file_data in iter_files(service, workspace):
-        keys = ["mimeType", "webViewLink", "name", "id"]
+        keys = ["mimeType", "webViewLink", "name", "id", "modifiedTime", "owners"]
         file_data = {k: v for k, v in file_data.items() if k in keys}
-        index_file_data.delay(workspace_id, file_data)
+        jobs.incr(job.id, enqueued=1)
+        scheduling.submit(workspace, index_file_data, workspace_id, file_data, job.id)
+    jobs.finish_listing(job.id)
 
 
-@shared_task
-def index_file_data(workspace_id: int, file_data: dict):
+@shared_task(base=retries.IndexingTask)
+def index_file_data(workspace_id: int, file_data: dict, job_id: int = None):
+    outcome, size = _index_file_data(workspace_id, file_data)
+    jobs.incr(job_id, **{outcome: 1}, bytes=size)
+
+
+def _index_file_data(workspace_id: int, file_data: dict):
+    """Returns ("succeeded" | "skipped", bytes indexed), raises on failure."""
+    key = idempotency.drive_file(workspace_id, file_data["id"])
+    if not idempotency.claim_version(*key, version=file_data.get("modifiedTime")):
+        logging.info("Skipping already indexed drive file %s", key)
+        return "skipped", 0
+    try:
+        return _index_drive_file(workspace_id, file_data)
+    except Exception:
+        # Unclaimed so that the retry indexes it
+        idempotency.release(*key)
+        raise
+
+
+def _index_drive_file(workspace_id: int, file_data: dict):
     workspace = Workspace.objects.get(pk=workspace_id)
+    author = (file_data.get("owners") or [{}])[0].get("displayName", "")
+    modified = parse_datetime(file_data.get("modifiedTime") or "")
+    if file_data["mimeType"] == SPREADSHEET:
+        return "succeeded", index_sheet(workspace, file_data, author, modified)
     service = workspace.get_google_drive_service()
     file_body = download_file(service, **file_data)
     extension = EXTENSION_FROM_MIMETYPE.get(file_data["mimeType"], "")
+    exported = MIMETYPES_TO_EXPORT.get(file_data["mimeType"], file_data["mimeType"])
+    signature = dedup.signature(dedup.office_text(file_body, exported))
+    canonical = dedup.find_duplicate(workspace_id, signature, file_data["id"])
+    if canonical is not None:
+        document = Document.objects.create(
+            workspace=workspace,
+            link=file_data["webViewLink"],
+            title=file_data["name"],
+            identifier=canonical.identifier,
+            size=0,
+            source="drive",
+            file_id=file_data["id"],
+            author=author,
+            created=modified,
+            mimetype=file_data["mimeType"],
+            canonical=canonical,
+        )
+        _delete_drive_versions(workspace, document)
+        metrics.documents_deduplicated.labels("drive").inc()
+        return "skipped", 0
     response, success = upload(
         file_body,
         file_data["name"],
         extension,
         file_data["mimeType"],
         corpus_id=workspace.corpus_id,
+        metadata=document_metadata("drive", "", author, modified, file_data["mimeType"]),
     )
     if success:
         doc = response.json()
@@ -62,14 +137,125 @@ def index_file_data(workspace_id: int, file_data: dict):
             title=file_data["name"],
             identifier=doc["document"]["documentId"],
             size=size,
+            source="drive",
+            file_id=file_data["id"],
+            author=author,
+            created=modified,
+            mimetype=file_data["mimeType"],
+            signature=dedup.pack(signature),
         )
+        metrics.documents_indexed.labels("drive").inc()
         for section in doc["document"]["section"]:
             Section.objects.create(
                 document=document,
                 word_count=len(section.get("text", "").split()),
+                token_count=count_tokens(section.get("text", "")),
                 section_id=section["id"],
                 text=section.get("text", ""),
             )
+        dedup.remember(document)
+        _delete_drive_versions(workspace, document)
+        return "succeeded", file_body.getbuffer().nbytes
+    retries.raise_for(response)
+
+
+def _delete_drive_versions(workspace: Workspace, document: Document):
+    """Delete the other versions of the Drive file of document from Vectara and
+    the database. Aliases of an indexed version now point to document, or to
+    its canonical when it is an alias itself."""
+    canonical_id = document.canonical_id or document.id
+    stale = (
+        Document.objects.filter(workspace=workspace, file_id=document.file_id)
+        .exclude(pk=document.pk)
+        .values_list("id", "identifier", "canonical_id")
+    )
+    for stale_id, identifier, stale_canonical_id in stale:
+        if stale_canonical_id is None:
+            delete(identifier, workspace.corpus_id)
+        with transaction.atomic():
+            aliases = Document.objects.filter(canonical_id=stale_id)
+            aliases.filter(source="drive").update(identifier=document.identifier)
+            aliases.update(canonical_id=canonical_id)
+            Section.objects.filter(document_id=stale_id).delete()
+            Document.objects.filter(pk=stale_id).delete()
+        logging.info("Deleted an older version of drive file %s", document.file_id)
+
+
+def _batches(items, size: int):
+    items = iter(items)
+    while batch := list(itertools.islice(items, size)):
+        yield batch
+
+
+def index_sheet(workspace: Workspace, file_data: dict, author: str, modified):
+    """Index a spreadsheet while its CSV export downloads, as one document per
+    ``SHEET_BATCH_SECTIONS`` sections. Returns the characters indexed, raises
+    the error of a part that failed. Parts already indexed are skipped the
+    next time, and the parts of other versions are deleted once all of this
+    version's are indexed."""
+    service = workspace.get_google_drive_service()
+    metadata = document_metadata("drive", "", author, modified, file_data["mimeType"])
+    version = int(modified.timestamp()) if modified else 0
+    sections = sheet_sections(stream_csv(service, file_data["id"]))
+    size = 0
+    for part, batch in enumerate(_batches(sections, SHEET_BATCH_SECTIONS)):
+        identifier = f"{file_data['id']}-{version}-{part}"
+        if Document.objects.filter(workspace=workspace, identifier=identifier).exists():
+            continue
+        indexed = build_document(
+            identifier, file_data["name"], False, sections=batch, metadata=metadata
+        )
+        for section_id, section in enumerate(indexed.section, 1):
+            section.id = section_id
+        [(_, error, success)] = index_many([indexed], workspace.corpus_id)
+        if not success:
+            logging.error("Indexing part %s of a sheet failed: %s", identifier, error)
+            raise error
+        document = Document.objects.create(
+            workspace=workspace,
+            link=file_data["webViewLink"],
+            title=file_data["name"],
+            identifier=identifier,
+            size=sum(len(text) for text in batch),
+            source="drive",
+            file_id=file_data["id"],
+            author=author,
+            created=modified,
+            mimetype=file_data["mimeType"],
+        )
+        Section.objects.bulk_create(
+            Section(
+                document=document,
+                word_count=len(text.split()),
+                token_count=count_tokens(text),
+                section_id=section_id,
+                text=text,
+            )
+            for section_id, text in enumerate(batch, 1)
+        )
+        metrics.documents_indexed.labels("drive").inc()
+        size += document.size
+    _delete_sheet_versions(workspace, file_data["id"], version)
+    return size
+
+
+def _delete_sheet_versions(workspace: Workspace, file_id: str, version: int):
+    """Delete the parts of the other versions of a sheet from Vectara and the
+    database."""
+    stale = (
+        Document.objects.filter(
+            workspace=workspace, identifier__regex=rf"^{re.escape(file_id)}-\d+-\d+$"
+        )
+        .exclude(identifier__startswith=f"{file_id}-{version}-")
+        .values_list("id", "identifier")
+    )
+    for document_id, identifier in stale:
+        delete(identifier, workspace.corpus_id)
+        # Sheet parts have no signature, so no other document is their alias
+        with transaction.atomic():
+            Section.objects.filter(document_id=document_id).delete()
+            Document.objects.filter(pk=document_id).delete()
+        logging.info("Deleted part %s of an older version of a sheet", identifier)
 
 
 @shared_task
@@ -114,10 +300,10 @@ def index_slack(workspace_id: int):
 
 @shared_task
 def index_channel(channel_id):
+    channel = SlackChannel.objects.filter(channel_id=channel_id).first()
+    channel_name = channel.channel_name
     logging.info("INDEXING %s [ID: %s]", channel_name, channel_id)
 
-    channel = SlackChannel.objects.filter(channel_id=channel_id).first()
-    channel_name = channel.name
     workspace = channel.workspace
     credentials = workspace.slack_credentials
     if not credentials:
@@ -126,6 +312,7 @@ def index_channel(channel_id):
 
     app = slack.user_app(slack_token)
 
+    job = jobs.start(workspace, "slack")
     cursor = None
     while True:
         response = app.client.conversations_history(
@@ -133,45 +320,97 @@ def index_channel(channel_id):
         )
         response.validate()
 
+        # Counted once per page
+        counts = Counter()
         for message in response["messages"]:
-            identifier = f"{channel_id}-{message['ts']}"
-            username = get_username(app, message["user"], slack_token)
-            title = f"@{username} in #{channel_name}"
-            section = message["text"]
-            document = store(
-                identifier, title, sections=[section], corpus_id=workspace.corpus_id,
+            if "user" not in message:
+                continue
+            counts["enqueued"] += 1
+            key = idempotency.slack_message(
+                workspace.slack_workspace_id, channel_id, message["ts"]
             )
-            if document is None:
+            if not idempotency.claim(*key):
+                counts["skipped"] += 1
                 continue
+            identifier = f"{channel_id}-{message['ts']}"
+            try:
+                username = get_username(app, message["user"], slack_token)
+                title = f"@{username} in #{channel_name}"
+                section = message["text"]
+                created = ts_to_timestamp(message["ts"])
+                signature = dedup.signature(section)
+                canonical = dedup.find_duplicate(workspace.id, signature)
 
-            permalink = app.client.chat_getPermalink(
-                channel=channel_id, message_ts=message["ts"], token=slack_token,
-            )
-            document = Document.objects.create(
-                workspace=workspace,
-                link=permalink,
-                title=title,
-                identifier=identifier,
-                size=0,
-            )
-            Section.objects.create(
-                document=document,
-                word_count=len(section.split()),
-                section_id=0,
-                text=section,
-            )
+                permalink = app.client.chat_getPermalink(
+                    channel=channel_id, message_ts=message["ts"], token=slack_token,
+                )["permalink"]
+                with transaction.atomic():
+                    document = Document.objects.create(
+                        workspace=workspace,
+                        link=permalink,
+                        title=title,
+                        identifier=identifier,
+                        size=0,
+                        source="slack",
+                        channel_id=channel_id,
+                        author=username,
+                        created=created,
+                        canonical=canonical,
+                        signature=dedup.pack(signature),
+                    )
+                    if canonical is None:
+                        Section.objects.create(
+                            document=document,
+                            word_count=len(section.split()),
+                            token_count=count_tokens(section),
+                            section_id=0,
+                            text=section,
+                        )
+                        dedup.remember(document)
+                        spool.append(document, send=False)
+            except Exception:
+                # Unclaimed so that the next run indexes it
+                idempotency.release(*key)
+                logging.exception("Indexing slack message %s failed", identifier)
+                counts["failed"] += 1
+                continue
+            if canonical is not None:
+                metrics.documents_deduplicated.labels("slack").inc()
+                counts["skipped"] += 1
+                continue
+            counts["succeeded"] += 1
+            counts["bytes"] += len(section.encode())
+        jobs.incr(job.id, **counts)
+        # Sent in batches once the page is spooled
+        if counts["succeeded"]:
+            spool.drain.delay(workspace.id)
 
         cursor = response.get("response_metadata", {}).get("next_cursor")
-        if cursor is None:
+        if not cursor:
             break
+    jobs.finish_listing(job.id)
 
 
-@shared_task
+@shared_task(base=retries.IndexingTask)
 def index_message(channel_id, user, text, ts, team):
-    channel = SlackChannel.objects.filter(channel_id=channel_id).first()
+    key = idempotency.slack_message(team, channel_id, ts)
+    if not idempotency.claim(*key):
+        logging.info("Skipping already indexed slack message %s", key)
+        return
+    try:
+        _index_message(channel_id, user, text, ts, team)
+    except Exception:
+        # Unclaimed so that the retry indexes it
+        idempotency.release(*key)
+        raise
+
+
+def _index_message(channel_id, user, text, ts, team):
+    channels = SlackChannel.objects.select_related("workspace")
+    channel = channels.filter(channel_id=channel_id).first()
     if channel is None:
         index_slack(Workspace.objects.filter(slack_workspace_id=team).first().id)
-        channel = SlackChannel.objects.filter(channel_id=channel_id).first()
+        channel = channels.filter(channel_id=channel_id).first()
 
     logging.info(
         "Indexing message [%s] for channel: %s [%s]",
@@ -186,20 +425,128 @@ def index_message(channel_id, user, text, ts, team):
     slack_token = credentials["credentials"]["access_token"]
     channel_name = channel.channel_name
     app = slack.user_app(slack_token)
-    identifier = f"{channel}-{ts}"
+    identifier = f"{channel.channel_id}-{ts}"
     username = get_username(app, user, slack_token)
     title = f"@{username} in #{channel_name}"
     section = text
-    document = store(
-        identifier, title, False, sections=[section], corpus_id=workspace.corpus_id,
-    )
+    created = ts_to_timestamp(ts)
+    signature = dedup.signature(section)
+    canonical = dedup.find_duplicate(workspace.id, signature)
 
     permalink = app.client.chat_getPermalink(
         channel=channel.channel_id, message_ts=ts, token=slack_token,
     )["permalink"]
-    document = Document.objects.create(
-        workspace=workspace, link=permalink, title=title, identifier=identifier, size=0,
-    )
-    Section.objects.create(
-        document=document, word_count=len(section.split()), section_id=0, text=section,
-    )
+    with transaction.atomic():
+        document = Document.objects.create(
+            workspace=workspace,
+            link=permalink,
+            title=title,
+            identifier=identifier,
+            size=0,
+            source="slack",
+            channel_id=channel.channel_id,
+            author=username,
+            created=created,
+            canonical=canonical,
+            signature=dedup.pack(signature),
+        )
+        if canonical is None:
+            Section.objects.create(
+                document=document,
+                word_count=len(section.split()),
+                token_count=count_tokens(section),
+                section_id=0,
+                text=section,
+            )
+            dedup.remember(document)
+            spool.append(document)
+    if canonical is not None:
+        metrics.documents_deduplicated.labels("slack").inc()
+
+
+@shared_task
+def rebuild_corpus(
+    workspace_id: int,
+    reset: bool = False,
+    create: bool = False,
+    restart: bool = False,
+    batch_size: int = REBUILD_BATCH_SIZE,
+    concurrency: int = REBUILD_CONCURRENCY,
+):
+    workspace = Workspace.objects.get(pk=workspace_id)
+    rebuild = None
+    if not restart:
+        rebuild = workspace.rebuilds.filter(finished_at=None).order_by("-id").first()
+    if rebuild is None:
+        if create or workspace.corpus_id is None:
+            workspace.create_corpus()
+            if workspace.corpus_id is None:
+                return None
+        elif reset:
+            _, success = reset_corpus(workspace.corpus_id)
+            if not success:
+                return None
+            replace_filter_attributes(workspace.corpus_id)
+        rebuild = CorpusRebuild.objects.create(workspace=workspace)
+    else:
+        logging.info(
+            "Resuming rebuild [%s] of workspace [%s] after document %s",
+            rebuild.id,
+            workspace_id,
+            rebuild.last_document_id,
+        )
+
+    sections = Prefetch("sections", queryset=Section.objects.order_by("section_id"))
+    while True:
+        documents = list(
+            Document.objects.filter(
+                workspace=workspace,
+                canonical=None,
+                id__gt=rebuild.last_document_id,
+            )
+            .order_by("id")
+            .prefetch_related(sections)[:batch_size]
+        )
+        if not documents:
+            break
+        started = time.monotonic()
+        batch = []
+        for document in documents:
+            indexed = build_document(
+                document.identifier,
+                document.title,
+                False,
+                sections=[s.text for s in document.sections.all()],
+                metadata=document.metadata,
+            )
+            for section, stored in zip(indexed.section, document.sections.all()):
+                section.id = stored.section_id
+            batch.append(indexed)
+        results = index_many(batch, workspace.corpus_id, concurrency=concurrency)
+        for indexed, error, success in results:
+            if success:
+                metrics.documents_indexed.labels("rebuild").inc()
+                rebuild.documents_indexed += 1
+                rebuild.sections_indexed += len(indexed.section)
+            else:
+                rebuild.documents_failed += 1
+                logging.error(
+                    "Rebuild [%s] failed to index %s: %s",
+                    rebuild.id,
+                    indexed.document_id,
+                    error,
+                )
+        rebuild.elapsed += time.monotonic() - started
+        rebuild.last_document_id = documents[-1].id
+        rebuild.save()
+        logging.info(
+            "Rebuild [%s]: %s documents indexed, %s failed (%.1f docs/s)",
+            rebuild.id,
+            rebuild.documents_indexed,
+            rebuild.documents_failed,
+            rebuild.documents_per_second,
+        )
+
+    rebuild.finished_at = timezone.now()
+    rebuild.save()
+    return rebuild.id
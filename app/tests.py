@@ -1,3 +1,347 @@
-from django.test import TestCase
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+import numpy as np
+
+from app.models import Document, Profile, QueryLog, Workspace
+import indexing_pb2
+from poma import concurrency, dedup, idempotency, retries
+from poma.metrics import metrics_view
+from poma.search.breaker import (
+    BREAKER_COOLDOWN_SECONDS,
+    BREAKER_MIN_CALLS,
+    BREAKER_SLOW_SECONDS,
+    CircuitBreaker,
+)
+from poma.search import semantic
+from poma.search.diversify import diversify, mmr, vectorize
+from poma.search.suggest import Trie, WorkspaceSuggestions
+from poma.sources.gdrive import sheet_sections
+import services_pb2
+import status_pb2
+
+
+class TrieTests(SimpleTestCase):
+    def test_completes_after_edge_splits(self):
+        trie = Trie()
+        trie.add("budget", 3)
+        # Each of these splits the edge the previous phrases share
+        trie.add("build", 2)
+        trie.add("bud", 1)
+        trie.add("buddy", 1)
+        self.assertEqual(trie.complete("bu"), ["budget", "build", "bud", "buddy"])
+        self.assertEqual(trie.complete("bud"), ["budget", "bud", "buddy"])
+        self.assertEqual(trie.complete("budg"), ["budget"])
+        self.assertEqual(trie.complete("bui"), ["build"])
+        self.assertEqual(trie.complete("bx"), [])
+
+    def test_completes_from_later_words(self):
+        trie = Trie()
+        trie.add("Q3 Budget  review")
+        self.assertEqual(trie.complete("budget"), ["Q3 Budget  review"])
+        self.assertEqual(trie.complete("q3 b"), ["Q3 Budget  review"])
+
+    def test_keeps_the_best_completions(self):
+        trie = Trie(limit=2)
+        for phrase, score in [("alpha", 1), ("alps", 3), ("altitude", 2)]:
+            trie.add(phrase, score)
+        self.assertEqual(trie.complete("al"), ["alps", "altitude"])
+        trie.add("alpha", 5)
+        self.assertEqual(trie.complete("al"), ["alpha", "alps"])
+
+
+class QuerySuggestionTests(TestCase):
+    def test_suggests_only_the_users_own_queries(self):
+        alice = User.objects.create(username="alice")
+        bob = User.objects.create(username="bob")
+        workspace = Workspace.objects.create(owner=alice, name="Acme", corpus_id=1)
+        QueryLog.record(workspace, alice, "salary review")
+        QueryLog.record(workspace, bob, "sales report")
+        QueryLog.record(workspace, bob, "sales report")
+        suggestions = WorkspaceSuggestions(workspace.id)
+        self.assertEqual(
+            suggestions.complete("sa", user_id=alice.id), ["salary review"]
+        )
+        self.assertEqual(suggestions.complete("sa", user_id=bob.id), ["sales report"])
+        self.assertEqual(suggestions.complete("sa"), [])
+
+
+class MMRTests(SimpleTestCase):
+    texts = [
+        "quarterly budget review for the sales team",
+        "quarterly budget review for the sales team",
+        "office move planned for next spring",
+    ]
+
+    def test_lambda_one_keeps_the_relevance_order(self):
+        relevance = np.array([1, 0.9, 0.5], dtype=np.float32)
+        self.assertEqual(mmr(relevance, vectorize(self.texts), lam=1), [0, 1, 2])
+
+    def test_lambda_zero_picks_the_most_different_next(self):
+        relevance = np.array([1, 0.9, 0.5], dtype=np.float32)
+        self.assertEqual(mmr(relevance, vectorize(self.texts), lam=0), [0, 2, 1])
+
+    def test_copies_sink_below_distinct_results(self):
+        responses = [
+            {"text": text, "score": score}
+            for text, score in zip(self.texts + ["hiring plan"], [0.9, 0.89, 0.88, 0.5])
+        ]
+        order = [responses.index(r) for r in diversify(responses, lam=0.7)]
+        self.assertEqual(order, [0, 2, 1, 3])
+        self.assertIs(diversify(responses, lam=1), responses)
+
+
+class NearDuplicateTests(TestCase):
+    text = " ".join(f"word{i}" for i in range(80))
+
+    def test_near_duplicates_have_similar_signatures(self):
+        edited = self.text.replace(self.text.split()[40], "changed", 1)
+        similarity = dedup.similarity(
+            dedup.signature(self.text), dedup.signature(edited)
+        )
+        self.assertGreaterEqual(similarity, dedup.DEDUP_THRESHOLD)
+        self.assertLess(similarity, 1)
+        other = dedup.signature(" ".join(f"other{i}" for i in range(80)))
+        self.assertLess(dedup.similarity(dedup.signature(self.text), other), 0.3)
+
+    def test_short_texts_are_not_deduplicated(self):
+        self.assertIsNone(dedup.signature("thanks, see you tomorrow"))
+        self.assertIsNone(dedup.find_duplicate(1, None))
+
+    def test_finds_the_canonical_document(self):
+        owner = User.objects.create(username="owner")
+        workspace = Workspace.objects.create(owner=owner, name="Acme", corpus_id=1)
+        signature = dedup.signature(self.text)
+        original = Document.objects.create(
+            workspace=workspace, title="a", size=0, signature=dedup.pack(signature)
+        )
+        dedup.remember(original)
+        copy = Document.objects.create(
+            workspace=workspace,
+            title="b",
+            size=0,
+            canonical_id=original.id,
+            signature=dedup.pack(signature),
+        )
+        dedup.remember(copy)
+        self.assertEqual(dedup.find_duplicate(workspace.id, signature), original)
+        other = Workspace.objects.create(owner=owner, name="Other", corpus_id=2)
+        self.assertIsNone(dedup.find_duplicate(other.id, signature))
+
+    def test_versions_of_a_drive_file_are_not_duplicates(self):
+        owner = User.objects.create(username="owner")
+        workspace = Workspace.objects.create(owner=owner, name="Acme", corpus_id=1)
+        signature = dedup.signature(self.text)
+        previous = Document.objects.create(
+            workspace=workspace,
+            title="a",
+            size=0,
+            file_id="file-1",
+            signature=dedup.pack(signature),
+        )
+        dedup.remember(previous)
+        self.assertIsNone(dedup.find_duplicate(workspace.id, signature, "file-1"))
+        self.assertEqual(
+            dedup.find_duplicate(workspace.id, signature, "file-2"), previous
+        )
+
+
+class SheetSectionTests(SimpleTestCase):
+    def test_groups_rows_as_column_value_pairs(self):
+        rows = [["Id", "Name", ""], ["1", "Alice", "x"], ["", " ", ""], ["2", "Bob"]]
+        self.assertEqual(
+            list(sheet_sections(rows, max_chars=40)),
+            ["Id: 1; Name: Alice; Column 3: x", "Id: 2; Name: Bob"],
+        )
+
+    def test_splits_long_rows_with_their_first_columns(self):
+        rows = [["Id", "Name", "Notes"], ["1", "Alice", "lorem ipsum " * 10]]
+        sections = list(sheet_sections(rows, max_chars=60))
+        self.assertGreater(len(sections), 1)
+        for section in sections:
+            self.assertLessEqual(len(section), 60)
+            self.assertTrue(section.startswith("Id: 1; Name: Alice; "))
+        notes = "".join(section[len("Id: 1; Name: Alice; ") :] for section in sections)
+        self.assertEqual(notes, "Notes: " + ("lorem ipsum " * 10).strip())
+
+
+class IdempotencyTests(SimpleTestCase):
+    def claim(self, previous, version):
+        client = mock.Mock()
+        client.set.return_value = previous
+        with mock.patch.object(idempotency, "get_redis", return_value=client):
+            claimed = idempotency.claim_version("drive-file", 1, "abc", version=version)
+        client.set.assert_called_once_with(
+            "poma:seen:drive-file:1:abc", version, get=True
+        )
+        return claimed
+
+    def test_new_versions_are_claimed(self):
+        self.assertTrue(self.claim(None, "2023-03-01T10:00:00.000Z"))
+        self.assertTrue(
+            self.claim(b"2023-03-01T10:00:00.000Z", "2023-03-02T09:00:00.000Z")
+        )
+
+    def test_the_current_version_is_skipped_for_good(self):
+        self.assertFalse(
+            self.claim(b"2023-03-01T10:00:00.000Z", "2023-03-01T10:00:00.000Z")
+        )
+
+
+class AIMDTests(SimpleTestCase):
+    def adjust(self, calls, overloaded, seconds, limit=b"8", baseline=b"0.1"):
+        client = mock.Mock()
+        client.hgetall.return_value = {
+            b"calls": str(calls).encode(),
+            b"overloaded": str(overloaded).encode(),
+            b"seconds": str(seconds).encode(),
+        }
+        client.mget.return_value = [limit, baseline]
+        with mock.patch.object(concurrency, "get_redis", return_value=client):
+            concurrency._adjust("vectara", "window")
+        if not client.mset.called:
+            return None
+        [values] = client.mset.call_args.args
+        return values[concurrency._key("vectara", "limit")]
+
+    def test_healthy_window_increases_the_limit(self):
+        self.assertEqual(self.adjust(20, 0, 20 * 0.1), 8 + concurrency.AIMD_INCREASE)
+
+    def test_overload_backs_off(self):
+        self.assertEqual(self.adjust(20, 5, 20 * 0.1), 8 * concurrency.AIMD_BACKOFF)
+
+    def test_slow_window_backs_off(self):
+        self.assertEqual(self.adjust(20, 0, 20 * 0.5), 8 * concurrency.AIMD_BACKOFF)
+
+    def test_limit_stays_within_bounds(self):
+        maximum = str(concurrency.AIMD_MAX).encode()
+        self.assertEqual(self.adjust(20, 0, 2, limit=maximum), concurrency.AIMD_MAX)
+        minimum = str(concurrency.AIMD_MIN).encode()
+        self.assertEqual(self.adjust(20, 20, 2, limit=minimum), concurrency.AIMD_MIN)
+
+    def test_small_windows_are_ignored(self):
+        self.assertIsNone(self.adjust(concurrency.AIMD_MIN_SAMPLES - 1, 5, 1))
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch("poma.search.breaker.time.monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = CircuitBreaker("vectara")
+
+    def fail(self, calls=BREAKER_MIN_CALLS):
+        for _ in range(calls):
+            self.breaker.record(0.1, success=False)
+
+    def test_opens_after_failures(self):
+        self.fail(BREAKER_MIN_CALLS - 1)
+        self.assertTrue(self.breaker.allow())
+        self.fail(1)
+        self.assertFalse(self.breaker.allow())
+
+    def test_slow_calls_count_as_failures(self):
+        for _ in range(BREAKER_MIN_CALLS):
+            self.breaker.record(BREAKER_SLOW_SECONDS, success=True)
+        self.assertFalse(self.breaker.allow())
+
+    def test_half_open_probe_closes_on_success(self):
+        self.fail()
+        self.now += BREAKER_COOLDOWN_SECONDS
+        self.assertTrue(self.breaker.allow())
+        # A single probe is let through
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record(0.1, success=True)
+        self.assertTrue(self.breaker.allow())
+        self.assertTrue(self.breaker.allow())
+
+    def test_failed_probe_opens_again(self):
+        self.fail()
+        self.now += BREAKER_COOLDOWN_SECONDS
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record(0.1, success=False)
+        self.assertFalse(self.breaker.allow())
+        self.now += BREAKER_COOLDOWN_SECONDS
+        self.assertTrue(self.breaker.allow())
+
+
+class IndexStatusTests(SimpleTestCase):
+    def index(self, code):
+        response = services_pb2.IndexDocumentResponse()
+        response.status.code = code
+        stub = mock.Mock()
+        stub.return_value.Index.return_value = response
+        with mock.patch("services_pb2_grpc.IndexServiceStub", stub), mock.patch.object(
+            semantic.concurrency, "limited"
+        ) as limited:
+            error, success = semantic.index(
+                indexing_pb2.Document(document_id="doc"), 1, 1, "localhost", "jwt"
+            )
+        return error, success, limited.return_value.__enter__.return_value.overloaded
+
+    def test_stored_documents_succeed(self):
+        self.assertEqual(self.index(status_pb2.OK), (None, True, False))
+        self.assertEqual(self.index(status_pb2.ALREADY_EXISTS), (None, True, False))
+
+    def test_rejected_documents_fail_for_good(self):
+        error, success, overloaded = self.index(status_pb2.INVALID_ARGUMENT)
+        self.assertIsInstance(error, semantic.IndexRejected)
+        self.assertFalse(success)
+        self.assertFalse(overloaded)
+        self.assertFalse(retries.retryable(error))
+
+    def test_overloaded_vectara_is_retried(self):
+        error, success, overloaded = self.index(status_pb2.RESOURCE_EXHAUSTED)
+        self.assertIsInstance(error, semantic.IndexRejected)
+        self.assertFalse(success)
+        self.assertTrue(overloaded)
+        self.assertTrue(retries.retryable(error))
+
+
+class MetricsViewTests(SimpleTestCase):
+    def scrape(self, **headers):
+        return metrics_view(RequestFactory().get("/metrics", **headers)).status_code
+
+    @override_settings(METRICS_TOKEN=None, DEBUG=False)
+    def test_closed_without_a_token(self):
+        self.assertEqual(self.scrape(), 403)
+
+    @override_settings(METRICS_TOKEN=None, DEBUG=True)
+    def test_open_in_development(self):
+        self.assertEqual(self.scrape(), 200)
+
+    @override_settings(METRICS_TOKEN="secret", DEBUG=False)
+    def test_requires_the_token(self):
+        self.assertEqual(self.scrape(), 403)
+        self.assertEqual(self.scrape(HTTP_AUTHORIZATION="Bearer wrong"), 403)
+        self.assertEqual(self.scrape(HTTP_AUTHORIZATION="Bearer secret"), 200)
+
+
+class AnswerTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username="alice")
+        self.workspace = Workspace.objects.create(
+            owner=self.user, name="Acme", corpus_id=1
+        )
+        Profile.objects.create(user=self.user, current_workspace=self.workspace)
+        self.client.force_login(self.user)
+
+    def answer(self, mode, gpt="true"):
+        Workspace.objects.filter(pk=self.workspace.pk).update(answer_mode=mode)
+        search = (None, [(1, 1, 0.9)], False, None)
+        with mock.patch("app.views.run_search", return_value=search), mock.patch(
+            "app.views.anwser", return_value="42"
+        ) as anwser:
+            response = self.client.get("/answer/", {"q": "meaning", "gpt": gpt})
+        return response.json()["answer"], anwser.called
+
+    def test_answers_with_gpt_when_the_workspace_does(self):
+        with mock.patch("app.views.assemble", return_value="context"):
+            self.assertEqual(self.answer(Workspace.EXTRACTIVE_THEN_GPT), ("42", True))
+            self.assertEqual(self.answer(Workspace.GPT), ("42", True))
+
+    def test_never_calls_gpt_otherwise(self):
+        self.assertEqual(self.answer(Workspace.EXTRACTIVE), ("", False))
+        self.assertEqual(self.answer(Workspace.GPT, gpt="false"), ("", False))
@@ -1,6 +1,7 @@
 from django.urls import path
 
 from app.views import (
+    Answer,
     Home,
     RegisterView,
     UpdateWorkspaceView,
@@ -8,15 +9,22 @@ from app.views import (
     VerifyView,
     GoogleOauth,
     GoogleOauthCallback,
+    IngestionProgress,
     RevokeGoogleCredentials,
     Search,
     SearchFailure,
+    Suggest,
 )
 from django.conf import settings
 
 urlpatterns = [
     path("register/", RegisterView.as_view(), name="register"),
     path("workspace/", UpdateWorkspaceView.as_view(), name="workspace-update"),
+    path(
+        "workspace/progress/",
+        IngestionProgress.as_view(),
+        name="ingestion-progress",
+    ),
     path("sent/", EmailSentView.as_view(), name="email-sent"),
     path("verify/<str:token>/", VerifyView.as_view(), name="verify-email"),
     path("google-oauth/", GoogleOauth.as_view(), name="google-oauth"),
@@ -32,6 +40,8 @@ urlpatterns = [
     ),
     path("search/", Search.as_view(), name="search"),
     path("search-failure/", SearchFailure.as_view(), name="search-failure"),
+    path("suggest/", Suggest.as_view(), name="suggest"),
+    path("answer/", Answer.as_view(), name="answer"),
     path("", Home.as_view(), name="home"),
 ]
 
@@ -39,5 +49,7 @@ if settings.DEMO_USERNAME:
     urlpatterns = [
         path("search/", Search.as_view(), name="search"),
         path("search-failure/", SearchFailure.as_view(), name="search-failure"),
+        path("suggest/", Suggest.as_view(), name="suggest"),
+        path("answer/", Answer.as_view(), name="answer"),
         path("", Home.as_view(), name="home"),
     ]
@@ -1,3 +1,4 @@
+import datetime
 import os
 import secrets
 import urllib.parse
@@ -10,22 +11,38 @@ from django.views.generic import TemplateView
 from django.views.generic.edit import FormView
 from django.views.generic.edit import UpdateView
 from django.shortcuts import render, redirect
+from django.http import JsonResponse
 from django.contrib.auth import login
 from django.utils import timezone
+from django.utils.dateparse import parse_date
 from django.contrib.auth.models import User
 from django.contrib.auth.mixins import LoginRequiredMixin, AccessMixin
 from app.forms import WorkspaceForm, WorkspaceCreationMultiForm
-from app.models import SlackInstallation, Workspace, Profile, Document, Section
+from app.models import (
+    SlackInstallation,
+    Workspace,
+    Profile,
+    Document,
+    QueryLog,
+    search_workspaces,
+)
 from app.verification import send_verification, verify_user_token
 import google.oauth2.credentials
 import google_auth_oauthlib.flow
 import requests
+from poma import jobs, metrics
+from poma.search.context import assemble
+from poma.search.extractive import answer as extractive_answer
 from poma.search.openai import anwser
+from poma.search.semantic import metadata_filter
+from poma.search.suggest import suggest
 from app import tasks
 from poma.sources import slack
 from poma.sources.nango import get_token
 
-PAGING = 15
+SEARCH_FILTERS = ["source", "channel", "author", "after", "before"]
+# Ingestion jobs shown in the progress panel of the workspace page
+JOBS_SHOWN = 5
 SLACK_SCOPES = os.getenv("SLACK_SCOPES", "")
 SLACK_CLIENT_ID = os.getenv("SLACK_CLIENT_ID")
 SLACK_CLIENT_SECRECT = os.getenv("SLACK_CLIENT_SECRET")
@@ -126,6 +143,38 @@ class UpdateWorkspaceView(LoginRequiredMixin, UpdateView):
         return super().dispatch(request, *args, **kwargs)
 
 
+class IngestionProgress(LoginRequiredMixin, views.View):
+    """Live counters of the latest ingestion jobs of the current workspace."""
+
+    def get(self, request, *args, **kwargs):
+        if not request.user.profile.is_admin():
+            return JsonResponse({"jobs": []}, status=403)
+        workspace = request.user.profile.current_workspace
+        latest = workspace.ingestion_jobs.order_by("-id")[:JOBS_SHOWN]
+        return JsonResponse({"jobs": [jobs.live(job).progress() for job in latest]})
+
+
+def _day(value: str, days: int = 0):
+    date = parse_date(value or "")
+    if date is None:
+        return None
+    date += datetime.timedelta(days=days)
+    return timezone.make_aware(datetime.datetime.combine(date, datetime.time.min))
+
+
+def search_filters(params):
+    """The facets of a search and the metadata filter they translate to."""
+    filters = {name: params[name] for name in SEARCH_FILTERS if params.get(name)}
+    return filters, metadata_filter(
+        source=filters.get("source"),
+        channel=filters.get("channel"),
+        author=filters.get("author"),
+        after=_day(filters.get("after")),
+        # before is inclusive in the form
+        before=_day(filters.get("before"), days=1),
+    )
+
+
 class SearchMixin(DemoMixin):
     default_template = "app/home.html"
 
@@ -137,6 +186,9 @@ class SearchMixin(DemoMixin):
         params = {"q": query}
         if gpt == "on":
             params["gpt"] = "true"
+        if self.request.POST.get("all") == "on":
+            params["all"] = "true"
+        params.update(search_filters(self.request.POST)[0])
         params = urllib.parse.urlencode(params)
         url = reverse("search") + f"?{params}"
         return redirect(url)
@@ -147,72 +199,144 @@ class Home(SearchMixin, LoginRequiredMixin, views.View):
         return render(request, "app/home.html")
 
 
+def run_search(request):
+    """Search for the query, filters and page of a request.
+    Returns:
+        (results, hits, has_next, error) where hits are the (document id, section
+        id, score) of the results, and error is None in case of success.
+    """
+    query = request.GET.get("q")
+    try:
+        page = max(int(request.GET.get("page", 1)), 1)
+    except ValueError:
+        page = 1
+    _, expression = search_filters(request.GET)
+    federated = request.GET.get("all") == "true"
+    profile = request.user.profile
+    workspace = profile.current_workspace
+    workspaces = profile.searchable_workspaces() if federated else [workspace]
+    responses, has_next, error, success = search_workspaces(
+        workspaces, query, page, expression
+    )
+    if not success:
+        return [], [], False, error
+
+    results = {}
+    hits = []
+    with metrics.timer(metrics.search_hydration_seconds):
+        by_corpus = {w.corpus_id: w for w in workspaces}
+        # Descending ids so the first document stored for an identifier wins
+        documents = {
+            (document.workspace_id, document.identifier): document
+            for document in Document.objects.filter(
+                workspace__in=workspaces,
+                identifier__in={r["documentId"] for r in responses},
+            ).order_by("-id")
+        }
+        for response in responses:
+            link = title = ""
+            result_workspace = by_corpus.get(response["corpusId"], workspace)
+            document = documents.get((result_workspace.id, response["documentId"]))
+            if document:
+                link = document.link
+                title = document.title
+            metadata = {m["name"]: m["value"] for m in response.get("metadata", [])}
+            if metadata.get("is_title") == "true":
+                continue
+            text = response.get("text", "")
+            results[text + "-" + link] = {
+                "text": text,
+                "score": response.get("score", ""),
+                "link": link,
+                "title": title,
+                "workspace": result_workspace.name if federated else "",
+                "degraded": response.get("degraded", False),
+            }
+            if document and (section := metadata.get("section")):
+                hits.append((document.id, int(section), response.get("score", 0)))
+    # Kept in the window order, which is diversified rather than by score
+    return list(results.values()), hits, has_next, None
+
+
 class Search(SearchMixin, LoginRequiredMixin, views.View):
     def get(self, request, *args, **kwargs):
         query = request.GET.get("q")
-        gpt = request.GET.get("gpt")
-        response, error, success = request.user.profile.current_workspace._search(query)
-        if not success:
+        gpt = request.GET.get("gpt") == "true"
+        try:
+            page = max(int(request.GET.get("page", 1)), 1)
+        except ValueError:
+            page = 1
+        filters, _ = search_filters(request.GET)
+        federated = request.GET.get("all") == "true"
+        results, hits, has_next, error = run_search(request)
+        if error is not None:
             logging.error("Search failed, %s", error)
             params = {"reason": error}
             params = urllib.parse.urlencode(params)
             url = reverse("search-failure") + f"?{params}"
             return redirect(url)
-
-        data = response.json()
-        results = {}
-        response_sets = data.get("responseSet", [])
-        document_ids = []
-        section_ids = []
-        for response_set in response_sets:
-            documents = response_set.get("document", [])
-            for response in response_set.get("response"):
-                link = title = ""
-                try:
-                    document_id = documents[response.get("documentIndex")].get("id")
-                    document = Document.objects.filter(identifier=document_id).first()
-                    if documents and document:
-                        link = document.link
-                        title = document.title
-                        document_ids.append(document.id)
-                except IndexError as e:
-                    logging.error("Getting the document failed", exc_info=e)
-                    pass
-                metadata = {m["name"]: m["value"] for m in response.get("metadata", [])}
-                if metadata.get("is_title") == 'true':
-                    continue
-                text = response.get("text", "")
-                results[text + "-" + link] = {
-                    "text": text,
-                    "score": response.get("score", ""),
-                    "link": link,
-                    "title": title,
-                }
-                if section := metadata.get("section"):
-                        section_ids.append(int(section))
-        if gpt == "true" and document_ids:
-            context = (
-                "".join(
-                    Section.objects.filter(
-                        document_id=document_ids[0], section_id__in=section_ids
-                    ).values_list("text", flat=True)
-                )[:1000]
-                + "..."
-            )
-            gpt = anwser(query, context)
-        else:
-            gpt = ""
+        workspace = request.user.profile.current_workspace
+        if page == 1:
+            QueryLog.record(workspace, request.user, query)
+
+        mode = workspace.answer_mode if gpt and hits else None
+        extractive = {}
+        if mode in (Workspace.EXTRACTIVE, Workspace.EXTRACTIVE_THEN_GPT):
+            extractive = extractive_answer(query, hits)
+        gpt_response = ""
+        if mode == Workspace.GPT:
+            gpt_response = anwser(query, assemble(hits))
         return render(
             request,
             "app/search-result.html",
             context={
-                "results": sorted(results.values(), key=lambda r: -r["score"]),
+                "results": results,
+                "degraded": any(result["degraded"] for result in results),
                 "q": query,
-                "gpt_response": gpt,
+                "gpt": gpt,
+                "gpt_response": gpt_response,
+                "extractive": extractive,
+                "gpt_pending": mode == Workspace.EXTRACTIVE_THEN_GPT,
+                "page": page,
+                "previous_page": page - 1 if page > 1 else None,
+                "next_page": page + 1 if has_next else None,
+                "filters": filters,
+                "filter_params": urllib.parse.urlencode(
+                    {**filters, "all": "true"} if federated else filters
+                ),
+                "federated": federated,
             },
         )
 
 
+class Answer(LoginRequiredMixin, views.View):
+    """GPT answer of a search, fetched after the page showed the extractive one.
+    The results come from the cached search window. Empty unless the search
+    asked for GPT and the workspace answers with it."""
+
+    def get(self, request, *args, **kwargs):
+        mode = request.user.profile.current_workspace.answer_mode
+        gpt = request.GET.get("gpt") == "true"
+        if not gpt or mode not in (Workspace.GPT, Workspace.EXTRACTIVE_THEN_GPT):
+            return JsonResponse({"answer": ""})
+        _, hits, _, error = run_search(request)
+        if error is not None or not hits:
+            return JsonResponse({"answer": ""})
+        return JsonResponse(
+            {"answer": anwser(request.GET.get("q"), assemble(hits))}
+        )
+
+
+class Suggest(LoginRequiredMixin, views.View):
+    def get(self, request, *args, **kwargs):
+        prefix = request.GET.get("q", "")
+        suggestions = []
+        if prefix.strip():
+            workspace_id = request.user.profile.current_workspace_id
+            suggestions = suggest(workspace_id, prefix, user_id=request.user.id)
+        return JsonResponse({"q": prefix, "suggestions": suggestions})
+
+
 class SearchFailure(SearchMixin, LoginRequiredMixin, TemplateView):
     template_name = "app/search-failed.html"
     default_template = template_name
@@ -0,0 +1,7 @@
+"""Benchmarks that run the real pipelines against the fakes in ``poma.bench.fakes``.
+
+Run them as modules so the fake endpoints are configured before Django loads:
+
+    python -m poma.bench.ingestion
+    python -m poma.bench.search
+"""
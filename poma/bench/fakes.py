@@ -0,0 +1,522 @@
+"""In-process stand-ins for Vectara, OpenAI, Slack, Google Drive and Nango.
+
+A single threaded HTTP server answers the REST endpoints of every service and a
+gRPC server implements the vendored ``IndexService``/``AdminService`` protos.
+Both keep per-service call counters and can add latency and rate limits so
+ingestion and search can be measured without touching the real APIs.
+"""
+
+import itertools
+import json
+import logging
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import grpc
+
+import admin_pb2
+import common_pb2
+import services_pb2
+import services_pb2_grpc
+import status_pb2
+
+WORDS = (
+    "quarterly roadmap budget hiring onboarding release customer incident "
+    "postmortem design review meeting notes launch metrics pipeline search "
+    "index latency drive slack vendor contract invoice policy security "
+    "retention backlog sprint planning feedback survey revenue forecast"
+).split()
+
+
+def lorem(n_words: int, seed) -> str:
+    rng = random.Random(seed)
+    return " ".join(rng.choice(WORDS) for _ in range(n_words)).capitalize() + "."
+
+
+class RateLimiter:
+    """Token bucket shared by every request to one fake service."""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        if not self.rate:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class FakeServices:
+    """Fake Vectara, OpenAI, Slack, Drive and Nango backends.
+
+    Args:
+        latency: Seconds of added latency per service name, e.g. {"slack": 0.05}.
+        rate_limits: Requests per second allowed per service name.
+        files: Number of Drive files to list.
+        file_words: Words in every exported Drive file.
+        sheets: Number of Google Sheets listed after the files.
+        sheet_rows: Rows in every exported sheet.
+        channels: Number of Slack channels.
+        messages: Messages per Slack channel.
+        query_results: Results a query can page through.
+        page_size: Page size of every paginated listing.
+    """
+
+    def __init__(
+        self,
+        latency=None,
+        rate_limits=None,
+        files=50,
+        file_words=800,
+        sheets=0,
+        sheet_rows=1000,
+        channels=5,
+        messages=40,
+        query_results=20,
+        page_size=100,
+    ):
+        self.latency = latency or {}
+        self.limiters = {
+            name: RateLimiter(rate) for name, rate in (rate_limits or {}).items()
+        }
+        self.files = files
+        self.file_words = file_words
+        self.sheets = sheets
+        self.sheet_rows = sheet_rows
+        self.channels = channels
+        self.messages = messages
+        self.query_results = query_results
+        self.page_size = page_size
+        self.calls = Counter()
+        self.rate_limited = Counter()
+        self.corpus = {}  # document id -> list of section texts
+        self.corpus_lock = threading.Lock()
+        self._corpus_ids = itertools.count(1)
+        self.http = None
+        self.grpc = None
+
+    # -- lifecycle -------------------------------------------------------------
+
+    def start(self):
+        self.http = ThreadingHTTPServer(("127.0.0.1", 0), _handler(self))
+        self.http.daemon_threads = True
+        threading.Thread(target=self.http.serve_forever, daemon=True).start()
+
+        self.grpc = grpc.server(ThreadPoolExecutor(max_workers=32))
+        services_pb2_grpc.add_IndexServiceServicer_to_server(
+            FakeIndexService(self), self.grpc
+        )
+        services_pb2_grpc.add_AdminServiceServicer_to_server(
+            FakeAdminService(self), self.grpc
+        )
+        self.grpc_port = self.grpc.add_secure_port(
+            "127.0.0.1:0", grpc.local_server_credentials()
+        )
+        self.grpc.start()
+        return self
+
+    def stop(self):
+        if self.http is not None:
+            self.http.shutdown()
+        if self.grpc is not None:
+            self.grpc.stop(0)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.http.server_port}"
+
+    def env(self):
+        """Environment variables pointing the app at these fakes."""
+        grpc_address = f"127.0.0.1:{self.grpc_port}"
+        return {
+            "SEMANTIC_API_URL": self.url,
+            "SEMANTIC_REDIRECT_URI": self.url,
+            "SEMANTIC_INDEXING_ENDPOINT": grpc_address,
+            "SEMANTIC_SERVING_ENDPOINT": grpc_address,
+            "SEMANTIC_ADMIN_ENDPOINT": grpc_address,
+            "SEMANTIC_GRPC_LOCAL": "true",
+            "SEMANTIC_CUSTOMER_ID": "1",
+            "SEMANTIC_APP_ID": "bench",
+            "SEMANTIC_CLIENT_SECRET": "bench",
+            "SLACK_API_URL": f"{self.url}/api/",
+            "SLACK_CLIENT_ID": "bench",
+            "SLACK_CLIENT_SECRET": "bench",
+            "SLACK_SIGNING_SECRET": "bench",
+            "GOOGLE_DRIVE_API_URL": f"{self.url}/drive/v3/",
+            "GOOGLE_TOKEN_URI": f"{self.url}/token",
+            "NANGO_SERVER": f"{self.url}/",
+            "OPENAI_API_BASE": f"{self.url}/v1",
+            "OPENAI_API_KEY": "bench",
+        }
+
+    def snapshot(self):
+        return Counter(self.calls)
+
+    # -- bookkeeping -----------------------------------------------------------
+
+    def hit(self, service: str) -> bool:
+        """Count a call, apply latency and return False if it is rate limited."""
+        self.calls[service] += 1
+        limiter = self.limiters.get(service)
+        if limiter is not None and not limiter.allow():
+            self.rate_limited[service] += 1
+            return False
+        if delay := self.latency.get(service):
+            time.sleep(delay)
+        return True
+
+    def add_document(self, document_id, sections):
+        with self.corpus_lock:
+            self.corpus[document_id] = sections
+
+    # -- canned payloads -------------------------------------------------------
+
+    def drive_files(self, page_token):
+        start = int(page_token or 0)
+        total = self.files + self.sheets
+        end = min(start + self.page_size, total)
+        files = [
+            {
+                "id": f"file-{i}",
+                "name": f"Document {i}",
+                "mimeType": "application/vnd.google-apps.document",
+                "webViewLink": f"https://docs.google.com/document/d/file-{i}/edit",
+                "size": str(self.file_words * 6),
+                "modifiedTime": "2023-03-01T00:00:00.000Z",
+            }
+            if i < self.files
+            else {
+                "id": f"sheet-{i}",
+                "name": f"Sheet {i}",
+                "mimeType": "application/vnd.google-apps.spreadsheet",
+                "webViewLink": f"https://docs.google.com/spreadsheets/d/sheet-{i}/edit",
+                "modifiedTime": "2023-03-01T00:00:00.000Z",
+            }
+            for i in range(start, end)
+        ]
+        response = {"files": files}
+        if end < total:
+            response["nextPageToken"] = str(end)
+        return response
+
+    def drive_export(self, file_id):
+        return lorem(self.file_words, file_id).encode()
+
+    def drive_csv(self, file_id, chunk_rows=500):
+        """CSV export of a sheet, generated in chunks of bytes."""
+        rng = random.Random(file_id)
+        yield b"Owner,Quarter,Status,Notes\r\n"
+        for start in range(0, self.sheet_rows, chunk_rows):
+            rows = (
+                f'{rng.choice(WORDS)},Q{rng.randint(1, 4)},{rng.choice(WORDS)},'
+                f'"{lorem(12, f"{file_id}-{i}")}"\r\n'
+                for i in range(start, min(start + chunk_rows, self.sheet_rows))
+            )
+            yield "".join(rows).encode()
+
+    def slack(self, method, params):
+        if method == "auth.test":
+            return {"ok": True, "team": "Bench", "team_id": "TBENCH", "user_id": "UBOT"}
+        if method == "conversations.list":
+            start = int(params.get("cursor") or 0)
+            end = min(start + self.page_size, self.channels)
+            channels = [
+                {"id": f"C{i}", "name": f"channel-{i}"} for i in range(start, end)
+            ]
+            return {
+                "ok": True,
+                "channels": channels,
+                "response_metadata": {
+                    "next_cursor": str(end) if end < self.channels else ""
+                },
+            }
+        if method == "conversations.history":
+            start = int(params.get("cursor") or 0)
+            end = min(start + self.page_size, self.messages)
+            channel = params.get("channel", "")
+            messages = [
+                {
+                    "type": "message",
+                    "user": f"U{i % 7}",
+                    "text": lorem(30, f"{channel}-{i}"),
+                    "ts": f"{1670000000 + i}.000100",
+                }
+                for i in range(start, end)
+            ]
+            return {
+                "ok": True,
+                "messages": messages,
+                "response_metadata": {
+                    "next_cursor": str(end) if end < self.messages else ""
+                },
+            }
+        if method == "users.info":
+            user = params.get("user", "U0")
+            return {"ok": True, "user": {"id": user, "name": f"user-{user.lower()}"}}
+        if method == "chat.getPermalink":
+            channel, ts = params.get("channel", ""), params.get("message_ts", "")
+            return {
+                "ok": True,
+                "channel": channel,
+                "permalink": f"https://bench.slack.com/archives/{channel}/p{ts}",
+            }
+        return {"ok": False, "error": "unknown_method"}
+
+    def nango_connection(self, connection_id):
+        workspace_id = connection_id.rsplit("-", 1)[-1]
+        return {
+            "connection_id": connection_id,
+            "credentials": {
+                "type": "OAUTH2",
+                "access_token": f"xoxp-bench-{workspace_id}",
+                "raw": {
+                    "enterprise": None,
+                    "team": {"id": "TBENCH", "name": "Bench"},
+                    "authed_user": {"id": "UADMIN"},
+                },
+            },
+        }
+
+    def upload(self, filename):
+        document_id = f"{filename}-{uuid.uuid4().hex[:8]}"
+        words = lorem(self.file_words, filename).split()
+        sections = [" ".join(words[i : i + 80]) for i in range(0, len(words), 80)]
+        self.add_document(document_id, sections)
+        return {
+            "response": {
+                "status": {"code": "OK"},
+                "quotaConsumed": {
+                    "numChars": str(sum(len(s) for s in sections)),
+                    "numMetadataChars": "0",
+                },
+            },
+            "document": {
+                "documentId": document_id,
+                "section": [
+                    {"id": i + 1, "text": text} for i, text in enumerate(sections)
+                ],
+            },
+        }
+
+    def query(self, payload):
+        response_sets = []
+        with self.corpus_lock:
+            documents = list(self.corpus.items())
+        for request in payload.get("query", []):
+            rng = random.Random(request.get("query"))
+            start = request.get("start", 0)
+            sample = rng.sample(
+                documents, min(len(documents), start + request["numResults"])
+            )[start : min(start + request["numResults"], self.query_results)]
+            responses = []
+            for index, (document_id, sections) in enumerate(sample):
+                section = rng.randrange(len(sections)) if sections else 0
+                responses.append(
+                    {
+                        "text": sections[section] if sections else "",
+                        "score": round(1 - index / (len(sample) + 1), 4),
+                        "metadata": [
+                            {"name": "lang", "value": "eng"},
+                            {"name": "section", "value": str(section + 1)},
+                            {"name": "offset", "value": "0"},
+                            {"name": "len", "value": "500"},
+                        ],
+                        "documentIndex": index,
+                        "corpusKey": request["corpusKey"][0],
+                    }
+                )
+            response_sets.append(
+                {
+                    "response": responses,
+                    "status": [],
+                    "document": [
+                        {
+                            "id": document_id,
+                            "metadata": [{"name": "title", "value": ""}],
+                        }
+                        for document_id, _ in sample
+                    ],
+                }
+            )
+        return {
+            "responseSet": response_sets,
+            "status": [],
+            "metrics": {
+                "queryEncodeMs": 12,
+                "retrievalMs": 40,
+                "userdataRetrievalMs": 5,
+                "rerankMs": 0,
+            },
+        }
+
+
+class FakeIndexService(services_pb2_grpc.IndexServiceServicer):
+    def __init__(self, fakes: FakeServices):
+        self.fakes = fakes
+
+    def Index(self, request, context):
+        if not self.fakes.hit("vectara-grpc"):
+            context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, "rate limited")
+        document = request.document
+        self.fakes.add_document(
+            document.document_id, [s.text for s in document.section]
+        )
+        response = services_pb2.IndexDocumentResponse()
+        response.status.code = status_pb2.OK
+        response.quota_consumed.num_chars = sum(len(s.text) for s in document.section)
+        return response
+
+    def Delete(self, request, context):
+        self.fakes.hit("vectara-grpc")
+        with self.fakes.corpus_lock:
+            self.fakes.corpus.pop(request.document_id, None)
+        return common_pb2.DeleteDocumentResponse()
+
+
+class FakeAdminService(services_pb2_grpc.AdminServiceServicer):
+    def __init__(self, fakes: FakeServices):
+        self.fakes = fakes
+
+    def ResetCorpus(self, request, context):
+        self.fakes.hit("vectara-grpc")
+        with self.fakes.corpus_lock:
+            self.fakes.corpus.clear()
+        return admin_pb2.ResetCorpusResponse()
+
+
+def _handler(fakes: FakeServices):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            logging.debug("fake %s", format % args)
+
+        def _body(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            return self.rfile.read(length) if length else b""
+
+        def _send(self, status, body, content_type="application/json", headers=None):
+            if not isinstance(body, bytes):
+                body = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_chunked(self, chunks, content_type):
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for chunk in chunks:
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.write(b"0\r\n\r\n")
+
+        def _limited(self, service, body=None):
+            if fakes.hit(service):
+                return False
+            self._send(
+                429, body or {"error": "rate limited"}, headers={"Retry-After": "1"}
+            )
+            return True
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if match := re.fullmatch(r"/drive/v3/files/([^/]+)/export", url.path):
+                mimetype = parse_qs(url.query).get("mimeType", [""])[0]
+                if self._limited("drive"):
+                    return
+                if mimetype == "text/csv":
+                    self._send_chunked(fakes.drive_csv(match[1]), "text/csv")
+                else:
+                    self._send(200, fakes.drive_export(match[1]), "text/plain")
+            elif url.path == "/drive/v3/files":
+                if not self._limited("drive"):
+                    page_token = parse_qs(url.query).get("pageToken", [None])[0]
+                    self._send(200, fakes.drive_files(page_token))
+            elif match := re.fullmatch(r"/connection/([^/]+)", url.path):
+                if not self._limited("nango"):
+                    self._send(200, fakes.nango_connection(match[1]))
+            else:
+                self._send(404, {"error": "not found"})
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            body = self._body()
+            if url.path == "/oauth2/token":
+                if not self._limited("vectara-auth"):
+                    self._send(
+                        200,
+                        {
+                            "access_token": "bench",
+                            "token_type": "bearer",
+                            "expires_in": 3600,
+                        },
+                    )
+            elif url.path == "/token":
+                if not self._limited("google-auth"):
+                    self._send(
+                        200,
+                        {
+                            "access_token": "bench",
+                            "token_type": "Bearer",
+                            "expires_in": 3600,
+                        },
+                    )
+            elif url.path == "/v1/upload":
+                if not self._limited("vectara"):
+                    match = re.search(rb'filename="([^"]+)"', body)
+                    filename = match[1].decode() if match else "upload"
+                    self._send(200, fakes.upload(filename))
+            elif url.path == "/v1/query":
+                if not self._limited("vectara"):
+                    self._send(200, fakes.query(json.loads(body)))
+            elif url.path == "/v1/completions":
+                if not self._limited("openai"):
+                    self._send(
+                        200,
+                        {
+                            "object": "text_completion",
+                            "choices": [{"text": lorem(90, body), "index": 0}],
+                            "usage": {"total_tokens": 700},
+                        },
+                    )
+            elif url.path == "/v1/create-corpus":
+                if not self._limited("vectara"):
+                    corpus_id = next(fakes._corpus_ids)
+                    self._send(200, {"corpusId": corpus_id, "status": {"code": "OK"}})
+            elif url.path == "/v1/replace-corpus-filter-attrs":
+                if not self._limited("vectara"):
+                    self._send(200, {"status": {"code": "OK"}})
+            elif url.path.startswith("/api/"):
+                if self._limited("slack", {"ok": False, "error": "ratelimited"}):
+                    return
+                if self.headers.get("Content-Type", "").startswith("application/json"):
+                    params = json.loads(body or b"{}")
+                else:
+                    params = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+                params.update({k: v[0] for k, v in parse_qs(url.query).items()})
+                self._send(200, fakes.slack(url.path[len("/api/") :], params))
+            else:
+                self._send(404, {"error": "not found"})
+
+    return Handler
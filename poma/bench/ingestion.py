@@ -0,0 +1,146 @@
+"""End-to-end ingestion benchmark.
+
+Runs the ``app.tasks`` pipelines eagerly against the fakes and reports
+documents per second, fake API calls and DB queries per document and peak
+memory for every scenario, compared with ``baselines/ingestion.json``:
+
+    python -m poma.bench.ingestion --files 100 --latency slack=0.02
+"""
+
+import argparse
+import sys
+
+from poma.bench.fakes import FakeServices, lorem
+from poma.bench.runner import compare, measure, report, results_of, setup_django
+
+SCENARIOS = ["drive", "slack-history", "slack-events", "rebuild"]
+
+
+def _per_service(values):
+    parsed = {}
+    for value in values or []:
+        service, _, number = value.partition("=")
+        parsed[service] = float(number)
+    return parsed
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--files", type=int, default=50)
+    parser.add_argument("--file-words", type=int, default=800)
+    parser.add_argument("--channels", type=int, default=5)
+    parser.add_argument("--messages", type=int, default=40)
+    parser.add_argument(
+        "--latency",
+        nargs="*",
+        metavar="SERVICE=SECONDS",
+        help="Added latency, services: vectara, vectara-grpc, vectara-auth, google-auth, slack, drive, nango",
+    )
+    parser.add_argument(
+        "--rate-limit", nargs="*", metavar="SERVICE=RPS", help="Requests per second"
+    )
+    parser.add_argument("--scenarios", nargs="*", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--update-baseline", action="store_true")
+    return parser.parse_args(argv)
+
+
+def workspace_fixture():
+    from django.contrib.auth.models import User
+    from django.utils import timezone
+    from app.models import Workspace
+
+    owner = User.objects.create(username="bench", email="bench@example.com")
+    workspace = Workspace.objects.create(
+        owner=owner, name="Bench", description="Benchmark workspace", corpus_id=1
+    )
+    workspace.google_token = "bench"
+    workspace.google_refresh_token = "bench"
+    workspace.google_client_id = "bench"
+    workspace.google_client_secret = "bench"
+    workspace.google_scopes = str(["https://www.googleapis.com/auth/drive.readonly"])
+    workspace.google_active = timezone.now()
+    workspace.slack_workspace_id = "TBENCH"
+    workspace.slack_active = timezone.now()
+    workspace.save()
+    return workspace
+
+
+def run(args, fakes):
+    from app import tasks
+    from app.models import Document, SlackChannel
+
+    workspace = workspace_fixture()
+    measurements = []
+
+    def documents():
+        return Document.objects.filter(workspace=workspace).count()
+
+    if "drive" in args.scenarios:
+        before = documents()
+        with measure("drive", fakes) as m:
+            tasks.index_google(workspace.id)
+        m.documents = documents() - before
+        measurements.append(m)
+
+    if "slack-history" in args.scenarios:
+        before = documents()
+        with measure("slack-history", fakes) as m:
+            tasks.index_slack(workspace.id)
+            for channel in SlackChannel.objects.filter(workspace=workspace):
+                tasks.index_channel(channel.channel_id)
+        m.documents = documents() - before
+        measurements.append(m)
+
+    if "slack-events" in args.scenarios:
+        before = documents()
+        with measure("slack-events", fakes) as m:
+            for i in range(args.messages):
+                tasks.index_message(
+                    "C0",
+                    f"U{i % 7}",
+                    lorem(30, f"event-{i}"),
+                    f"{1680000000 + i}.000100",
+                    "TBENCH",
+                )
+        m.documents = documents() - before
+        measurements.append(m)
+
+    if "rebuild" in args.scenarios:
+        with measure("rebuild", fakes) as m:
+            tasks.rebuild_corpus(workspace.id, reset=True, restart=True)
+        m.documents = workspace.rebuilds.order_by("-id").first().documents_indexed
+        measurements.append(m)
+
+    return measurements
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    fakes = FakeServices(
+        latency=_per_service(args.latency),
+        rate_limits=_per_service(args.rate_limit),
+        files=args.files,
+        file_words=args.file_words,
+        channels=args.channels,
+        messages=args.messages,
+    ).start()
+    try:
+        setup_django(fakes.env())
+        measurements = run(args, fakes)
+    finally:
+        fakes.stop()
+
+    report(measurements)
+    if fakes.rate_limited:
+        print(f"Rate limited calls: {dict(fakes.rate_limited)}")
+    regressions = compare(
+        "ingestion", results_of(measurements), args.tolerance, args.update_baseline
+    )
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,146 @@
+"""Shared plumbing for the benchmarks: Django setup, measuring and baselines."""
+
+import json
+import os
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+
+BASELINES = Path(__file__).resolve().parent / "baselines"
+
+# metric -> True when a higher value is better
+METRICS = {
+    "docs_per_second": True,
+    "api_calls_per_doc": False,
+    "queries_per_doc": False,
+    "peak_memory_mb": False,
+}
+
+
+def setup_django(env, database=None):
+    """Point the app at the fakes, load Django and create a throwaway database.
+
+    Args:
+        env: Environment variables from ``FakeServices.env``.
+        database: Optional file for the test database, required when the
+            benchmark queries it from several threads.
+    """
+    os.environ.update(env)
+    os.environ.setdefault("SECRET_KEY", "bench")
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "poma.settings")
+    os.environ.setdefault("DJANGO_CONFIGURATION", "DEV")
+
+    import configurations
+
+    configurations.setup()
+
+    from django.db import connection
+    from poma.celery import app
+
+    if database is not None:
+        connection.settings_dict["TEST"]["NAME"] = database
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    app.conf.task_always_eager = True
+    app.conf.task_eager_propagates = True
+
+
+@dataclass
+class Measurement:
+    name: str
+    documents: int = 0
+    elapsed: float = 0.0
+    queries: int = 0
+    peak_memory: int = 0
+    calls: Counter = field(default_factory=Counter)
+
+    @property
+    def api_calls(self):
+        return sum(self.calls.values())
+
+    def metrics(self):
+        documents = max(self.documents, 1)
+        return {
+            "documents": self.documents,
+            "docs_per_second": (
+                round(self.documents / self.elapsed, 2) if self.elapsed else 0.0
+            ),
+            "api_calls_per_doc": round(self.api_calls / documents, 2),
+            "queries_per_doc": round(self.queries / documents, 2),
+            "peak_memory_mb": round(self.peak_memory / 2**20, 2),
+            "calls": dict(self.calls),
+        }
+
+
+@contextmanager
+def measure(name, fakes):
+    """Measure wall time, fake API calls, DB queries and peak Python memory."""
+    from django.db import connection
+
+    result = Measurement(name)
+
+    def count_queries(execute, sql, params, many, context):
+        result.queries += 1
+        return execute(sql, params, many, context)
+
+    before = fakes.snapshot()
+    tracemalloc.start()
+    started = time.monotonic()
+    try:
+        with connection.execute_wrapper(count_queries):
+            yield result
+    finally:
+        result.elapsed = time.monotonic() - started
+        result.peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        result.calls = fakes.snapshot() - before
+
+
+def report(measurements):
+    header = f"{'scenario':<16}{'docs':>8}{'docs/s':>10}{'calls/doc':>11}{'queries/doc':>13}{'peak MB':>10}"
+    print(header)
+    print("-" * len(header))
+    for measurement in measurements:
+        m = measurement.metrics()
+        print(
+            f"{measurement.name:<16}{m['documents']:>8}{m['docs_per_second']:>10}"
+            f"{m['api_calls_per_doc']:>11}{m['queries_per_doc']:>13}{m['peak_memory_mb']:>10}"
+        )
+
+
+def compare(name, results, tolerance, update=False):
+    """Compare results with the stored baseline and return the regressions.
+
+    Args:
+        name: Baseline file name, without extension.
+        results: Mapping of scenario name to its metrics.
+        tolerance: Allowed relative change before a metric counts as a regression.
+        update: Overwrite the baseline with these results instead.
+    """
+    path = BASELINES / f"{name}.json"
+    if update or not path.exists():
+        path.write_text(json.dumps(results, indent=2, sort_keys=True) + "\n")
+        print(f"Baseline written to {path}")
+        return []
+    baseline = json.loads(path.read_text())
+    regressions = []
+    for scenario, metrics in results.items():
+        for metric, higher_is_better in METRICS.items():
+            expected = baseline.get(scenario, {}).get(metric)
+            current = metrics.get(metric)
+            if not expected or current is None:
+                continue
+            change = (current - expected) / expected
+            if (higher_is_better and change < -tolerance) or (
+                not higher_is_better and change > tolerance
+            ):
+                regressions.append(
+                    f"{scenario}.{metric}: {expected} -> {current} ({change:+.0%})"
+                )
+    return regressions
+
+
+def results_of(measurements):
+    return {m.name: m.metrics() for m in measurements}
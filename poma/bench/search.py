@@ -0,0 +1,258 @@
+"""Search path load test.
+
+Drives the ``Search`` view in-process against the fake Vectara and OpenAI
+endpoints, either from a thread pool through the WSGI stack or as concurrent
+tasks through the ASGI handler daphne uses, and reports p50/p95/p99 latency,
+throughput and where the time of an average request went:
+
+    python -m poma.bench.search --requests 200 --concurrency 8 --latency vectara=0.15
+"""
+
+import argparse
+import asyncio
+import contextvars
+import random
+import statistics
+import sys
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from poma.bench.fakes import WORDS, FakeServices, lorem
+from poma.bench.runner import setup_django
+
+STAGES = ["token", "vectara", "db", "decrypt", "openai", "render"]
+
+# (timings, stack of child time of the open stages) of the current request
+_timings = contextvars.ContextVar("timings")
+
+
+def _timed(stage, function):
+    """Time calls to function as stage, excluding time spent in nested stages."""
+
+    def timed(*args, **kwargs):
+        state = _timings.get(None)
+        if state is None:
+            return function(*args, **kwargs)
+        timings, stack = state
+        stack.append(0.0)
+        started = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            timings[stage] += elapsed - stack.pop()
+            if stack:
+                stack[-1] += elapsed
+
+    return timed
+
+
+def _untimed(function):
+    """Run function outside the timings of the current request, so the work it
+    hands to background threads is not counted as the request's."""
+
+    def untimed(*args, **kwargs):
+        token = _timings.set(None)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _timings.reset(token)
+
+    return untimed
+
+
+def instrument():
+    """Wrap the functions behind every stage with timers."""
+    from django.db.backends.utils import CursorWrapper
+    from fernet_fields.fields import EncryptedField
+    from app import views
+    from poma.search import semantic, windows
+
+    semantic._get_jwt_token = _timed("token", semantic._get_jwt_token)
+    semantic.batch_query = _timed("vectara", semantic.batch_query)
+    CursorWrapper.execute = _timed("db", CursorWrapper.execute)
+    CursorWrapper.executemany = _timed("db", CursorWrapper.executemany)
+    EncryptedField.from_db_value = _timed("decrypt", EncryptedField.from_db_value)
+    views.anwser = _timed("openai", views.anwser)
+    views.render = _timed("render", views.render)
+    # Prefetches run in threads bound to the request's context, their Vectara
+    # calls overlap the request and would be counted twice
+    windows.prefetch = _untimed(windows.prefetch)
+
+
+def reset_cache():
+    """Wait for the prefetches in flight and empty the cache, so each mode
+    starts cold rather than on the windows the previous mode fetched."""
+    from django.core.cache import cache
+    from poma.search import windows
+
+    while windows._inflight:
+        time.sleep(0.01)
+    cache.clear()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--mode", choices=["threads", "asgi"], nargs="*", default=["threads", "asgi"]
+    )
+    parser.add_argument("--gpt", type=float, default=0.2, help="Share of GPT searches")
+    parser.add_argument("--documents", type=int, default=500)
+    parser.add_argument("--sections", type=int, default=8)
+    parser.add_argument("--results", type=int, default=20)
+    parser.add_argument(
+        "--latency",
+        nargs="*",
+        metavar="SERVICE=SECONDS",
+        default=["vectara=0.12", "vectara-auth=0.05", "openai=0.8"],
+    )
+    return parser.parse_args(argv)
+
+
+def fixture(args, fakes):
+    from django.contrib.auth.models import User
+    from app.models import Document, Profile, Section, Workspace
+
+    owner = User.objects.create(username="bench", email="bench@example.com")
+    workspace = Workspace.objects.create(
+        owner=owner, name="Bench", description="Benchmark workspace", corpus_id=1
+    )
+    Profile.objects.create(user=owner, current_workspace=workspace)
+    for i in range(args.documents):
+        identifier = f"doc-{i}"
+        texts = [lorem(80, f"{identifier}-{s}") for s in range(args.sections)]
+        document = Document.objects.create(
+            workspace=workspace,
+            link=f"https://docs.google.com/document/d/{identifier}/edit",
+            title=f"Document {i}",
+            identifier=identifier,
+            size=sum(len(t) for t in texts),
+        )
+        Section.objects.bulk_create(
+            Section(
+                document=document,
+                section_id=s + 1,
+                word_count=len(text.split()),
+                text=text,
+            )
+            for s, text in enumerate(texts)
+        )
+        fakes.add_document(identifier, texts)
+    return owner
+
+
+def _urls(args):
+    from django.urls import reverse
+
+    rng = random.Random(0)
+    urls = []
+    for _ in range(args.requests):
+        url = f"{reverse('search')}?q={'+'.join(rng.sample(WORDS, 3))}"
+        if rng.random() < args.gpt:
+            url += "&gpt=true"
+        urls.append(url)
+    return urls
+
+
+def run_threads(args, user):
+    from django.db import connection
+    from django.test import Client
+
+    def search(url):
+        client = Client()
+        client.force_login(user)
+        timings = Counter()
+        _timings.set((timings, []))
+        started = time.perf_counter()
+        response = client.get(url)
+        assert response.status_code == 200, response.status_code
+        connection.close()
+        return time.perf_counter() - started, timings
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        started = time.perf_counter()
+        results = list(executor.map(search, _urls(args)))
+    return results, time.perf_counter() - started
+
+
+def run_asgi(args, user):
+    from django.db import connection
+    from django.test import AsyncClient
+
+    client = AsyncClient()
+    client.force_login(user)
+    connection.close()
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def search(url):
+        async with semaphore:
+            timings = Counter()
+            _timings.set((timings, []))
+            started = time.perf_counter()
+            response = await client.get(url)
+            assert response.status_code == 200, response.status_code
+            return time.perf_counter() - started, timings
+
+    async def main():
+        return await asyncio.gather(*(search(url) for url in _urls(args)))
+
+    started = time.perf_counter()
+    results = asyncio.run(main())
+    return results, time.perf_counter() - started
+
+
+def report(mode, results, elapsed):
+    latencies = sorted(latency for latency, _ in results)
+    # quantiles() needs two samples, a single one is every percentile
+    if len(latencies) > 1:
+        cuts = statistics.quantiles(latencies, n=100)
+    else:
+        cuts = latencies * 99
+    total = Counter()
+    for _, timings in results:
+        total.update(timings)
+    mean = statistics.mean(latencies)
+    print(f"\n[{mode}] {len(results)} requests in {elapsed:.2f}s")
+    print(
+        f"throughput {len(results) / elapsed:.1f} req/s  "
+        f"p50 {cuts[49] * 1000:.0f}ms  p95 {cuts[94] * 1000:.0f}ms  "
+        f"p99 {cuts[98] * 1000:.0f}ms"
+    )
+    print(f"{'stage':<10}{'mean ms':>10}{'share':>8}")
+    accounted = 0.0
+    for stage in STAGES:
+        stage_mean = total[stage] / len(results)
+        accounted += stage_mean
+        print(f"{stage:<10}{stage_mean * 1000:>10.1f}{stage_mean / mean:>8.0%}")
+    other = mean - accounted
+    print(f"{'other':<10}{other * 1000:>10.1f}{other / mean:>8.0%}")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    latency = {}
+    for value in args.latency or []:
+        service, _, seconds = value.partition("=")
+        latency[service] = float(seconds)
+    fakes = FakeServices(latency=latency, query_results=args.results).start()
+    try:
+        with tempfile.NamedTemporaryFile(suffix=".sqlite3") as database:
+            setup_django(fakes.env(), database=database.name)
+            user = fixture(args, fakes)
+            instrument()
+            for mode in args.mode:
+                reset_cache()
+                runner = run_threads if mode == "threads" else run_asgi
+                results, elapsed = runner(args, user)
+                report(mode, results, elapsed)
+    finally:
+        fakes.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
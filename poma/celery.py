@@ -18,5 +18,16 @@ app = Celery("poma")
 #   should have a `CELERY_` prefix.
 app.config_from_object("django.conf:settings", namespace="CELERY")
 
+# Run by `celery -A poma beat`, the spool sweep drains what lost its drain.
+app.conf.beat_schedule = {
+    "sweep-spools": {
+        "task": "poma.spool.sweep",
+        "schedule": float(os.getenv("SPOOL_SWEEP_SECONDS", 60)),
+    },
+}
+
 # Load task modules from all registered Django apps.
 app.autodiscover_tasks()
+
+# Connects the task metrics and trace propagation signal handlers.
+from poma import metrics, tracing  # noqa: E402
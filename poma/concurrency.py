@@ -0,0 +1,178 @@
+"""Adaptive concurrency limits for Vectara ingestion calls, shared in Redis.
+
+Every worker takes a slot in a Redis sorted set before calling Vectara and
+waits while the set holds as many slots as the current limit. Latencies and
+overload errors (429, 5xx, ``RESOURCE_EXHAUSTED``...) are added up per
+``AIMD_WINDOW_SECONDS`` window, and the first call of the next window adjusts
+the limit: it grows by ``AIMD_INCREASE`` after a healthy window and is
+multiplied by ``AIMD_BACKOFF`` when more than ``AIMD_ERROR_RATE`` of the calls
+were overloaded or their mean latency exceeded ``AIMD_LATENCY_TOLERANCE``
+times the baseline, a moving average pulled down to the fastest windows.
+
+Slots of crashed workers expire after ``AIMD_SLOT_TIMEOUT``. When Redis is
+unreachable calls are not limited, which is logged once per process.
+"""
+from contextlib import contextmanager
+import logging
+import os
+import random
+import time
+import uuid
+
+import redis
+
+from poma import metrics
+from poma.idempotency import get_redis
+
+AIMD_INITIAL = float(os.getenv("AIMD_INITIAL", 8))
+AIMD_MIN = float(os.getenv("AIMD_MIN", 1))
+AIMD_MAX = float(os.getenv("AIMD_MAX", 64))
+AIMD_INCREASE = float(os.getenv("AIMD_INCREASE", 1))
+AIMD_BACKOFF = float(os.getenv("AIMD_BACKOFF", 0.5))
+AIMD_ERROR_RATE = float(os.getenv("AIMD_ERROR_RATE", 0.05))
+AIMD_LATENCY_TOLERANCE = float(os.getenv("AIMD_LATENCY_TOLERANCE", 2))
+AIMD_WINDOW_SECONDS = int(os.getenv("AIMD_WINDOW_SECONDS", 5))
+AIMD_MIN_SAMPLES = int(os.getenv("AIMD_MIN_SAMPLES", 10))
+AIMD_ACQUIRE_TIMEOUT = float(os.getenv("AIMD_ACQUIRE_TIMEOUT", 60))
+AIMD_SLOT_TIMEOUT = int(os.getenv("AIMD_SLOT_TIMEOUT", 5 * 60))
+PREFIX = "poma:aimd"
+POLL_SECONDS = 0.05
+BASELINE_WEIGHT = 0.1
+
+logger = logging.getLogger(__name__)
+
+_warned = False
+
+
+class Saturated(Exception):
+    """No slot freed up within ``AIMD_ACQUIRE_TIMEOUT`` seconds."""
+
+
+class Slot:
+    """A call in flight, mark it ``overloaded`` when the service pushed back."""
+
+    def __init__(self, name: str, token):
+        self.name = name
+        self.token = token
+        self.overloaded = False
+
+
+def _key(name, *parts):
+    return ":".join([PREFIX, name, *(str(part) for part in parts)])
+
+
+def _window(name, now):
+    return _key(name, "window", int(now // AIMD_WINDOW_SECONDS))
+
+
+def _unlimited(name: str, error: redis.RedisError):
+    """Log the first Redis error of the process, later calls fall back
+    silently."""
+    global _warned
+    if _warned:
+        return
+    _warned = True
+    logger.warning("Calling %s without concurrency limit: %s", name, error)
+
+
+def current_limit(name: str) -> float:
+    try:
+        value = get_redis().get(_key(name, "limit"))
+    except redis.RedisError:
+        return AIMD_INITIAL
+    return AIMD_INITIAL if value is None else float(value)
+
+
+def acquire(name: str):
+    """Wait for a slot, returns its token or None when Redis is unreachable."""
+    token = uuid.uuid4().hex
+    inflight = _key(name, "inflight")
+    deadline = time.monotonic() + AIMD_ACQUIRE_TIMEOUT
+    delay = POLL_SECONDS
+    try:
+        redis_client = get_redis()
+        while True:
+            now = time.time()
+            pipeline = redis_client.pipeline()
+            pipeline.zremrangebyscore(inflight, 0, now - AIMD_SLOT_TIMEOUT)
+            pipeline.zadd(inflight, {token: now})
+            pipeline.zcard(inflight)
+            pipeline.get(_key(name, "limit"))
+            *_, count, limit = pipeline.execute()
+            if count <= max(int(float(limit or AIMD_INITIAL)), 1):
+                return token
+            redis_client.zrem(inflight, token)
+            if time.monotonic() > deadline:
+                raise Saturated(f"{name}: {count - 1} calls in flight")
+            time.sleep(random.uniform(0, delay))
+            delay = min(delay * 2, 1)
+    except redis.RedisError as error:
+        _unlimited(name, error)
+        return None
+
+
+def release(slot: Slot, seconds: float):
+    """Free the slot and count the call in the current window. The first call
+    of a window adjusts the limit from the totals of the previous one."""
+    now = time.time()
+    window = _window(slot.name, now)
+    previous = _window(slot.name, now - AIMD_WINDOW_SECONDS)
+    try:
+        pipeline = get_redis().pipeline()
+        if slot.token is not None:
+            pipeline.zrem(_key(slot.name, "inflight"), slot.token)
+        pipeline.hincrby(window, "calls", 1)
+        pipeline.hincrby(window, "overloaded", int(slot.overloaded))
+        pipeline.hincrbyfloat(window, "seconds", seconds)
+        pipeline.expire(window, AIMD_WINDOW_SECONDS * 3)
+        pipeline.set(f"{previous}:adjusted", 1, nx=True, ex=AIMD_WINDOW_SECONDS * 3)
+        *_, adjusting = pipeline.execute()
+        if adjusting:
+            _adjust(slot.name, previous)
+    except redis.RedisError as error:
+        _unlimited(slot.name, error)
+
+
+def _adjust(name: str, window: str):
+    redis_client = get_redis()
+    totals = redis_client.hgetall(window)
+    calls = int(totals.get(b"calls", 0))
+    if calls < AIMD_MIN_SAMPLES:
+        return
+    error_rate = int(totals.get(b"overloaded", 0)) / calls
+    latency = float(totals.get(b"seconds", 0)) / calls
+    limit_key, baseline_key = _key(name, "limit"), _key(name, "baseline")
+    limit, baseline = redis_client.mget(limit_key, baseline_key)
+    limit = AIMD_INITIAL if limit is None else float(limit)
+    baseline = latency if baseline is None else float(baseline)
+    if error_rate > AIMD_ERROR_RATE or latency > AIMD_LATENCY_TOLERANCE * baseline:
+        limit = max(AIMD_MIN, limit * AIMD_BACKOFF)
+    else:
+        limit = min(AIMD_MAX, limit + AIMD_INCREASE)
+    # Drops to faster windows at once, follows slower ones gradually
+    baseline = min(latency, baseline + BASELINE_WEIGHT * (latency - baseline))
+    redis_client.mset({limit_key: limit, baseline_key: baseline})
+    metrics.vectara_concurrency_limit.labels(name).set(limit)
+    logger.info(
+        "%s limit %.1f (%.0f%% overloaded, %.2fs mean, %.2fs baseline)",
+        name,
+        limit,
+        error_rate * 100,
+        latency,
+        baseline,
+    )
+
+
+@contextmanager
+def limited(name: str):
+    """Run the block in a slot of the name's limit. Exceptions count as
+    overload, set ``slot.overloaded`` for errors returned as values."""
+    slot = Slot(name, acquire(name))
+    started = time.monotonic()
+    try:
+        yield slot
+    except Exception:
+        slot.overloaded = True
+        raise
+    finally:
+        release(slot, time.monotonic() - started)
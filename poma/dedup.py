@@ -0,0 +1,155 @@
+"""Near-duplicate detection of ingested documents with MinHash and LSH.
+
+Every indexed document keeps a MinHash signature of its word shingles, and the
+signature's bands are stored as ``LshBucket`` rows of its workspace. A new
+document looks up the documents sharing a band with it, and if the signatures
+of one agree on at least ``DEDUP_THRESHOLD`` of their hashes it is recorded as
+an alias of that document instead of being sent to Vectara again.
+
+Texts shorter than ``DEDUP_MIN_WORDS`` are always indexed, short Slack replies
+("thanks!", "+1") are identical without being copies.
+"""
+import hashlib
+import io
+import os
+import re
+from typing import Optional
+import zipfile
+import zlib
+from xml.etree import ElementTree
+
+import numpy as np
+
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", 0.85))
+DEDUP_MIN_WORDS = int(os.getenv("DEDUP_MIN_WORDS", 12))
+SHINGLE_WORDS = 3
+# 16 bands of 8 rows catch pairs above ~0.7 similarity
+BANDS = 16
+ROWS = 8
+PERMUTATIONS = BANDS * ROWS
+PRIME = (1 << 31) - 1
+
+# Fixed seed, signatures are persisted and compared across processes
+_rng = np.random.RandomState(20230301)
+_a = _rng.randint(1, PRIME, PERMUTATIONS).astype(np.uint64)
+_b = _rng.randint(0, PRIME, PERMUTATIONS).astype(np.uint64)
+_words = re.compile(r"\w+")
+
+OFFICE_TEXT = {
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document": (
+        re.compile(r"word/document\.xml"),
+        "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}t",
+    ),
+    "application/vnd.openxmlformats-officedocument.presentationml.presentation": (
+        re.compile(r"ppt/slides/slide\d+\.xml"),
+        "{http://schemas.openxmlformats.org/drawingml/2006/main}t",
+    ),
+}
+
+
+def signature(text: str) -> Optional[np.ndarray]:
+    """MinHash signature of text, None when it is too short to deduplicate."""
+    words = _words.findall(text.lower())
+    if len(words) < DEDUP_MIN_WORDS:
+        return None
+    shingles = {
+        " ".join(words[i : i + SHINGLE_WORDS])
+        for i in range(len(words) - SHINGLE_WORDS + 1)
+    }
+    hashes = np.fromiter(
+        (zlib.crc32(shingle.encode()) % PRIME for shingle in shingles),
+        dtype=np.uint64,
+        count=len(shingles),
+    )
+    permuted = (hashes[:, None] * _a + _b) % PRIME
+    return permuted.min(axis=0).astype(np.uint32)
+
+
+def band_keys(sig: np.ndarray):
+    """One signed 64 bit key per band of the signature."""
+    return [
+        int.from_bytes(
+            hashlib.blake2b(
+                bytes([band]) + sig[band * ROWS : (band + 1) * ROWS].tobytes(),
+                digest_size=8,
+            ).digest(),
+            "big",
+            signed=True,
+        )
+        for band in range(BANDS)
+    ]
+
+
+def similarity(a: np.ndarray, b: np.ndarray) -> float:
+    """Estimated Jaccard similarity of the shingles behind two signatures."""
+    return float(np.count_nonzero(a == b)) / PERMUTATIONS
+
+
+def find_duplicate(workspace_id: int, sig: Optional[np.ndarray], file_id: str = ""):
+    """Returns the indexed Document sig nearly duplicates, if any, with only its
+    id and identifier loaded. The versions of the Drive file file_id are left
+    out, an edited file is not a copy of its previous version."""
+    from app.models import Document
+
+    if sig is None:
+        return None
+    candidates = (
+        Document.objects.filter(
+            lsh_buckets__workspace_id=workspace_id,
+            lsh_buckets__key__in=band_keys(sig),
+            canonical=None,
+        )
+        .only("id", "identifier", "signature")
+        .distinct()
+    )
+    if file_id:
+        candidates = candidates.exclude(file_id=file_id)
+    best, best_similarity = None, DEDUP_THRESHOLD
+    for document in candidates:
+        if document.signature is None:
+            continue
+        score = similarity(sig, unpack(document.signature))
+        if score >= best_similarity:
+            best, best_similarity = document, score
+    return best
+
+
+def pack(sig: Optional[np.ndarray]) -> Optional[bytes]:
+    """Signature as stored in ``Document.signature``."""
+    return None if sig is None else sig.tobytes()
+
+
+def unpack(data: bytes) -> np.ndarray:
+    return np.frombuffer(data, dtype=np.uint32)
+
+
+def remember(document):
+    """Store the LSH buckets of an indexed document with a signature."""
+    from app.models import LshBucket
+
+    if document.signature is None:
+        return
+    LshBucket.objects.bulk_create(
+        LshBucket(workspace_id=document.workspace_id, key=key, document=document)
+        for key in band_keys(unpack(document.signature))
+    )
+
+
+def office_text(fh: io.BytesIO, mimetype: str) -> str:
+    """Text of a .docx or .pptx file, empty for other types or broken files.
+    The file is rewound for the upload that follows."""
+    if mimetype not in OFFICE_TEXT:
+        return ""
+    parts, tag = OFFICE_TEXT[mimetype]
+    texts = []
+    try:
+        with zipfile.ZipFile(fh) as archive:
+            for name in sorted(archive.namelist()):
+                if parts.fullmatch(name):
+                    root = ElementTree.fromstring(archive.read(name))
+                    texts.extend(element.text or "" for element in root.iter(tag))
+    except (zipfile.BadZipFile, ElementTree.ParseError):
+        return ""
+    finally:
+        fh.seek(0)
+    return " ".join(texts)
@@ -0,0 +1,73 @@
+"""Drop duplicate deliveries of ingestion events.
+
+Every event is claimed with a ``SET NX EX`` in Redis before any work starts,
+a key that already exists means the event was seen within ``IDEMPOTENCY_TTL``
+seconds. Work that fails releases its key so a retry can run again. When Redis
+is unreachable events are let through rather than lost.
+
+Versioned items (Drive files) keep one key per item holding the last version
+claimed instead, without expiry: a version is skipped for as long as it is
+the current one, however old, and keys do not pile up with every edit.
+"""
+from functools import lru_cache
+import logging
+import os
+
+import redis
+
+REDIS_URL = os.getenv(
+    "REDIS_URL", os.getenv("CELERY_BROKER_URL", "redis://localhost:6379/0")
+)
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", 24 * 60 * 60))
+KEY_PREFIX = "poma:seen"
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache
+def get_redis():
+    return redis.Redis.from_url(REDIS_URL, socket_timeout=1, socket_connect_timeout=1)
+
+
+def _key(parts):
+    return ":".join([KEY_PREFIX, *(str(part) for part in parts)])
+
+
+def claim(*parts, ttl: int = IDEMPOTENCY_TTL) -> bool:
+    """Return True the first time the key made of parts is seen."""
+    try:
+        return bool(get_redis().set(_key(parts), 1, nx=True, ex=ttl))
+    except redis.RedisError as error:
+        logger.warning("Idempotency check skipped for %s: %s", _key(parts), error)
+        return True
+
+
+def claim_version(*parts, version) -> bool:
+    """Return True unless version is the last one claimed for the key made of
+    parts, and make it the last one."""
+    try:
+        previous = get_redis().set(_key(parts), str(version), get=True)
+    except redis.RedisError as error:
+        logger.warning("Idempotency check skipped for %s: %s", _key(parts), error)
+        return True
+    return previous is None or previous.decode() != str(version)
+
+
+def release(*parts):
+    """Forget a claim so the event is processed again when redelivered."""
+    try:
+        get_redis().delete(_key(parts))
+    except redis.RedisError as error:
+        logger.warning("Could not release %s: %s", _key(parts), error)
+
+
+def slack_event(team, channel, ts, event_id):
+    return ("slack-event", team, channel, ts, event_id)
+
+
+def slack_message(team, channel, ts):
+    return ("slack", team, channel, ts)
+
+
+def drive_file(workspace_id, file_id):
+    return ("drive-file", workspace_id, file_id)
@@ -0,0 +1,125 @@
+"""Progress of ingestion jobs, counted in Redis and saved periodically.
+
+Workers add to the counters of a job in a Redis hash, and at most every
+``JOB_FLUSH_SECONDS`` one of them copies the totals to its ``IngestionJob``
+row. The progress panel reads the live totals from Redis. A job is finished
+once all its items were enqueued and as many were processed. While Redis is
+unreachable the counters are added to the row directly.
+"""
+import logging
+import os
+
+import redis
+from django.db.models import F
+from django.utils import timezone
+
+from poma.idempotency import get_redis
+
+JOB_FLUSH_SECONDS = int(os.getenv("JOB_FLUSH_SECONDS", 5))
+JOB_TTL = int(os.getenv("JOB_TTL", 7 * 24 * 60 * 60))
+COUNTERS = ("enqueued", "succeeded", "failed", "skipped", "bytes")
+
+logger = logging.getLogger(__name__)
+
+
+def _key(job_id):
+    return f"poma:job:{job_id}"
+
+
+def start(workspace, source: str):
+    from app.models import IngestionJob
+
+    return IngestionJob.objects.create(workspace=workspace, source=source)
+
+
+def _totals(values: dict):
+    return {
+        name.decode(): int(value)
+        for name, value in values.items()
+        if name.decode() in COUNTERS + ("listed",)
+    }
+
+
+def _done(totals: dict):
+    processed = sum(totals.get(name, 0) for name in ("succeeded", "failed", "skipped"))
+    return bool(totals.get("listed")) and processed >= totals.get("enqueued", 0)
+
+
+def _save(job_id, totals: dict, **fields):
+    from app.models import IngestionJob
+
+    counters = {name: totals[name] for name in COUNTERS if name in totals}
+    if _done(totals):
+        fields["finished_at"] = timezone.now()
+    IngestionJob.objects.filter(pk=job_id).update(
+        updated_at=timezone.now(), **counters, **fields
+    )
+
+
+def _finish_in_db(job_id):
+    from app.models import IngestionJob
+
+    IngestionJob.objects.filter(
+        pk=job_id,
+        finished_at=None,
+        listed=True,
+        enqueued__lte=F("succeeded") + F("failed") + F("skipped"),
+    ).update(finished_at=timezone.now())
+
+
+def incr(job_id, **amounts):
+    """Add amounts to the counters of a job, e.g. incr(job.id, succeeded=1)."""
+    from app.models import IngestionJob
+
+    amounts = {name: amount for name, amount in amounts.items() if amount}
+    if job_id is None or not amounts:
+        return
+    key = _key(job_id)
+    try:
+        pipeline = get_redis().pipeline()
+        for name, amount in amounts.items():
+            pipeline.hincrby(key, name, amount)
+        pipeline.expire(key, JOB_TTL)
+        pipeline.set(f"{key}:flushed", 1, nx=True, ex=JOB_FLUSH_SECONDS)
+        pipeline.hgetall(key)
+        *_, due, values = pipeline.execute()
+    except redis.RedisError as error:
+        logger.warning("Counting job %s in the database: %s", job_id, error)
+        IngestionJob.objects.filter(pk=job_id).update(
+            updated_at=timezone.now(),
+            **{name: F(name) + amount for name, amount in amounts.items()},
+        )
+        _finish_in_db(job_id)
+        return
+    totals = _totals(values)
+    if due or _done(totals):
+        _save(job_id, totals)
+
+
+def finish_listing(job_id):
+    """Record that every item of the job was enqueued."""
+    try:
+        redis_client = get_redis()
+        redis_client.hset(_key(job_id), "listed", 1)
+        totals = _totals(redis_client.hgetall(_key(job_id)))
+    except redis.RedisError as error:
+        logger.warning("Finishing job %s in the database: %s", job_id, error)
+        from app.models import IngestionJob
+
+        IngestionJob.objects.filter(pk=job_id).update(listed=True)
+        _finish_in_db(job_id)
+        return
+    _save(job_id, totals, listed=True)
+
+
+def live(job):
+    """The job with its counters updated from Redis, without saving it."""
+    if job.finished_at is not None:
+        return job
+    try:
+        totals = _totals(get_redis().hgetall(_key(job.id)))
+    except redis.RedisError:
+        return job
+    for name, value in totals.items():
+        setattr(job, name, bool(value) if name == "listed" else value)
+    return job
@@ -0,0 +1,195 @@
+"""Prometheus metrics for the search and ingestion pipelines.
+
+Django serves them from ``/metrics`` and celery workers from
+``CELERY_METRICS_PORT``. Set ``PROMETHEUS_MULTIPROC_DIR`` when running more
+than one process (prefork workers, several daphne processes) so every
+process' samples are aggregated.
+"""
+import logging
+import os
+import time
+
+from celery import signals
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+    start_http_server,
+)
+
+CELERY_METRICS_PORT = int(os.getenv("CELERY_METRICS_PORT", 9808))
+MULTIPROCESS = bool(os.getenv("PROMETHEUS_MULTIPROC_DIR"))
+
+# Server side timings Vectara reports in BatchQueryResponse.metrics
+VECTARA_STAGES = {
+    "queryEncodeMs": "query_encode",
+    "retrievalMs": "retrieval",
+    "userdataRetrievalMs": "userdata_retrieval",
+    "rerankMs": "rerank",
+}
+
+vectara_server_seconds = Histogram(
+    "poma_vectara_server_seconds",
+    "Time Vectara reports spending on each stage of a query",
+    ["stage"],
+)
+vectara_token_seconds = Histogram(
+    "poma_vectara_token_fetch_seconds", "Time fetching a Vectara JWT token"
+)
+vectara_query_seconds = Histogram(
+    "poma_vectara_query_seconds", "Round trip of a Vectara query", ["status"]
+)
+vectara_query_rejected = Counter(
+    "poma_vectara_query_rejected_total",
+    "Queries not sent to Vectara because the circuit breaker was open",
+)
+vectara_queries_hedged = Counter(
+    "poma_vectara_queries_hedged_total",
+    "Queries sent a second time because the first was slower than usual",
+)
+search_degraded = Counter(
+    "poma_search_degraded_total",
+    "Search windows served without Vectara",
+    ["mode"],
+)
+search_hydration_seconds = Histogram(
+    "poma_search_hydration_seconds", "Time loading documents for search results"
+)
+openai_seconds = Histogram(
+    "poma_openai_completion_seconds",
+    "Time waiting for an OpenAI completion",
+    buckets=(0.25, 0.5, 1, 2, 3, 5, 8, 13, 21, float("inf")),
+)
+task_seconds = Histogram(
+    "poma_task_seconds",
+    "Celery task run time",
+    ["task", "state"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, float("inf")),
+)
+task_queue_seconds = Histogram(
+    "poma_task_queue_wait_seconds",
+    "Time celery tasks waited in the queue before starting",
+    ["task"],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 15, 60, 300, 900, float("inf")),
+)
+documents_indexed = Counter(
+    "poma_documents_indexed_total", "Documents indexed", ["source"]
+)
+documents_deduplicated = Counter(
+    "poma_documents_deduplicated_total",
+    "Near-duplicate documents stored as aliases instead of indexed",
+    ["source"],
+)
+vectara_concurrency_limit = Gauge(
+    "poma_vectara_concurrency_limit",
+    "Adaptive limit of concurrent Vectara ingestion calls",
+    ["call"],
+)
+tasks_dead_lettered = Counter(
+    "poma_tasks_dead_lettered_total",
+    "Indexing tasks stored as failed after a permanent error or their last retry",
+    ["task"],
+)
+slack_event_lag_seconds = Histogram(
+    "poma_slack_event_lag_seconds",
+    "Time from a Slack event to its dispatch to celery",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float("inf")),
+)
+slack_queue_depth = Gauge(
+    "poma_slack_queue_depth", "Slack events waiting to be dispatched"
+)
+slack_events_deferred = Counter(
+    "poma_slack_events_deferred_total",
+    "Slack events left unacknowledged for Slack to redeliver, the queue being full",
+)
+
+
+class timer:
+    """Context manager observing the elapsed seconds on a histogram."""
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed = time.perf_counter() - self.started
+        self.histogram.observe(self.elapsed)
+
+
+def observe_vectara_metrics(data: dict):
+    """Record the PerformanceMetrics of a REST query response."""
+    for key, stage in VECTARA_STAGES.items():
+        value = data.get("metrics", {}).get(key)
+        if value is not None:
+            vectara_server_seconds.labels(stage).observe(int(value) / 1000)
+
+
+def _registry():
+    if not MULTIPROCESS:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def metrics_view(request):
+    token = getattr(settings, "METRICS_TOKEN", None)
+    if not token:
+        # Without a token the endpoint is only open in development
+        if not settings.DEBUG:
+            return HttpResponseForbidden()
+    elif request.headers.get("Authorization") != f"Bearer {token}":
+        return HttpResponseForbidden()
+    return HttpResponse(generate_latest(_registry()), content_type=CONTENT_TYPE_LATEST)
+
+
+# -- celery ---------------------------------------------------------------------
+
+_started = {}
+
+
+@signals.before_task_publish.connect
+def _stamp_publish_time(headers=None, **kwargs):
+    if headers is not None:
+        headers["published_at"] = time.time()
+
+
+@signals.task_prerun.connect
+def _task_started(task_id=None, task=None, **kwargs):
+    _started[task_id] = time.perf_counter()
+    published_at = getattr(task.request, "published_at", None)
+    if published_at:
+        task_queue_seconds.labels(task.name).observe(
+            max(time.time() - float(published_at), 0)
+        )
+
+
+@signals.task_postrun.connect
+def _task_finished(task_id=None, task=None, state=None, **kwargs):
+    started = _started.pop(task_id, None)
+    if started is not None:
+        task_seconds.labels(task.name, state or "UNKNOWN").observe(
+            time.perf_counter() - started
+        )
+
+
+@signals.worker_init.connect
+def _serve_worker_metrics(**kwargs):
+    start_http_server(CELERY_METRICS_PORT, registry=_registry())
+    logging.info("Serving celery metrics on :%s", CELERY_METRICS_PORT)
+
+
+@signals.worker_process_shutdown.connect
+def _mark_process_dead(pid=None, **kwargs):
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(pid or os.getpid())
@@ -0,0 +1,144 @@
+"""Retries and dead letters of the document indexing tasks.
+
+Failures are classified as retryable (Vectara or Drive overloaded or
+unreachable, timeouts, rate limits) or permanent (rejected documents, missing
+files...), whether they are raised or reported in the status of an Index
+response. Retryable failures are retried by celery up to
+``TASK_MAX_RETRIES`` times, ``TASK_RETRY_BACKOFF * 2 ** retries`` seconds
+apart at most with full jitter. Tasks failing for good, permanently or out of
+retries, are stored as ``FailedTask`` rows with their error and arguments, and
+``manage.py replay_failed_tasks`` sends them again.
+"""
+import inspect
+import json
+import logging
+import os
+import socket
+
+from celery import Task
+from django.db import OperationalError
+import grpc
+import requests
+from slack_sdk.errors import SlackApiError
+import status_pb2
+
+from poma import jobs, metrics
+from poma.concurrency import Saturated
+from poma.search.semantic import IndexRejected
+
+TASK_MAX_RETRIES = int(os.getenv("TASK_MAX_RETRIES", 8))
+TASK_RETRY_BACKOFF = int(os.getenv("TASK_RETRY_BACKOFF", 2))
+TASK_RETRY_BACKOFF_MAX = int(os.getenv("TASK_RETRY_BACKOFF_MAX", 10 * 60))
+RETRYABLE_CODES = {
+    grpc.StatusCode.UNAVAILABLE,
+    grpc.StatusCode.RESOURCE_EXHAUSTED,
+    grpc.StatusCode.DEADLINE_EXCEEDED,
+    grpc.StatusCode.ABORTED,
+    grpc.StatusCode.INTERNAL,
+    grpc.StatusCode.UNKNOWN,
+    # An expired token, the next attempt fetches a new one
+    grpc.StatusCode.UNAUTHENTICATED,
+}
+RETRYABLE_STATUS = {408, 409, 425, 429, 500, 502, 503, 504}
+# Statuses of an Index response worth another attempt, the others (invalid
+# document, disabled or missing corpus...) fail the same way every time
+RETRYABLE_INDEX_STATUS = {
+    status_pb2.UNKNOWN,
+    status_pb2.DEADLINE_EXCEEDED,
+    status_pb2.RESOURCE_EXHAUSTED,
+    status_pb2.ABORTED,
+    status_pb2.INTERNAL,
+    status_pb2.UNAVAILABLE,
+    status_pb2.UNAUTHENTICATED,
+    status_pb2.TOO_MANY_REQUESTS,
+    status_pb2.INTERNAL_SERVER_ERROR,
+    status_pb2.SERVICE_UNAVAILABLE,
+    status_pb2.IDX__TRANSIENT_PARTIAL_DELETION_FAILURE,
+}
+
+logger = logging.getLogger(__name__)
+
+
+def retryable(error: Exception) -> bool:
+    """Whether the call that raised error may succeed when tried again."""
+    from googleapiclient.errors import HttpError
+    from poma.sources import gdrive
+
+    if isinstance(error, grpc.RpcError):
+        return error.code() in RETRYABLE_CODES
+    if isinstance(error, IndexRejected):
+        return error.code in RETRYABLE_INDEX_STATUS
+    if isinstance(error, (requests.HTTPError, SlackApiError)):
+        response = error.response
+        return response is None or response.status_code in RETRYABLE_STATUS
+    if isinstance(error, HttpError):
+        return gdrive.retryable(error)
+    return isinstance(
+        error,
+        (
+            Saturated,
+            requests.ConnectionError,
+            requests.Timeout,
+            ConnectionError,
+            socket.timeout,
+            OperationalError,
+        ),
+    )
+
+
+def raise_for(failure):
+    """Raise the error of a failed upload(), an exception or a response."""
+    if isinstance(failure, Exception):
+        raise failure
+    raise requests.HTTPError(
+        f"{failure.status_code} {failure.reason}: {failure.text}", response=failure
+    )
+
+
+def dead_letter(task: str, args, kwargs, error, attempts, workspace_id=None):
+    """Store a task that failed for good as a ``FailedTask`` to replay."""
+    from app.models import FailedTask
+
+    FailedTask.objects.create(
+        task=task,
+        workspace_id=workspace_id,
+        arguments=json.dumps([list(args), kwargs]),
+        error=repr(error),
+        retryable=retryable(error),
+        attempts=attempts,
+    )
+    metrics.tasks_dead_lettered.labels(task).inc()
+
+
+class IndexingTask(Task):
+    """Base of tasks indexing one document: retries retryable errors with
+    backoff and dead-letters the task once it fails for good. The job of a
+    ``job_id`` argument counts the document as failed."""
+
+    autoretry_for = (Exception,)
+    max_retries = TASK_MAX_RETRIES
+    retry_backoff = TASK_RETRY_BACKOFF
+    retry_backoff_max = TASK_RETRY_BACKOFF_MAX
+    retry_jitter = True
+
+    def retry(self, *args, exc=None, **kwargs):
+        if exc is not None and not retryable(exc):
+            raise exc
+        logger.warning("Retrying %s[%s] after %r", self.name, self.request.id, exc)
+        return super().retry(*args, exc=exc, **kwargs)
+
+    def on_failure(self, exc, task_id, args, kwargs, einfo):
+        try:
+            arguments = inspect.signature(self.run).bind(*args, **kwargs).arguments
+        except TypeError:
+            arguments = {}
+        dead_letter(
+            self.name,
+            args,
+            kwargs,
+            exc,
+            self.request.retries + 1,
+            workspace_id=arguments.get("workspace_id"),
+        )
+        jobs.incr(arguments.get("job_id"), failed=1)
+        logger.error("%s[%s] dead-lettered: %r", self.name, task_id, exc)
@@ -0,0 +1,125 @@
+"""Fair-share scheduling of backfill tasks across workspaces.
+
+Instead of going straight to Celery, backfill tasks wait in a Redis list per
+workspace. Workspaces with pending tasks sit in a ring that is walked round
+robin, and each turn a workspace may send as many tasks as its
+``schedule_weight``, as long as it has fewer than
+``FAIR_INFLIGHT_PER_WEIGHT * schedule_weight`` tasks in flight. A task frees
+its slot when it succeeds or finally fails, which dispatches more work, so a
+workspace with a huge Drive cannot hold the whole queue and a small one gets
+its first documents indexed right away.
+
+Slots of tasks lost with their worker expire after ``FAIR_SLOT_TIMEOUT``.
+When Redis is unreachable tasks are sent to Celery directly.
+"""
+import json
+import logging
+import os
+import time
+
+import redis
+from celery import current_app, shared_task
+from celery.utils import uuid
+
+from poma.idempotency import get_redis
+
+FAIR_INFLIGHT_PER_WEIGHT = int(os.getenv("FAIR_INFLIGHT_PER_WEIGHT", 4))
+FAIR_SLOT_TIMEOUT = int(os.getenv("FAIR_SLOT_TIMEOUT", 60 * 60))
+PREFIX = "poma:fair"
+RING = f"{PREFIX}:ring"
+WEIGHTS = f"{PREFIX}:weights"
+LOCK = f"{PREFIX}:lock"
+DIRTY = f"{PREFIX}:dirty"
+LOCK_TTL = 30
+
+logger = logging.getLogger(__name__)
+
+
+def _queue(workspace_id):
+    return f"{PREFIX}:queue:{workspace_id}"
+
+
+def _inflight(workspace_id):
+    return f"{PREFIX}:inflight:{workspace_id}"
+
+
+def submit(workspace, task, *args):
+    """Schedule task(*args) for the workspace, instead of task.delay(*args)."""
+    payload = json.dumps([task.name, args])
+    try:
+        pipeline = get_redis().pipeline()
+        pipeline.rpush(_queue(workspace.id), payload)
+        pipeline.hset(WEIGHTS, workspace.id, max(workspace.schedule_weight, 1))
+        pipeline.lrem(RING, 0, workspace.id)
+        pipeline.rpush(RING, workspace.id)
+        pipeline.execute()
+    except redis.RedisError as error:
+        logger.warning("Sending %s without fair scheduling: %s", task.name, error)
+        task.apply_async(args)
+        return
+    dispatch()
+
+
+def dispatch():
+    """Send the tasks the in-flight caps allow. Only one process dispatches at a
+    time, the others leave a mark so it makes another pass for them."""
+    try:
+        redis_client = get_redis()
+        redis_client.set(DIRTY, 1)
+        while redis_client.set(LOCK, 1, nx=True, ex=LOCK_TTL):
+            try:
+                while redis_client.delete(DIRTY):
+                    while _dispatch_round(redis_client):
+                        pass
+            finally:
+                redis_client.delete(LOCK)
+            if not redis_client.exists(DIRTY):
+                break
+    except redis.RedisError as error:
+        logger.warning("Fair scheduling dispatch failed: %s", error)
+
+
+def _dispatch_round(redis_client):
+    """Give every workspace of the ring one turn, returns the tasks sent."""
+    sent = 0
+    now = time.time()
+    weights = redis_client.hgetall(WEIGHTS)
+    for workspace_id in redis_client.lrange(RING, 0, -1):
+        workspace_id = workspace_id.decode()
+        weight = int(weights.get(workspace_id.encode(), 1))
+        inflight = _inflight(workspace_id)
+        redis_client.zremrangebyscore(inflight, 0, now - FAIR_SLOT_TIMEOUT)
+        free = FAIR_INFLIGHT_PER_WEIGHT * weight - redis_client.zcard(inflight)
+        for _ in range(min(free, weight)):
+            payload = redis_client.lpop(_queue(workspace_id))
+            if payload is None:
+                redis_client.lrem(RING, 0, workspace_id)
+                # A task submitted meanwhile puts the workspace back
+                if redis_client.llen(_queue(workspace_id)):
+                    redis_client.rpush(RING, workspace_id)
+                break
+            name, args = json.loads(payload)
+            task_id = uuid()
+            redis_client.zadd(inflight, {task_id: now})
+            slot = release.si(workspace_id, task_id)
+            try:
+                current_app.signature(name, args=args).apply_async(
+                    task_id=task_id, link=slot, link_error=slot
+                )
+            except Exception:
+                redis_client.zrem(inflight, task_id)
+                redis_client.lpush(_queue(workspace_id), payload)
+                raise
+            sent += 1
+    return sent
+
+
+@shared_task
+def release(workspace_id, task_id):
+    """Free the slot of a finished task and dispatch the next ones."""
+    try:
+        get_redis().zrem(_inflight(workspace_id), task_id)
+    except redis.RedisError as error:
+        logger.warning("Could not release slot %s: %s", task_id, error)
+        return
+    dispatch()
@@ -0,0 +1,125 @@
+"""Client side circuit breaker and hedged calls for the search backend.
+
+The breaker keeps the outcome and latency of the calls of the last
+``BREAKER_WINDOW_SECONDS``. Once at least ``BREAKER_MIN_CALLS`` were made and
+``BREAKER_FAILURE_RATE`` of them failed or took longer than
+``BREAKER_SLOW_SECONDS``, it opens and callers fail fast for
+``BREAKER_COOLDOWN_SECONDS``. Then a single probe call is let through, which
+closes the breaker when it succeeds in time and opens it again otherwise.
+
+The state is kept per process, a daphne process that stops waiting on Vectara
+is what keeps its workers free.
+"""
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeout
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+BREAKER_WINDOW_SECONDS = float(os.getenv("BREAKER_WINDOW_SECONDS", 30))
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", 10))
+BREAKER_FAILURE_RATE = float(os.getenv("BREAKER_FAILURE_RATE", 0.5))
+BREAKER_SLOW_SECONDS = float(os.getenv("BREAKER_SLOW_SECONDS", 2))
+BREAKER_COOLDOWN_SECONDS = float(os.getenv("BREAKER_COOLDOWN_SECONDS", 15))
+# Quantile of the recent latencies after which a call is hedged, 0 disables
+HEDGE_QUANTILE = float(os.getenv("SEARCH_HEDGE_QUANTILE", 0.95))
+HEDGE_MIN_DELAY = float(os.getenv("SEARCH_HEDGE_MIN_DELAY", 0.05))
+
+_hedger = ThreadPoolExecutor(max_workers=16, thread_name_prefix="search-hedge")
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitBreaker:
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = deque()  # (finished at, seconds, failed)
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def _trim(self, now):
+        while self.calls and self.calls[0][0] < now - BREAKER_WINDOW_SECONDS:
+            self.calls.popleft()
+
+    def allow(self) -> bool:
+        """Whether a call may be made, False while the breaker is open."""
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if (
+                self.probing
+                or time.monotonic() - self.opened_at < BREAKER_COOLDOWN_SECONDS
+            ):
+                return False
+            self.probing = True
+            return True
+
+    def record(self, seconds: float, success: bool):
+        """Count the outcome of a call, opening or closing the breaker."""
+        failed = not success or seconds >= BREAKER_SLOW_SECONDS
+        now = time.monotonic()
+        with self.lock:
+            self.calls.append((now, seconds, failed))
+            self._trim(now)
+            if self.probing:
+                self.probing = False
+                if failed:
+                    self.opened_at = now
+                else:
+                    logger.info("%s circuit closed", self.name)
+                    self.opened_at = None
+                    self.calls.clear()
+                return
+            if self.opened_at is not None or len(self.calls) < BREAKER_MIN_CALLS:
+                return
+            failures = sum(failed for _, _, failed in self.calls)
+            if failures / len(self.calls) >= BREAKER_FAILURE_RATE:
+                logger.warning(
+                    "%s circuit opened, %d of %d calls failed or were slow",
+                    self.name,
+                    failures,
+                    len(self.calls),
+                )
+                self.opened_at = now
+
+    def hedge_delay(self):
+        """Seconds after which a call should be hedged, None when it should not
+        be (not enough recent calls, or the breaker is not closed)."""
+        if not 0 < HEDGE_QUANTILE < 1:
+            return None
+        with self.lock:
+            if self.opened_at is not None:
+                return None
+            self._trim(time.monotonic())
+            latencies = [seconds for _, seconds, failed in self.calls if not failed]
+        if len(latencies) < BREAKER_MIN_CALLS:
+            return None
+        return max(float(np.quantile(latencies, HEDGE_QUANTILE)), HEDGE_MIN_DELAY)
+
+
+def hedged(call, delay, accept=bool, on_hedge=None):
+    """Run call(), and if it did not return within delay seconds run it a
+    second time and return the first accepted result of the two. The slower
+    call is left to finish in the background."""
+    if delay is None:
+        return call()
+    first = _hedger.submit(call)
+    try:
+        return first.result(timeout=delay)
+    except FutureTimeout:
+        pending = {first, _hedger.submit(call)}
+    if on_hedge is not None:
+        on_hedge()
+    result = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            result = future.result()
+            if accept(result):
+                return result
+    return result
@@ -0,0 +1,108 @@
+"""GPT context assembled from the best sections of the search results.
+
+Sections are ranked by the best score of a hit on them and chosen by their
+token count stored at index time, so only the chosen sections are loaded and
+decrypted. Sentences that nearly repeat an already kept sentence are dropped
+and the rest is packed into ``GPT_CONTEXT_TOKENS``.
+"""
+import os
+import re
+from typing import Iterable, Tuple
+
+GPT_CONTEXT_TOKENS = int(os.getenv("GPT_CONTEXT_TOKENS", 600))
+# Share of the budget loaded beyond it, to refill what duplicates free
+OVERFETCH = 1.5
+# Word shingle overlap above which two sentences are duplicates
+DUPLICATE_SIMILARITY = 0.8
+
+_pieces = re.compile(r"\w+|[^\w\s]")
+_words = re.compile(r"\w+")
+_sentences = re.compile(r"(?<=[.!?])\s+|\n+")
+
+
+def count_tokens(text: str):
+    """Estimate of the GPT tokens of text: about a token per word or
+    punctuation mark, and never fewer than one per four characters."""
+    return max(len(_pieces.findall(text)), len(text) // 4)
+
+
+def _shingles(sentence: str):
+    words = _words.findall(sentence.lower())
+    if len(words) < 3:
+        return {tuple(words)}
+    return {tuple(words[i : i + 3]) for i in range(len(words) - 2)}
+
+
+def _is_duplicate(shingles, kept):
+    for other in kept:
+        overlap = len(shingles & other) / max(min(len(shingles), len(other)), 1)
+        if overlap >= DUPLICATE_SIMILARITY:
+            return True
+    return False
+
+
+def split_sentences(text: str):
+    return [sentence.strip() for sentence in _sentences.split(text) if sentence.strip()]
+
+
+def best_sections(hits: Iterable[Tuple[int, int, float]], budget: int):
+    """Returns [(document id, text)] of the best scoring sections of the
+    (document id, section id, score) hits, up to about budget tokens."""
+    from app.models import Section
+
+    scores = {}
+    for document_id, section_id, score in hits:
+        key = (document_id, section_id)
+        scores[key] = max(score, scores.get(key, score))
+    if not scores:
+        return []
+
+    rows = Section.objects.filter(
+        document_id__in={document_id for document_id, _ in scores}
+    ).values_list("id", "document_id", "section_id", "token_count", "word_count")
+    sections, by_document = {}, {}
+    for id, document_id, section_id, tokens, words in rows:
+        # Sections stored before token counts existed estimate from words
+        section = (
+            id,
+            document_id,
+            tokens if tokens is not None else words * 4 // 3 + 1,
+        )
+        sections[(document_id, section_id)] = section
+        by_document.setdefault(document_id, []).append(section)
+
+    chosen, total = [], 0
+    for key in sorted(scores, key=scores.get, reverse=True):
+        section = sections.get(key)
+        if section is None and len(by_document.get(key[0], [])) == 1:
+            # Single section documents (Slack messages) are not indexed by id
+            section = by_document[key[0]][0]
+        if section is None or section in chosen:
+            continue
+        if total + section[2] <= budget:
+            chosen.append(section)
+            total += section[2]
+
+    ids = [id for id, _, _ in chosen]
+    texts = dict(Section.objects.filter(id__in=ids).values_list("id", "text"))
+    return [(document_id, texts.get(id, "")) for id, document_id, _ in chosen]
+
+
+def assemble(hits: Iterable[Tuple[int, int, float]], budget: int = GPT_CONTEXT_TOKENS):
+    """Build the context from (document id, section id, score) search hits."""
+    kept, parts, total = [], [], 0
+    for _, text in best_sections(hits, int(budget * OVERFETCH)):
+        sentences = []
+        for sentence in split_sentences(text):
+            shingles = _shingles(sentence)
+            if _is_duplicate(shingles, kept):
+                continue
+            tokens = count_tokens(sentence)
+            if total + tokens > budget:
+                break
+            kept.append(shingles)
+            sentences.append(sentence)
+            total += tokens
+        if sentences:
+            parts.append(" ".join(sentences))
+    return "\n\n".join(parts)
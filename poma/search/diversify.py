@@ -0,0 +1,57 @@
+"""Diversify search results with maximal marginal relevance (MMR).
+
+Snippets are embedded as hashed TF-IDF vectors, their words hashed into
+``SEARCH_MMR_DIMENSIONS`` buckets so no vocabulary is kept. Results are then
+picked greedily by ``λ * relevance - (1 - λ) * similarity to the picked ones``,
+so crossposts and copies of a document sink below distinct content instead of
+filling the page. A λ of 1 keeps the Vectara order.
+"""
+import os
+import re
+import zlib
+
+import numpy as np
+
+SEARCH_MMR_LAMBDA = float(os.getenv("SEARCH_MMR_LAMBDA", 0.7))
+SEARCH_MMR_DIMENSIONS = int(os.getenv("SEARCH_MMR_DIMENSIONS", 2**12))
+
+_words = re.compile(r"\w+")
+
+
+def vectorize(texts: list, dimensions: int = SEARCH_MMR_DIMENSIONS):
+    """L2 normalized hashed TF-IDF vectors of texts, one row per text."""
+    counts = np.zeros((len(texts), dimensions), dtype=np.float32)
+    for row, text in enumerate(texts):
+        for word in _words.findall(text.lower()):
+            counts[row, zlib.crc32(word.encode()) % dimensions] += 1
+    df = np.count_nonzero(counts, axis=0)
+    vectors = np.log1p(counts) * (np.log((1 + len(texts)) / (1 + df)) + 1)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-9)
+
+
+def mmr(relevance, vectors, lam: float = SEARCH_MMR_LAMBDA):
+    """Indexes of all rows ordered by maximal marginal relevance."""
+    n = len(relevance)
+    similarity = vectors @ vectors.T
+    closest = np.zeros(n, dtype=np.float32)
+    remaining = np.ones(n, dtype=bool)
+    order = []
+    for _ in range(n):
+        gains = np.where(remaining, lam * relevance - (1 - lam) * closest, -np.inf)
+        best = int(np.argmax(gains))
+        order.append(best)
+        remaining[best] = False
+        closest = np.maximum(closest, similarity[best])
+    return order
+
+
+def diversify(responses: list, lam: float = SEARCH_MMR_LAMBDA):
+    """Reorder Vectara responses, best first, by maximal marginal relevance."""
+    if lam >= 1 or len(responses) < 3:
+        return responses
+    scores = np.array([r.get("score", 0) for r in responses], dtype=np.float32)
+    spread = scores.max() - scores.min()
+    relevance = (scores - scores.min()) / spread if spread > 0 else np.ones_like(scores)
+    vectors = vectorize([r.get("text", "") for r in responses])
+    return [responses[i] for i in mmr(relevance, vectors, lam)]
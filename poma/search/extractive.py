@@ -0,0 +1,79 @@
+"""Extractive answers picked from the top search results, without a LLM.
+
+The sentences of the best sections are scored against the query with BM25
+computed on a NumPy term matrix, and the best few are returned in reading
+order with the documents they come from, in a few milliseconds.
+"""
+import os
+import re
+from typing import Iterable, Tuple
+
+import numpy as np
+
+from poma.search.context import best_sections, split_sentences
+
+EXTRACTIVE_TOKENS = int(os.getenv("EXTRACTIVE_TOKENS", 2000))
+EXTRACTIVE_SENTENCES = int(os.getenv("EXTRACTIVE_SENTENCES", 3))
+K1 = 1.2
+B = 0.75
+
+_terms = re.compile(r"\w+")
+
+
+def _tokenize(text: str):
+    return _terms.findall(text.lower())
+
+
+def bm25(query: str, sentences: list):
+    """BM25 score of every sentence, sentences being the collection."""
+    terms = sorted(set(_tokenize(query)))
+    if not terms or not sentences:
+        return np.zeros(len(sentences))
+    column = {term: i for i, term in enumerate(terms)}
+    tf = np.zeros((len(sentences), len(terms)))
+    lengths = np.zeros(len(sentences))
+    for row, sentence in enumerate(sentences):
+        words = _tokenize(sentence)
+        lengths[row] = len(words)
+        for word in words:
+            if word in column:
+                tf[row, column[word]] += 1
+    df = np.count_nonzero(tf, axis=0)
+    idf = np.log1p((len(sentences) - df + 0.5) / (df + 0.5))
+    norm = K1 * (1 - B + B * lengths / max(lengths.mean(), 1))
+    return (tf * (K1 + 1) / (tf + norm[:, None]) * idf).sum(axis=1)
+
+
+def answer(
+    query: str,
+    hits: Iterable[Tuple[int, int, float]],
+    sentences: int = EXTRACTIVE_SENTENCES,
+):
+    """Returns {"text", "sources"} answering query from (document id, section
+    id, score) hits, text being empty when no sentence matches the query."""
+    from app.models import Document
+
+    candidates = [
+        (document_id, sentence)
+        for document_id, text in best_sections(hits, EXTRACTIVE_TOKENS)
+        for sentence in split_sentences(text)
+    ]
+    scores = bm25(query, [sentence for _, sentence in candidates])
+    best = [i for i in np.argsort(-scores, kind="stable")[:sentences] if scores[i] > 0]
+    if not best:
+        return {"text": "", "sources": []}
+
+    cited = list(dict.fromkeys(candidates[i][0] for i in sorted(best)))
+    documents = Document.objects.in_bulk(cited)
+    parts = []
+    for i in sorted(best):
+        document_id, sentence = candidates[i]
+        parts.append(f"{sentence} [{cited.index(document_id) + 1}]")
+    return {
+        "text": " ".join(parts),
+        "sources": [
+            {"title": documents[id].title, "link": documents[id].link}
+            for id in cited
+            if id in documents
+        ],
+    }
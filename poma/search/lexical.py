@@ -0,0 +1,72 @@
+"""Lexical search over the stored sections, used while Vectara is unavailable.
+
+Section texts are encrypted, so they cannot be matched in SQL. The candidates
+are the sections of documents whose title contains a query term and the most
+recent sections, ``SEARCH_LEXICAL_CANDIDATES`` in all, ranked with BM25 in
+Python. Filtered searches do not fall back to it.
+"""
+import os
+import re
+
+import numpy as np
+from django.db.models import Q
+
+from poma.search.extractive import bm25
+
+SEARCH_LEXICAL_CANDIDATES = int(os.getenv("SEARCH_LEXICAL_CANDIDATES", 1000))
+MAX_TERMS = 8
+
+_words = re.compile(r"\w+")
+
+
+def search(workspaces, query: str, num_results: int):
+    """Returns Vectara-like responses, {"text", "score", "documentId",
+    "corpusId", "metadata", "degraded"}, for the best matches in the
+    documents of the workspaces."""
+    from app.models import Section
+
+    terms = sorted(set(_words.findall(query.lower())), key=len, reverse=True)[
+        :MAX_TERMS
+    ]
+    if not terms:
+        return []
+    sections = Section.objects.filter(
+        document__workspace__in=workspaces,
+        document__canonical=None,
+    ).values_list(
+        "id",
+        "section_id",
+        "text",
+        "document__title",
+        "document__identifier",
+        "document__workspace_id",
+    )
+    titles = Q()
+    for term in terms:
+        titles |= Q(document__title__icontains=term)
+    share = SEARCH_LEXICAL_CANDIDATES // 2
+    candidates = {
+        row[0]: row
+        for rows in (
+            sections.filter(titles).order_by("-id")[:share],
+            sections.order_by("-id")[:share],
+        )
+        for row in rows
+    }
+    rows = list(candidates.values())
+    corpora = {workspace.id: workspace.corpus_id for workspace in workspaces}
+    scores = bm25(query, [f"{title} {text}" for _, _, text, title, _, _ in rows])
+    best = [
+        i for i in np.argsort(-scores, kind="stable")[:num_results] if scores[i] > 0
+    ]
+    return [
+        {
+            "text": rows[i][2],
+            "score": float(scores[i]),
+            "documentId": rows[i][4],
+            "corpusId": corpora[rows[i][5]],
+            "metadata": [{"name": "section", "value": str(rows[i][1])}],
+            "degraded": True,
+        }
+        for i in best
+    ]
@@ -1,9 +1,12 @@
 import os
 import openai
 
+from poma import metrics, tracing
+
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
 
+@tracing.traced("openai.completion")
 def anwser(query: str, context: str):
     prompt = f"""
 I am a highly intelligent question answering bot. If you ask me a question that is rooted in truth, I will give you the answer. If you ask me a question that is nonsense, trickery, or has no clear answer, I will respond with "Unknown". If you give me context, I will use it to answer. The question might be in a non-english language, and I'll answer.
@@ -40,15 +43,16 @@ Based only in the above context, and without adding any other information that's
 Q: {query}
 A:
     """
-    response = openai.Completion.create(
-        model="text-davinci-003",
-        prompt=prompt,
-        temperature=0.5,
-        max_tokens=500,
-        frequency_penalty=1,
-        presence_penalty=1,
-        echo=False,
-    )
+    with metrics.timer(metrics.openai_seconds):
+        response = openai.Completion.create(
+            model="text-davinci-003",
+            prompt=prompt,
+            temperature=0.5,
+            max_tokens=500,
+            frequency_penalty=1,
+            presence_penalty=1,
+            echo=False,
+        )
     text = response.get("choices", [None])[0]
     if text is None:
         return ""
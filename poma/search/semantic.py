@@ -1,6 +1,8 @@
 import os
 import io
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
 import json
 from typing import List, Tuple
 from authlib.integrations.requests_client import OAuth2Session
@@ -9,39 +11,110 @@ import argparse
 import json
 import logging
 import struct
+import time
 
 from authlib.integrations.requests_client import OAuth2Session
 import requests
 import grpc
 
 import admin_pb2
+import common_pb2
 import indexing_pb2
 import services_pb2
 import services_pb2_grpc
 import serving_pb2
+import status_pb2
+from poma import concurrency, metrics, tracing
+from poma.search.breaker import CircuitBreaker, hedged
 
 KEY = os.getenv("SEMANTIC_KEY")
 REDIRECT_URI = os.getenv("SEMANTIC_REDIRECT_URI")
 APP_ID = os.getenv("SEMANTIC_APP_ID")
 CLIENT_SECRET = os.getenv("SEMANTIC_CLIENT_SECRET")
 CUSTOMER_ID = os.getenv("SEMANTIC_CUSTOMER_ID")
-SERVING_ENDPOINT = "serving.vectara.io"
-INDEXING_ENDPOINT = "indexing.vectara.io"
-UPLOAD_ENDPOINT = "https://api.vectara.io/v1/upload"
+SERVING_ENDPOINT = os.getenv("SEMANTIC_SERVING_ENDPOINT", "serving.vectara.io")
+INDEXING_ENDPOINT = os.getenv("SEMANTIC_INDEXING_ENDPOINT", "indexing.vectara.io")
+ADMIN_ENDPOINT = os.getenv("SEMANTIC_ADMIN_ENDPOINT", "admin.vectara.io")
+API_URL = os.getenv("SEMANTIC_API_URL", "https://api.vectara.io")
+QUERY_ENDPOINT = f"{API_URL}/v1/query"
+UPLOAD_ENDPOINT = f"{API_URL}/v1/upload"
+# (connect, read) seconds, a query never holds a request longer than that
+SEARCH_TIMEOUT = (
+    float(os.getenv("SEARCH_CONNECT_TIMEOUT", 1)),
+    float(os.getenv("SEARCH_TIMEOUT", 5)),
+)
+# Only for local stand-ins of the gRPC services (see poma.bench)
+GRPC_LOCAL = os.getenv("SEMANTIC_GRPC_LOCAL") == "true"
 TOKEN = None
 
+# Document level metadata every corpus can filter on, see metadata_filter()
+FILTER_ATTRIBUTES = {
+    "source": "FILTER_ATTRIBUTE_TYPE__TEXT",
+    "channel": "FILTER_ATTRIBUTE_TYPE__TEXT",
+    "author": "FILTER_ATTRIBUTE_TYPE__TEXT",
+    "ts": "FILTER_ATTRIBUTE_TYPE__INTEGER",
+    "mimetype": "FILTER_ATTRIBUTE_TYPE__TEXT",
+    "is_title": "FILTER_ATTRIBUTE_TYPE__BOOLEAN",
+}
+# Custom dimensions every corpus declares. Documents get their values at index
+# time and queries add weight * value to the score of each hit.
+CUSTOM_DIMENSIONS = {
+    "recency": "Years between 2020 and the last change of the document",
+    "slack": "1 for Slack messages, 0 otherwise",
+}
+# Errors meaning Vectara is overloaded, they shrink the ingestion concurrency
+OVERLOAD_CODES = {
+    grpc.StatusCode.RESOURCE_EXHAUSTED,
+    grpc.StatusCode.UNAVAILABLE,
+    grpc.StatusCode.DEADLINE_EXCEEDED,
+}
+OVERLOAD_STATUS = {429, 500, 502, 503, 504}
+# Statuses of an Index response meaning Vectara is overloaded
+OVERLOAD_INDEX_STATUS = {
+    status_pb2.RESOURCE_EXHAUSTED,
+    status_pb2.UNAVAILABLE,
+    status_pb2.DEADLINE_EXCEEDED,
+    status_pb2.TOO_MANY_REQUESTS,
+    status_pb2.SERVICE_UNAVAILABLE,
+}
+query_breaker = CircuitBreaker("vectara.query")
+RECENCY_EPOCH = 1577836800  # 2020-01-01 UTC
+YEAR = 365.25 * 24 * 60 * 60
+
+
+class IndexRejected(Exception):
+    """Vectara answered an Index call with a status other than OK."""
+
+    def __init__(self, status):
+        self.code = status.code
+        self.detail = status.status_detail
+        if self.code in status_pb2.StatusCode.values():
+            name = status_pb2.StatusCode.Name(self.code)
+        else:
+            name = str(self.code)
+        super().__init__(f"{name}: {self.detail}")
+
 
 def _get_jwt_token() -> Tuple[str, datetime]:
     """Connect to the server and get a JWT token and it's expiration datetime."""
     global TOKEN
-    if TOKEN is None or datetime.fromtimestamp(TOKEN["expires_in"]) < datetime.now():
+    if TOKEN is None or datetime.fromtimestamp(TOKEN["expires_at"]) < datetime.now():
         token_endpoint = f"{REDIRECT_URI}/oauth2/token"
         session = OAuth2Session(APP_ID, CLIENT_SECRET, scope="")
-        TOKEN = session.fetch_token(token_endpoint, grant_type="client_credentials")
-        return TOKEN["access_token"], datetime.fromtimestamp(TOKEN["expires_in"])
-    return (TOKEN["access_token"], datetime.fromtimestamp(TOKEN["expires_in"]))
+        with metrics.timer(metrics.vectara_token_seconds), tracing.span("vectara.token"):
+            TOKEN = session.fetch_token(token_endpoint, grant_type="client_credentials")
+    return (TOKEN["access_token"], datetime.fromtimestamp(TOKEN["expires_at"]))
 
 
+@lru_cache
+def _channel(address: str):
+    """Reuse one channel per address, gRPC multiplexes concurrent calls over it."""
+    if GRPC_LOCAL:
+        return grpc.secure_channel(address, grpc.local_channel_credentials())
+    return grpc.secure_channel(address, grpc.ssl_channel_credentials())
+
+
+@tracing.traced("vectara.index")
 def index(
     document: indexing_pb2.Document,
     customer_id: int,
@@ -57,6 +130,9 @@ def index(
         jwt_token: A valid Auth token.
     Returns:
         (None, True) in case of success and returns (error, False) in case of failure.
+        A response whose status is not OK fails with ``IndexRejected``, except
+        ALREADY_EXISTS: the document is in the corpus, e.g. from an attempt
+        that timed out after Vectara stored it.
     """
     customer_id = int(customer_id)
     logging.info("Indexing data into the corpus.")
@@ -66,108 +142,358 @@ def index(
     index_req.document.MergeFrom(document)
 
     try:
-        index_stub = services_pb2_grpc.IndexServiceStub(
-            grpc.secure_channel(idx_address, grpc.ssl_channel_credentials())
-        )
+        index_stub = services_pb2_grpc.IndexServiceStub(_channel(idx_address))
 
         # Vectara API expects customer_id as a 64-bit binary encoded value in the metadata of
         # all grpcs calls. Following line generates the encoded value from customer ID.
         packed_customer_id = struct.pack(">q", customer_id)
-        response = index_stub.Index(
-            index_req,
-            credentials=grpc.access_token_call_credentials(jwt_token),
-            metadata=[("customer-id-bin", packed_customer_id)],
-        )
+        with concurrency.limited("index") as slot:
+            try:
+                response = index_stub.Index(
+                    index_req,
+                    credentials=grpc.access_token_call_credentials(jwt_token),
+                    metadata=[("customer-id-bin", packed_customer_id)],
+                )
+            except grpc.RpcError as rpc_error:
+                slot.overloaded = rpc_error.code() in OVERLOAD_CODES
+                return rpc_error, False
+            code = response.status.code
+            slot.overloaded = code in OVERLOAD_INDEX_STATUS
+        if code not in (status_pb2.OK, status_pb2.ALREADY_EXISTS):
+            return IndexRejected(response.status), False
         logging.info("Indexed document successful: %s", response)
-    except grpc.RpcError as rpc_error:
+    except (grpc.RpcError, concurrency.Saturated) as rpc_error:
         return rpc_error, False
     return None, True
 
 
-def query(
-    customer_id: int, corpus_id: int, query_address: str, jwt_token: str, query: str,
+def query_request(
+    customer_id: int,
+    corpus_id: int,
+    query: str,
+    start: int = 0,
+    num_results: int = 20,
+    metadata_filter: str = None,
+    dims: dict = None,
 ):
-    """This method queries the data.
+    """One QueryRequest of a BatchQueryRequest, see query() for the arguments."""
+    corpus_key = {
+        "customerId": customer_id,
+        "corpusId": corpus_id,
+        "semantics": "DEFAULT",
+    }
+    if metadata_filter:
+        corpus_key["metadataFilter"] = metadata_filter
+    if dims:
+        corpus_key["dim"] = [
+            {"name": name, "weight": weight} for name, weight in dims.items()
+        ]
+    return {
+        "query": query,
+        "start": start,
+        "numResults": num_results,
+        "corpusKey": [corpus_key],
+    }
+
+
+@tracing.traced("vectara.query")
+def batch_query(
+    customer_id: int, query_address: str, jwt_token: str, query_requests: List[dict]
+):
+    """Runs several query requests in one round trip.
     Args:
         customer_id: Unique customer ID in vectara platform.
-        corpus_id: ID of the corpus to which data needs to be indexed.
         query_address: Address of the querying server. e.g., serving.vectara.io
         jwt_token: A valid Auth token.
+        query_requests: Requests built with query_request(), the response has
+            one response set per request, in the same order.
     Returns:
-        (None, True) in case of success and returns (error, False) in case of failure.
+        (response, text, True) in case of success and returns (response, error, False) in case of failure.
     """
 
     headers = {"Authorization": f"Bearer {jwt_token}", "customer-id": str(customer_id)}
-    payload = {
-        "query": [
-            {
-                "query": query,
-                "start": 0,
-                "numResults": 20,
-                "corpusKey": [
-                    {
-                        "customerId": customer_id,
-                        "corpusId": corpus_id,
-                        "semantics": "DEFAULT",
-                    }
-                ],
-            }
-        ]
-    }
-    response = requests.request(
-        "POST", "https://api.vectara.io/v1/query", headers=headers, json=payload
+    payload = {"query": query_requests}
+    if not query_breaker.allow():
+        metrics.vectara_query_rejected.inc()
+        return None, "Vectara is unavailable, try again shortly", False
+
+    def post():
+        started = time.perf_counter()
+        try:
+            response = requests.post(
+                QUERY_ENDPOINT, headers=headers, json=payload, timeout=SEARCH_TIMEOUT
+            )
+        except requests.RequestException as error:
+            elapsed = time.perf_counter() - started
+            metrics.vectara_query_seconds.labels("error").observe(elapsed)
+            query_breaker.record(elapsed, False)
+            return None, error
+        elapsed = time.perf_counter() - started
+        metrics.vectara_query_seconds.labels(response.status_code).observe(elapsed)
+        # Rejected queries (bad filter...) say nothing about Vectara's health
+        query_breaker.record(elapsed, response.status_code not in OVERLOAD_STATUS)
+        return response, None
+
+    response, error = hedged(
+        tracing.in_context(post),
+        query_breaker.hedge_delay(),
+        accept=lambda result: result[0] is not None and result[0].status_code == 200,
+        on_hedge=metrics.vectara_queries_hedged.inc,
     )
+    if response is None:
+        logging.error("Query failed: %s", error)
+        return None, str(error), False
     if response.status_code != 200:
         logging.error(
-            "REST upload failed with code %d, reason %s, text %s",
+            "REST query failed with code %d, reason %s, text %s",
             response.status_code,
             response.reason,
             response.text,
         )
         return response, response.text, False
+    metrics.observe_vectara_metrics(response.json())
     return response, response.text, True
 
 
-def search(query_string, corpus_id=2):
+def query(
+    customer_id: int,
+    corpus_id: int,
+    query_address: str,
+    jwt_token: str,
+    query: str,
+    start: int = 0,
+    num_results: int = 20,
+    metadata_filter: str = None,
+    dims: dict = None,
+):
+    """This method queries the data.
+    Args:
+        customer_id: Unique customer ID in vectara platform.
+        corpus_id: ID of the corpus to which data needs to be indexed.
+        query_address: Address of the querying server. e.g., serving.vectara.io
+        jwt_token: A valid Auth token.
+        start: Offset of the first result to return.
+        num_results: Number of results to return.
+        metadata_filter: Filter expression over the corpus' filter attributes.
+        dims: Weight of each custom dimension.
+    Returns:
+        (None, True) in case of success and returns (error, False) in case of failure.
+    """
+    request = query_request(
+        customer_id, corpus_id, query, start, num_results, metadata_filter, dims
+    )
+    return batch_query(customer_id, query_address, jwt_token, [request])
+
+
+def search(
+    query_string,
+    corpus_id=2,
+    start=0,
+    num_results=20,
+    metadata_filter=None,
+    dims=None,
+):
     token = _get_jwt_token()[0]
     response, error, success = query(
-        CUSTOMER_ID, corpus_id, SERVING_ENDPOINT, token, query_string
+        CUSTOMER_ID,
+        corpus_id,
+        SERVING_ENDPOINT,
+        token,
+        query_string,
+        start,
+        num_results,
+        metadata_filter,
+        dims,
     )
     return response, error, success
 
 
-def store(id: str, title: str, is_title: bool, sections: List[str], corpus_id: int):
+def search_many(
+    query_string,
+    corpora: List[Tuple[int, dict]],
+    start=0,
+    num_results=20,
+    metadata_filter=None,
+):
+    """Search several corpora in one batch query.
+    Args:
+        corpora: (corpus_id, dims) of every corpus to search.
+    Returns:
+        (response, error, success) with one response set per corpus.
+    """
+    token = _get_jwt_token()[0]
+    query_requests = [
+        query_request(
+            CUSTOMER_ID,
+            corpus_id,
+            query_string,
+            start,
+            num_results,
+            metadata_filter,
+            dims,
+        )
+        for corpus_id, dims in corpora
+    ]
+    return batch_query(CUSTOMER_ID, SERVING_ENDPOINT, token, query_requests)
+
+
+def document_metadata(
+    source: str, channel: str = "", author: str = "", ts=None, mimetype: str = ""
+):
+    """Filterable document metadata, empty values are left out."""
+    metadata = {
+        "source": source,
+        "channel": channel,
+        "author": author,
+        "ts": int(ts.timestamp()) if ts else None,
+        "mimetype": mimetype,
+    }
+    return {key: value for key, value in metadata.items() if value}
+
+
+def custom_dims(metadata: dict):
+    """Custom dimension values of a document with the given metadata."""
+    dims = {}
+    if metadata.get("ts"):
+        dims["recency"] = (metadata["ts"] - RECENCY_EPOCH) / YEAR
+    if metadata.get("source") == "slack":
+        dims["slack"] = 1.0
+    return dims
+
+
+def _quote(value: str):
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def metadata_filter(
+    source: str = None,
+    channel: str = None,
+    author: str = None,
+    after: datetime = None,
+    before: datetime = None,
+):
+    """Translate search facets into a Vectara metadata filter expression."""
+    clauses = []
+    for name, value in [("source", source), ("channel", channel), ("author", author)]:
+        if value:
+            clauses.append(f"doc.{name} = {_quote(value)}")
+    if after:
+        clauses.append(f"doc.ts >= {int(after.timestamp())}")
+    if before:
+        clauses.append(f"doc.ts < {int(before.timestamp())}")
+    if not clauses:
+        return None
+    return " and ".join(["doc.is_title = false", *clauses])
+
+
+def build_document(
+    id: str, title: str, is_title: bool, sections: List[str], metadata: dict = None
+):
     document = indexing_pb2.Document()
-    document.metadata_json = json.dumps({"is_title": is_title})
+    document.metadata_json = json.dumps({"is_title": is_title, **(metadata or {})})
+    for name, value in custom_dims(metadata or {}).items():
+        document.custom_dims.add(name=name, value=value)
     document.document_id = id
     document.title = title
     for section_text in sections:
         section = indexing_pb2.Section()
         section.text = section_text
         document.section.extend([section])
+    return document
+
+
+def store(
+    id: str,
+    title: str,
+    is_title: bool,
+    sections: List[str],
+    corpus_id: int,
+    metadata: dict = None,
+):
+    """Index a document, raises the gRPC error, ``IndexRejected`` or
+    ``Saturated`` on failure."""
+    document = build_document(id, title, is_title, sections, metadata)
     error, success = index(
         document, CUSTOMER_ID, corpus_id, INDEXING_ENDPOINT, _get_jwt_token()[0]
     )
     if not success:
-        logging.error(
-            "GRPC INDEX failed. RESON: %s RESPONSE: %s", error,
-        )
-        return None
+        logging.error("GRPC INDEX failed. REASON: %s", error)
+        raise error
     return document
 
 
-def upload(fh: io.BytesIO, title: str, extension: str, mimetype: str, corpus_id=2):
+@tracing.traced("vectara.delete")
+def delete(document_id: str, corpus_id: int):
+    """Delete a document from the corpus, raises the gRPC error on failure. A
+    document that is not in the corpus counts as deleted."""
+    customer_id = int(CUSTOMER_ID)
+    request = common_pb2.DeleteDocumentRequest(
+        customer_id=customer_id, corpus_id=corpus_id, document_id=document_id
+    )
+    index_stub = services_pb2_grpc.IndexServiceStub(_channel(INDEXING_ENDPOINT))
+    try:
+        index_stub.Delete(
+            request,
+            credentials=grpc.access_token_call_credentials(_get_jwt_token()[0]),
+            metadata=[("customer-id-bin", struct.pack(">q", customer_id))],
+        )
+    except grpc.RpcError as error:
+        if error.code() != grpc.StatusCode.NOT_FOUND:
+            raise
+
+
+def index_many(
+    documents: List[indexing_pb2.Document], corpus_id: int, concurrency: int = 8
+):
+    """Indexes many documents concurrently over a shared channel.
+    Args:
+        documents: Documents to index.
+        corpus_id: ID of the corpus to which data needs to be indexed.
+        concurrency: Maximum number of in-flight Index calls.
+    Returns:
+        A list of (document, error, success) tuples in the same order as documents.
+    """
+    token = _get_jwt_token()[0]
+
+    def _index(document):
+        error, success = index(
+            document, CUSTOMER_ID, corpus_id, INDEXING_ENDPOINT, token
+        )
+        return document, error, success
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(tracing.in_context(_index), documents))
+
+
+@tracing.traced("vectara.upload")
+def upload(
+    fh: io.BytesIO,
+    title: str,
+    extension: str,
+    mimetype: str,
+    corpus_id=2,
+    metadata: dict = None,
+):
     token, _ = _get_jwt_token()
     post_headers = {
         "Authorization": f"Bearer {token}",
     }
-    response = requests.post(
-        f"https://api.vectara.io/v1/upload?c={CUSTOMER_ID}&o={corpus_id}&d=true",
-        files={"file": (f"{title}{extension}", fh, mimetype)},
-        headers=post_headers,
-        data={"c": CUSTOMER_ID, "o": corpus_id, "d": True},
-        stream=True,
-    )
+    data = {"c": CUSTOMER_ID, "o": corpus_id, "d": True}
+    if metadata:
+        data["doc_metadata"] = json.dumps({"is_title": False, **metadata})
+    try:
+        with concurrency.limited("upload") as slot:
+            response = requests.post(
+                f"{UPLOAD_ENDPOINT}?c={CUSTOMER_ID}&o={corpus_id}&d=true",
+                files={"file": (f"{title}{extension}", fh, mimetype)},
+                headers=post_headers,
+                data=data,
+                stream=True,
+            )
+            slot.overloaded = response.status_code in OVERLOAD_STATUS
+    except concurrency.Saturated as error:
+        logging.error("REST upload not sent: %s", error)
+        return error, False
     if response.status_code != 200:
         logging.error(
             "REST upload failed with code %d, reason %s, text %s",
@@ -179,6 +505,7 @@ def upload(fh: io.BytesIO, title: str, extension: str, mimetype: str, corpus_id=
     return response, True
 
 
+@tracing.traced("vectara.create_corpus")
 def create_corpus(name: str, description: str):
     """Create a corpus.
     Args:
@@ -195,9 +522,24 @@ def create_corpus(name: str, description: str):
         "customer-id": f"{CUSTOMER_ID}",
         "Authorization": f"Bearer {jwt_token}",
     }
-    corpus = {"corpus": {"name": name, "description": description,}}
+    corpus = {
+        "corpus": {
+            "name": name,
+            "description": description,
+            "filterAttributes": _filter_attributes(),
+            "customDimensions": [
+                {
+                    "name": name,
+                    "description": description,
+                    "indexingDefault": 0,
+                    "servingDefault": 0,
+                }
+                for name, description in CUSTOM_DIMENSIONS.items()
+            ],
+        }
+    }
     response = requests.post(
-        f"https://api.vectara.io/v1/create-corpus",
+        f"{API_URL}/v1/create-corpus",
         verify=True,
         headers=post_headers,
         json=corpus,
@@ -212,3 +554,68 @@ def create_corpus(name: str, description: str):
         )
         return response, False
     return response, True
+
+
+def _filter_attributes():
+    return [
+        {
+            "name": name,
+            "indexed": True,
+            "type": attribute_type,
+            "level": "FILTER_ATTRIBUTE_LEVEL__DOCUMENT",
+        }
+        for name, attribute_type in FILTER_ATTRIBUTES.items()
+    ]
+
+
+@tracing.traced("vectara.replace_filter_attributes")
+def replace_filter_attributes(corpus_id: int):
+    """Declare FILTER_ATTRIBUTES on a corpus created before they existed.
+    Documents indexed earlier only become filterable once indexed again.
+    Returns:
+        (response, True) in case of success and returns (error, False) in case of failure.
+    """
+    jwt_token, _ = _get_jwt_token()
+    response = requests.post(
+        f"{API_URL}/v1/replace-corpus-filter-attrs",
+        headers={
+            "customer-id": f"{CUSTOMER_ID}",
+            "Authorization": f"Bearer {jwt_token}",
+        },
+        json={"corpusId": corpus_id, "filterAttributes": _filter_attributes()},
+    )
+    if response.status_code != 200:
+        logging.error(
+            "Replacing filter attributes failed with code %d, reason %s, text %s",
+            response.status_code,
+            response.reason,
+            response.text,
+        )
+        return response, False
+    return response, True
+
+
+@tracing.traced("vectara.reset_corpus")
+def reset_corpus(corpus_id: int):
+    """Remove every document from a corpus, keeping its id and settings.
+    Args:
+        corpus_id: ID of the corpus to reset.
+    Returns:
+        (None, True) in case of success and returns (error, False) in case of failure.
+    """
+    customer_id = int(CUSTOMER_ID)
+    request = admin_pb2.ResetCorpusRequest()
+    request.customer_id = customer_id
+    request.corpus_id = corpus_id
+    try:
+        admin_stub = services_pb2_grpc.AdminServiceStub(_channel(ADMIN_ENDPOINT))
+        response = admin_stub.ResetCorpus(
+            request,
+            credentials=grpc.access_token_call_credentials(_get_jwt_token()[0]),
+            metadata=[("customer-id-bin", struct.pack(">q", customer_id))],
+        )
+    except grpc.RpcError as rpc_error:
+        logging.error("Reset Corpus failed for corpus %s: %s", corpus_id, rpc_error)
+        return rpc_error, False
+    logging.info("Reset corpus %s: %s", corpus_id, response)
+    return None, True
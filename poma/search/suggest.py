@@ -0,0 +1,231 @@
+"""Typeahead suggestions from an in-memory prefix index per workspace.
+
+Every process keeps a compressed trie (radix tree) per workspace built from
+document titles and Slack channel names, and one per user of the workspace
+built from their past queries, so nobody is suggested what others searched.
+Each node caches the best ``SUGGEST_LIMIT`` completions of its subtree, so a
+lookup is a walk down the prefix of both tries and never touches Vectara.
+Phrases are also reachable from the start of each of their first words, so
+"budget" completes "Q3 budget review".
+
+The index is refreshed incrementally at most every ``SUGGEST_REFRESH_SECONDS``
+by loading the rows added (or, for queries, searched) since the last refresh.
+Scores only grow: a phrase that stops being popular keeps its place until the
+process restarts.
+"""
+import logging
+import os
+import re
+import threading
+import time
+
+from django.utils import timezone
+
+SUGGEST_LIMIT = int(os.getenv("SUGGEST_LIMIT", 8))
+SUGGEST_REFRESH_SECONDS = float(os.getenv("SUGGEST_REFRESH_SECONDS", 30))
+# Words of a phrase it can be completed from
+SUGGEST_WORD_STARTS = 6
+TITLE_SCORE = 1
+CHANNEL_SCORE = 1
+
+_spaces = re.compile(r"\s+")
+
+
+def normalize(phrase: str):
+    return _spaces.sub(" ", phrase).strip().lower()
+
+
+def _common_prefix(a: str, b: str):
+    i = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        i += 1
+    return i
+
+
+class _Node:
+    __slots__ = ("children", "top")
+
+    def __init__(self, top=None):
+        # first character of the edge label -> (label, child)
+        self.children = {}
+        # best (score, phrase) completions of the subtree, highest first
+        self.top = top or []
+
+
+class Trie:
+    """Compressed trie keeping the top completions at every node."""
+
+    def __init__(self, limit: int = SUGGEST_LIMIT):
+        self.limit = limit
+        self.root = _Node()
+        self.scores = {}
+        self.display = {}
+
+    def __len__(self):
+        return len(self.scores)
+
+    def _path(self, key: str):
+        """Nodes from the root to key's node, splitting edges as needed."""
+        node = self.root
+        nodes = [node]
+        i = 0
+        while i < len(key):
+            edge = node.children.get(key[i])
+            if edge is None:
+                child = _Node()
+                node.children[key[i]] = (key[i:], child)
+                nodes.append(child)
+                return nodes
+            label, child = edge
+            common = _common_prefix(label, key[i:])
+            if common < len(label):
+                middle = _Node(list(child.top))
+                middle.children[label[common]] = (label[common:], child)
+                node.children[key[i]] = (label[:common], middle)
+                child = middle
+            nodes.append(child)
+            node = child
+            i += common
+        return nodes
+
+    def _promote(self, node: _Node, phrase: str, score: float):
+        top = [entry for entry in node.top if entry[1] != phrase]
+        top.append((score, phrase))
+        top.sort(key=lambda entry: (-entry[0], entry[1]))
+        node.top = top[: self.limit]
+
+    def add(self, phrase: str, score: float = 1):
+        """Add score to phrase, indexing it under the start of its first words."""
+        key = normalize(phrase)
+        if not key:
+            return
+        self.display.setdefault(key, phrase.strip())
+        self.scores[key] = total = self.scores.get(key, 0) + score
+        starts = [0] + [m.end() for m in re.finditer(" ", key)]
+        for start in starts[:SUGGEST_WORD_STARTS]:
+            for node in self._path(key[start:]):
+                self._promote(node, key, total)
+
+    def top(self, prefix: str, limit: int = None):
+        """Best (score, normalized phrase) completions of prefix."""
+        prefix = normalize(prefix)
+        node = self.root
+        i = 0
+        while i < len(prefix):
+            edge = node.children.get(prefix[i])
+            if edge is None:
+                return []
+            label, child = edge
+            rest = prefix[i:]
+            if not (rest.startswith(label) or label.startswith(rest)):
+                return []
+            node = child
+            i += len(label)
+        return node.top[: limit or self.limit]
+
+    def complete(self, prefix: str, limit: int = None):
+        return [self.display[key] for _, key in self.top(prefix, limit)]
+
+
+class WorkspaceSuggestions:
+    """Tries of one workspace and of its users' queries, with the high-water
+    marks of their sources."""
+
+    def __init__(self, workspace_id: int):
+        self.workspace_id = workspace_id
+        self.trie = Trie()
+        self.user_tries = {}
+        self.lock = threading.Lock()
+        self.last_document_id = 0
+        self.last_channel_id = 0
+        self.query_counts = {}
+        self.queries_since = None
+        self.refreshed_at = 0.0
+
+    def refresh(self):
+        from app.models import Document, QueryLog, SlackChannel
+
+        started = timezone.now()
+        documents = (
+            Document.objects.filter(
+                workspace_id=self.workspace_id, id__gt=self.last_document_id
+            )
+            .order_by("id")
+            .values_list("id", "title")
+        )
+        for document_id, title in documents.iterator():
+            self.last_document_id = document_id
+            # Slack messages are titled "@user in #channel", channels come below
+            if title and not title.startswith("@"):
+                self.trie.add(title, TITLE_SCORE)
+
+        channels = (
+            SlackChannel.objects.filter(
+                workspace_id=self.workspace_id, id__gt=self.last_channel_id
+            )
+            .order_by("id")
+            .values_list("id", "channel_name")
+        )
+        for channel_id, name in channels.iterator():
+            self.last_channel_id = channel_id
+            self.trie.add(f"#{name}", CHANNEL_SCORE)
+
+        queries = QueryLog.objects.filter(
+            workspace_id=self.workspace_id, user__isnull=False
+        )
+        if self.queries_since is not None:
+            queries = queries.filter(last_searched__gte=self.queries_since)
+        rows = queries.values_list("user_id", "query", "count")
+        for user_id, query, count in rows.iterator():
+            delta = count - self.query_counts.get((user_id, query), 0)
+            if delta > 0:
+                self.query_counts[user_id, query] = count
+                if user_id not in self.user_tries:
+                    self.user_tries[user_id] = Trie()
+                self.user_tries[user_id].add(query, delta)
+        self.queries_since = started
+        self.refreshed_at = time.monotonic()
+
+    def complete(self, prefix: str, limit: int = None, user_id: int = None):
+        if time.monotonic() - self.refreshed_at > SUGGEST_REFRESH_SECONDS:
+            # Only one thread refreshes, the others answer from the current trie
+            if self.lock.acquire(blocking=self.refreshed_at == 0):
+                try:
+                    self.refresh()
+                except Exception:
+                    logging.exception(
+                        "Refreshing suggestions of workspace %s failed",
+                        self.workspace_id,
+                    )
+                finally:
+                    self.lock.release()
+        user_trie = self.user_tries.get(user_id)
+        if user_trie is None:
+            return self.trie.complete(prefix, limit)
+        # A title the user also searched for adds up both scores
+        scores = {}
+        for trie in (self.trie, user_trie):
+            for score, key in trie.top(prefix, limit):
+                scores[key] = scores.get(key, 0) + score
+        best = sorted(scores, key=lambda key: (-scores[key], key))
+        display = {**self.trie.display, **user_trie.display}
+        return [display[key] for key in best[: limit or self.trie.limit]]
+
+
+_workspaces = {}
+_workspaces_lock = threading.Lock()
+
+
+def suggestions(workspace_id: int):
+    with _workspaces_lock:
+        if workspace_id not in _workspaces:
+            _workspaces[workspace_id] = WorkspaceSuggestions(workspace_id)
+        return _workspaces[workspace_id]
+
+
+def suggest(workspace_id: int, prefix: str, limit: int = None, user_id: int = None):
+    """Returns up to limit completions of prefix in the workspace, including
+    the past queries of the user."""
+    return suggestions(workspace_id).complete(prefix, limit, user_id)
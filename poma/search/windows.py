@@ -0,0 +1,146 @@
+"""Paginated search over cached windows of Vectara results.
+
+Results are fetched ``SEARCH_WINDOW_PAGES`` pages at a time with ``start`` and
+cached per (corpora, query, filter, window), so moving between pages of a
+window never queries Vectara again. When a page is the last one of its window,
+the next window is fetched in the background while the user reads it.
+
+Several corpora are searched with one batch query, each corpus filling an
+equal share of the window. Scores are divided by the best score of their
+corpus before being merged, raw scores are not comparable across corpora.
+Each window is then reordered by maximal marginal relevance before caching.
+
+When Vectara fails, or its circuit breaker is open, a window is served from a
+copy kept ``SEARCH_STALE_TTL`` seconds, its results marked ``degraded``.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import logging
+import os
+import threading
+from typing import List, Tuple
+
+from django.core.cache import cache
+
+from poma import metrics, tracing
+from poma.search.diversify import diversify
+from poma.search.semantic import search_many
+
+PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", 15))
+WINDOW_PAGES = int(os.getenv("SEARCH_WINDOW_PAGES", 4))
+WINDOW_SIZE = PAGE_SIZE * WINDOW_PAGES
+WINDOW_TTL = int(os.getenv("SEARCH_WINDOW_TTL", 10 * 60))
+STALE_TTL = int(os.getenv("SEARCH_STALE_TTL", 24 * 60 * 60))
+
+_prefetcher = ThreadPoolExecutor(max_workers=4, thread_name_prefix="search-prefetch")
+_inflight = set()
+_lock = threading.Lock()
+
+# (corpus_id, custom dimension weights) of every corpus to search
+Corpora = List[Tuple[int, dict]]
+
+
+def _key(corpora: Corpora, query: str, window: int, metadata_filter: str):
+    search = json.dumps([corpora, query, metadata_filter], sort_keys=True)
+    return f"search:{hashlib.sha1(search.encode()).hexdigest()}:{window}"
+
+
+def _responses(data: dict, corpora: Corpora):
+    """Flatten the response sets, tagging results with their document and corpus."""
+    responses = []
+    response_sets = data.get("responseSet", [])
+    for (corpus_id, _), response_set in zip(corpora, response_sets):
+        documents = response_set.get("document", [])
+        hits = response_set.get("response", [])
+        best = max((hit.get("score", 0) for hit in hits), default=0)
+        for response in hits:
+            try:
+                response["documentId"] = documents[response.get("documentIndex")]["id"]
+            except (IndexError, TypeError) as e:
+                logging.error("Getting the document failed", exc_info=e)
+                response["documentId"] = None
+            response["corpusId"] = corpus_id
+            if len(corpora) > 1 and best > 0:
+                response["score"] = response.get("score", 0) / best
+            responses.append(response)
+    if len(corpora) > 1:
+        responses.sort(key=lambda response: -response.get("score", 0))
+    return responses
+
+
+def fetch_window(
+    corpora: Corpora, query: str, window: int, metadata_filter: str = None
+):
+    """Returns ({"responses", "more"}, error, success) for the window-th window,
+    more tells whether any corpus may have results past it."""
+    key = _key(corpora, query, window, metadata_filter)
+    results = cache.get(key)
+    if results is not None:
+        return results, None, True
+    share = max(WINDOW_SIZE // len(corpora), 1)
+    response, error, success = search_many(
+        query,
+        corpora,
+        start=window * share,
+        num_results=share,
+        metadata_filter=metadata_filter,
+    )
+    if not success:
+        return stale_window(key, error)
+    data = response.json()
+    results = {
+        "responses": diversify(_responses(data, corpora)),
+        "more": any(
+            len(response_set.get("response", [])) >= share
+            for response_set in data.get("responseSet", [])
+        ),
+    }
+    cache.set(key, results, WINDOW_TTL)
+    cache.set(f"{key}:stale", results, STALE_TTL)
+    return results, None, True
+
+
+def stale_window(key: str, error):
+    """The stale copy of a window, not cached again and without more windows."""
+    results = cache.get(f"{key}:stale")
+    if results is None:
+        return None, error, False
+    logging.warning("Serving stale search results: %s", error)
+    metrics.search_degraded.labels("stale").inc()
+    responses = [{**response, "degraded": True} for response in results["responses"]]
+    return {"responses": responses, "more": False}, None, True
+
+
+def prefetch(corpora: Corpora, query: str, window: int, metadata_filter: str = None):
+    key = _key(corpora, query, window, metadata_filter)
+    with _lock:
+        if key in _inflight or cache.get(key) is not None:
+            return
+        _inflight.add(key)
+
+    def _fetch():
+        try:
+            fetch_window(corpora, query, window, metadata_filter)
+        except Exception:
+            logging.exception("Prefetching search window %s failed", key)
+        finally:
+            with _lock:
+                _inflight.discard(key)
+
+    _prefetcher.submit(tracing.in_context(_fetch))
+
+
+def get_page(
+    corpora: Corpora, query: str, page: int = 1, metadata_filter: str = None
+):
+    """Returns (responses, has_next, error, success) for a 1-based page."""
+    window, offset = divmod((page - 1) * PAGE_SIZE, WINDOW_SIZE)
+    results, error, success = fetch_window(corpora, query, window, metadata_filter)
+    if not success:
+        return [], False, error, False
+    responses = results["responses"]
+    end = offset + PAGE_SIZE
+    if results["more"] and end >= WINDOW_SIZE:
+        prefetch(corpora, query, window + 1, metadata_filter)
+    return responses[offset:end], end < len(responses) or results["more"], None, True
@@ -73,6 +73,7 @@ class DEV(Configuration):
     INSTALLED_APPS = apps_to_install
 
     MIDDLEWARE = [
+        "poma.tracing.middleware",
         "django.middleware.security.SecurityMiddleware",
         "django.contrib.sessions.middleware.SessionMiddleware",
         "django.middleware.common.CommonMiddleware",
@@ -181,6 +182,18 @@ class DEV(Configuration):
 
     DEMO_USERNAME = os.getenv("DEMO_USERNAME")
 
+    # Search result windows, shared between processes when REDIS_URL is set
+    if os.getenv("REDIS_URL"):
+        CACHES = {
+            "default": {
+                "BACKEND": "django.core.cache.backends.redis.RedisCache",
+                "LOCATION": os.getenv("REDIS_URL"),
+            }
+        }
+
+    # Bearer token required to scrape /metrics, closed when unset unless DEBUG
+    METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
 
 EMAIL_VERIFIED_CALLBACK = verified_callback
 
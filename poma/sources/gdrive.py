@@ -1,9 +1,15 @@
+import csv
 import logging
+from google.auth.transport.requests import AuthorizedSession
 from googleapiclient.http import MediaIoBaseDownload
 import io
+import os
+from typing import Iterable
+from urllib.parse import urljoin
 from googleapiclient.errors import HttpError
 
 from app.models import Workspace
+from poma import tracing
 
 
 logger = logging.Logger(__name__)
@@ -13,10 +19,20 @@ MIMETYPES_TO_EXPORT = {
     "application/vnd.google-apps.presentation": "application/vnd.openxmlformats-officedocument.presentationml.presentation",
 }
 
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+RATE_LIMIT_REASONS = ("rateLimitExceeded", "userRateLimitExceeded")
 
+SPREADSHEET = "application/vnd.google-apps.spreadsheet"
+SHEET_SECTION_CHARS = int(os.getenv("SHEET_SECTION_CHARS", 2000))
+# Columns repeated at the start of every line of a row split across sections
+SHEET_CONTEXT_COLUMNS = int(os.getenv("SHEET_CONTEXT_COLUMNS", 2))
+EXPORT_TIMEOUT = int(os.getenv("DRIVE_EXPORT_TIMEOUT", 300))
+
+
+@tracing.traced("drive.list_files")
 def list_files(
     service,
-    query="mimeType='application/vnd.google-apps.document' or mimeType='application/vnd.google-apps.presentation'",
+    query="mimeType='application/vnd.google-apps.document' or mimeType='application/vnd.google-apps.presentation' or mimeType='application/vnd.google-apps.spreadsheet'",
 ):
     """Search file in drive location"""
     try:
@@ -31,7 +47,8 @@ def list_files(
                     spaces="drive",
                     corpora="allDrives",
                     fields="nextPageToken, "
-                    "files(id, name, mimeType, webViewLink, size)",
+                    "files(id, name, mimeType, webViewLink, size, modifiedTime, "
+                    "owners(displayName))",
                     pageToken=page_token,
                     includeItemsFromAllDrives="true",
                     supportsAllDrives="true",
@@ -54,6 +71,7 @@ def list_files(
     return files
 
 
+@tracing.traced("drive.download_file")
 def download_file(service, **file):
     mimetype = MIMETYPES_TO_EXPORT.get(file["mimeType"], "text/plain")
     request = service.files().export_media(fileId=file["id"], mimeType=mimetype)
@@ -68,6 +86,79 @@ def download_file(service, **file):
     return fh
 
 
+def stream_csv(service, file_id: str):
+    """Rows of the CSV export of a spreadsheet's first sheet, parsed as they
+    are downloaded instead of after the whole export is buffered."""
+    session = AuthorizedSession(service._http.credentials)
+    url = urljoin(service._baseUrl, f"files/{file_id}/export")
+    with session.get(
+        url, params={"mimeType": "text/csv"}, stream=True, timeout=EXPORT_TIMEOUT
+    ) as response:
+        response.raise_for_status()
+        response.raw.decode_content = True
+        text = io.TextIOWrapper(response.raw, encoding="utf-8-sig", newline="")
+        yield from csv.reader(text)
+
+
+def sheet_sections(rows: Iterable[list], max_chars: int = SHEET_SECTION_CHARS):
+    """Group the rows after the header into sections of up to about max_chars.
+    Every row is written as "column: value" pairs so a section keeps the
+    meaning of its cells without the header row."""
+    rows = iter(rows)
+    header = next(rows, None)
+    if not header:
+        return
+    header = [name.strip() or f"Column {i + 1}" for i, name in enumerate(header)]
+    lines, size = [], 0
+    for row in rows:
+        pairs = [
+            f"{name}: {value.strip()}"
+            for name, value in zip(header, row)
+            if value.strip()
+        ]
+        for line in _row_lines(pairs, max_chars):
+            if lines and size + len(line) > max_chars:
+                yield "\n".join(lines)
+                lines, size = [], 0
+            lines.append(line)
+            size += len(line) + 1
+    if lines:
+        yield "\n".join(lines)
+
+
+def _row_lines(pairs: list, max_chars: int):
+    """Join the pairs of a row into lines of up to max_chars. The lines of a
+    row too long for one start with its first ``SHEET_CONTEXT_COLUMNS`` pairs,
+    and cells longer than a line are cut."""
+    line = "; ".join(pairs)
+    if len(line) <= max_chars:
+        if line:
+            yield line
+        return
+    context = "; ".join(pairs[:SHEET_CONTEXT_COLUMNS])[: max_chars // 2]
+    room = max(max_chars - len(context) - 2, 1)
+    line = ""
+    for i, pair in enumerate(pairs):
+        for start in range(0, len(pair), room):
+            piece = pair[start : start + room]
+            if line and len(line) + 2 + len(piece) > max_chars:
+                yield line
+                line = context if i >= SHEET_CONTEXT_COLUMNS else ""
+            line = f"{line}; {piece}" if line else piece
+    yield line
+
+
+def retryable(error: Exception):
+    if not isinstance(error, HttpError):
+        return False
+    if error.resp.status in RETRYABLE_STATUS:
+        return True
+    # Drive reports most rate limits as 403 with a rate limit reason
+    return error.resp.status == 403 and any(
+        reason in str(error.error_details) for reason in RATE_LIMIT_REASONS
+    )
+
+
 def iter_files(service, workspace: Workspace):
     logger.info("Listing google drive files for %s (%s)", workspace.name, workspace.id)
     files = list_files(service)
@@ -2,6 +2,8 @@ import os
 from urllib.parse import urljoin
 import requests
 
+from poma import tracing
+
 NANGO_HOSTPORT = os.getenv("NANGO_SERVER")
 NANGO_SECRET_KEY = os.getenv("NANGO_SECRET_KEY", "")
 
@@ -17,6 +19,7 @@ def _delete(path, provider):
     return requests.delete(url, auth=(NANGO_SECRET_KEY, ""))
 
 
+@tracing.traced("nango.get_token")
 def get_token(provider, workspace_id):
     response = _get(f"connection/{provider}-{workspace_id}", provider)
     if response.ok:
@@ -25,5 +28,6 @@ def get_token(provider, workspace_id):
         return response.text, False
 
 
+@tracing.traced("nango.revoke")
 def revoke(provider, workspace_id):
     _delete(f"connection/{provider}-{workspace_id}")
@@ -1,20 +1,37 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache
+import itertools
 import os
 import logging
+import random
+import time
 from slack_bolt import App
 from slack_bolt.oauth.oauth_settings import OAuthSettings
 from slack_sdk.oauth.installation_store import FileInstallationStore
 from poma.sources.slack_datastores import DjangoInstallationStore, DjangoOAuthStateStore
 from slack_sdk.oauth.state_store import FileOAuthStateStore
 from slack_bolt.adapter.socket_mode import SocketModeHandler
-
+from slack_sdk import WebClient
+from poma import idempotency, metrics, retries, tracing
 
 SLACK_SCOPES = os.getenv("SLACK_SCOPES", "").split(",")
 SLACK_CLIENT_ID = os.getenv("SLACK_CLIENT_ID")
+SLACK_API_URL = os.getenv("SLACK_API_URL", WebClient.BASE_URL)
+# Slack redelivers events not acknowledged within 3 seconds
+SLACK_ENQUEUE_TIMEOUT = float(os.getenv("SLACK_ENQUEUE_TIMEOUT", 2))
+SLACK_DISPATCH_RETRIES = int(os.getenv("SLACK_DISPATCH_RETRIES", 5))
+SLACK_DISPATCH_BACKOFF_MAX = float(os.getenv("SLACK_DISPATCH_BACKOFF_MAX", 60))
 
 logger = logging.Logger(__name__)
 
 
+class TracedWebClient(WebClient):
+    def api_call(self, api_method: str, **kwargs):
+        with tracing.span(f"slack.{api_method}"):
+            return super().api_call(api_method, **kwargs)
+
+
 def app():
     oauth_settings = OAuthSettings(
         client_id=os.getenv("SLACK_CLIENT_ID", ""),
@@ -31,7 +48,13 @@ def app():
 
 
 def bot_app():
-    return App(token=os.environ.get("SLACK_BOT_TOKEN"))
+    # Events whose listener raised are not acknowledged and Slack redelivers them
+    return App(
+        client=TracedWebClient(
+            token=os.environ.get("SLACK_BOT_TOKEN"), base_url=SLACK_API_URL
+        ),
+        process_before_response=True,
+    )
 
 
 @lru_cache
@@ -48,7 +71,7 @@ def user_app(token):
     return App(
         signing_secret=os.getenv("SLACK_SIGNING_SECRET"),
         oauth_settings=oauth_settings,
-        token=token,
+        client=TracedWebClient(token=token, base_url=SLACK_API_URL),
     )
 
 
@@ -68,20 +91,167 @@ def socket_app(join_callback, message_callback):
         return True
 
     @_app.message("")
-    def index_message(message, say, **kwargs):
+    def index_message(message, body, say, **kwargs):
         print("INDEXING", message)
-        if message["type"] == "message" and message["channel_type"] == "channel":
-            message_callback(
-                message["channel"],
-                message["user"],
-                message["text"],
-                message["ts"],
-                message["team"],
-            )
+        if args := _message_args(message):
+            _deliver(message_callback, args, _event_key(args, body))
 
     SocketModeHandler(_app).start()
 
 
+def _message_args(message):
+    # Bot messages and most subtypes (edits, deletions...) have no user
+    if (
+        message["type"] == "message"
+        and message.get("channel_type") == "channel"
+        and message.get("user")
+    ):
+        return (
+            message["channel"],
+            message["user"],
+            message.get("text", ""),
+            message["ts"],
+            message["team"],
+        )
+    return None
+
+
+def _event_key(args, body):
+    channel, _, _, ts, team = args
+    return idempotency.slack_event(team, channel, ts, body.get("event_id"))
+
+
+def _deliver(callback, args, key=None):
+    """Run callback unless the event behind key was already delivered."""
+    if key is not None and not idempotency.claim(*key):
+        logger.info("Dropping redelivered slack event %s", key)
+        return
+    try:
+        callback(*args)
+    except Exception:
+        if key is not None:
+            idempotency.release(*key)
+        raise
+
+
+def _task_name(callback):
+    # Callbacks are usually the ``delay`` of a celery task
+    task = getattr(callback, "__self__", None)
+    return getattr(task, "name", None) or callback.__qualname__
+
+
+async def async_socket_app(
+    join_callback, message_callback, connections=2, queue_size=1000, workers=8
+):
+    """Socket Mode runner that hands events to blocking callbacks (e.g. celery's
+    ``delay``) through a bounded queue. An event is acknowledged once queued,
+    while the queue stays full for ``SLACK_ENQUEUE_TIMEOUT`` seconds events are
+    left unacknowledged and Slack delivers them again later. Callbacks that
+    fail are retried with backoff, holding their place in the queue, and after
+    ``SLACK_DISPATCH_RETRIES`` attempts stored as ``FailedTask`` rows.
+
+    Args:
+        join_callback: Called with the channel id when the bot joins a channel.
+        message_callback: Called with (channel, user, text, ts, team) per message.
+        connections: Concurrent socket connections, Slack allows up to 10.
+        queue_size: Events buffered, later events wait for Slack's redelivery.
+        workers: Threads running the callbacks.
+    """
+    from slack_bolt.async_app import AsyncApp
+    from slack_bolt.adapter.socket_mode.async_handler import AsyncSocketModeHandler
+    from slack_sdk.web.async_client import AsyncWebClient
+
+    # Acknowledges an event when its listener returns, not before it runs
+    _app = AsyncApp(
+        client=AsyncWebClient(
+            token=os.environ.get("SLACK_BOT_TOKEN"), base_url=SLACK_API_URL
+        ),
+        process_before_response=True,
+    )
+    bot_info = await _app.client.auth_test(token=os.getenv("SLACK_APP_TOKEN"))
+    bot_user_id = bot_info["user_id"]
+    queue = asyncio.Queue(maxsize=queue_size)
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=workers)
+
+    async def enqueue(callback, args, body, key=None):
+        """Queue the event, raises so that Bolt does not acknowledge it when
+        the queue stays full."""
+        event = (callback, args, key, body.get("event_time", time.time()))
+        try:
+            await asyncio.wait_for(queue.put(event), SLACK_ENQUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            metrics.slack_events_deferred.inc()
+            raise asyncio.QueueFull(
+                f"Event queue full, leaving {body.get('event_id')} to redelivery"
+            )
+        metrics.slack_queue_depth.set(queue.qsize())
+
+    async def deliver(callback, args, key):
+        for attempt in itertools.count(1):
+            try:
+                await loop.run_in_executor(executor, _deliver, callback, args, key)
+                return
+            except Exception as error:
+                logger.warning("Dispatching slack event failed: %r", error)
+                if attempt >= SLACK_DISPATCH_RETRIES:
+                    try:
+                        await loop.run_in_executor(
+                            executor,
+                            retries.dead_letter,
+                            _task_name(callback),
+                            args,
+                            {},
+                            error,
+                            attempt,
+                        )
+                        return
+                    except Exception:
+                        logger.exception("Dead-lettering slack event failed")
+            delay = min(SLACK_DISPATCH_BACKOFF_MAX, 2**attempt)
+            await asyncio.sleep(random.uniform(0, delay))
+
+    async def dispatch():
+        while True:
+            callback, args, key, event_time = await queue.get()
+            metrics.slack_queue_depth.set(queue.qsize())
+            metrics.slack_event_lag_seconds.observe(max(time.time() - event_time, 0))
+            try:
+                await deliver(callback, args, key)
+            finally:
+                queue.task_done()
+
+    @_app.event("member_joined_channel")
+    async def index_history(ack, event, body):
+        if event["user"] != bot_user_id:
+            logger.info("Ingoring user [%s] that joined channel", event["user"])
+            await ack()
+            return
+        logger.info("BOT that joined channel: %s", event)
+        await enqueue(join_callback, (event["channel"],), body)
+        await ack()
+
+    @_app.message("")
+    async def index_message(message, body):
+        if args := _message_args(message):
+            await enqueue(message_callback, args, body, _event_key(args, body))
+
+    dispatchers = [asyncio.create_task(dispatch()) for _ in range(workers)]
+    handlers = [
+        AsyncSocketModeHandler(_app, os.getenv("SLACK_APP_TOKEN"))
+        for _ in range(connections)
+    ]
+    for handler in handlers:
+        await handler.connect_async()
+    logger.info("Connected %d slack socket mode connections", connections)
+    try:
+        await asyncio.gather(*dispatchers)
+    finally:
+        for handler in handlers:
+            await handler.close_async()
+        executor.shutdown(wait=False)
+
+
 def is_valid(token):
     _app = app()
     bot_info = _app.client.auth_test(token=os.getenv("SLACK_APP_TOKEN"))
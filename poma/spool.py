@@ -0,0 +1,185 @@
+"""Write-ahead spool of the documents to send to Vectara.
+
+Slack messages are stored as ``Document`` and ``Section`` rows together with
+a ``PendingIndex`` row in one transaction, before anything is sent, so a
+message is never lost to a Vectara outage. ``SPOOL_DELAY_SECONDS`` after the
+transaction commits the workspace's spool is drained: pending documents are
+sent oldest first in batches of ``SPOOL_BATCH_SIZE``, and deleted from the
+spool once indexed. Documents spooled while older ones are pending schedule
+no drain of their own, the drain of the older ones sends them too, so a burst
+of messages is sent by one drain. ``sweep`` runs every ``SPOOL_SWEEP_SECONDS``
+and drains the spools whose drain was lost with a worker.
+
+When Vectara fails with a retryable error the failed documents stay at the
+head of the spool and the drain is tried again after a jittered exponential
+backoff, new documents only join the spool meanwhile. Documents Vectara
+rejects are marked failed with the error and left out, until the
+``replay_failed_tasks`` command sends them again. One drainer runs per
+workspace at a time, the others mark the spool dirty so it makes another pass.
+"""
+import logging
+import os
+import random
+
+import redis
+from celery import shared_task
+from django.db import transaction
+from django.db.models import F, Prefetch
+from django.utils import timezone
+
+from poma import metrics, retries
+from poma.idempotency import get_redis
+from poma.search.semantic import build_document, index_many
+
+SPOOL_BATCH_SIZE = int(os.getenv("SPOOL_BATCH_SIZE", 100))
+SPOOL_CONCURRENCY = int(os.getenv("SPOOL_CONCURRENCY", 8))
+SPOOL_RETRY_SECONDS = int(os.getenv("SPOOL_RETRY_SECONDS", 5))
+SPOOL_RETRY_MAX = int(os.getenv("SPOOL_RETRY_MAX", 10 * 60))
+SPOOL_DELAY_SECONDS = float(os.getenv("SPOOL_DELAY_SECONDS", 2))
+LOCK_TTL = 5 * 60
+
+logger = logging.getLogger(__name__)
+
+
+def _key(workspace_id, name):
+    return f"poma:spool:{workspace_id}:{name}"
+
+
+def append(document, send: bool = True):
+    """Spool the document, call inside the transaction that created it. The
+    spool is drained once it commits, unless send is False and the caller
+    drains it after spooling more documents."""
+    from app.models import PendingIndex
+
+    entry = PendingIndex.objects.create(
+        workspace_id=document.workspace_id, document=document
+    )
+    if send:
+        transaction.on_commit(lambda: _schedule(entry))
+
+
+def _schedule(entry):
+    """Drain the spool of the entry after ``SPOOL_DELAY_SECONDS``, unless older
+    entries are pending, whose drain sends this one too."""
+    from app.models import PendingIndex
+
+    older = PendingIndex.objects.filter(
+        workspace_id=entry.workspace_id, failed_at=None, id__lt=entry.id
+    )
+    if not older.exists():
+        drain.apply_async((entry.workspace_id,), countdown=SPOOL_DELAY_SECONDS)
+
+
+def _backoff(attempts: int):
+    return random.uniform(0, min(SPOOL_RETRY_MAX, SPOOL_RETRY_SECONDS * 2**attempts))
+
+
+def send_pending(workspace_id: int, on_batch=None):
+    """Send the pending documents of the workspace in order, calling on_batch()
+    before each batch. Returns the seconds to wait before trying again, None
+    once the spool is empty."""
+    from app.models import PendingIndex, Section
+
+    sections = Prefetch(
+        "document__sections", queryset=Section.objects.order_by("section_id")
+    )
+    while True:
+        pending = list(
+            PendingIndex.objects.filter(workspace_id=workspace_id, failed_at=None)
+            .select_related("document", "workspace")
+            .prefetch_related(sections)
+            .order_by("id")[:SPOOL_BATCH_SIZE]
+        )
+        if not pending:
+            return None
+        corpus_id = pending[0].workspace.corpus_id
+        if corpus_id is None:
+            return SPOOL_RETRY_MAX
+        if on_batch is not None:
+            on_batch()
+        batch = []
+        for entry in pending:
+            document = entry.document
+            indexed = build_document(
+                document.identifier,
+                document.title,
+                False,
+                sections=[s.text for s in document.sections.all()],
+                metadata=document.metadata,
+            )
+            for section, stored in zip(indexed.section, document.sections.all()):
+                section.id = stored.section_id
+            batch.append(indexed)
+        results = index_many(batch, corpus_id, concurrency=SPOOL_CONCURRENCY)
+        sent, retry = [], []
+        for entry, (_, error, success) in zip(pending, results):
+            if success:
+                sent.append(entry.id)
+                metrics.documents_indexed.labels(entry.document.source).inc()
+            elif retries.retryable(error):
+                retry.append(entry)
+            else:
+                logger.error("Vectara rejected %s: %s", entry.document_id, error)
+                PendingIndex.objects.filter(pk=entry.pk).update(
+                    failed_at=timezone.now(), error=repr(error)
+                )
+        # Looks again even after a short batch, documents spooled meanwhile
+        # scheduled no drain as older ones were pending
+        PendingIndex.objects.filter(id__in=sent).delete()
+        if retry:
+            PendingIndex.objects.filter(id__in=[e.id for e in retry]).update(
+                attempts=F("attempts") + 1
+            )
+            logger.warning(
+                "Vectara unavailable, %d spooled documents of workspace %s wait",
+                len(retry),
+                workspace_id,
+            )
+            return _backoff(min(entry.attempts for entry in retry))
+
+
+@shared_task(bind=True)
+def drain(self, workspace_id: int, retry: bool = False):
+    """Send the spool of the workspace, unless another worker is at it or it
+    waits for Vectara to recover, retry being True for the scheduled drain."""
+    lock, dirty = _key(workspace_id, "lock"), _key(workspace_id, "dirty")
+    backoff = _key(workspace_id, "backoff")
+    try:
+        redis_client = get_redis()
+        if not retry and redis_client.exists(backoff):
+            return
+        redis_client.set(dirty, 1)
+        retry_in = None
+        while retry_in is None and redis_client.set(lock, 1, nx=True, ex=LOCK_TTL):
+            try:
+                while retry_in is None and redis_client.delete(dirty):
+                    retry_in = send_pending(
+                        workspace_id, lambda: redis_client.expire(lock, LOCK_TTL)
+                    )
+            finally:
+                redis_client.delete(lock)
+            if not redis_client.exists(dirty):
+                break
+    except redis.RedisError as error:
+        logger.warning("Draining spool of %s without lock: %s", workspace_id, error)
+        retry_in = send_pending(workspace_id)
+    if retry_in is None:
+        return
+    try:
+        get_redis().set(backoff, 1, ex=max(int(retry_in), 1))
+    except redis.RedisError:
+        pass
+    # Eager runs (benchmarks) would retry at once instead of after the delay
+    if not self.request.is_eager:
+        drain.apply_async((workspace_id, True), countdown=retry_in)
+
+
+@shared_task
+def sweep():
+    """Drain every spool with pending documents, those whose drain was lost
+    with a crashed worker included. Spools waiting for Vectara are skipped."""
+    from app.models import PendingIndex
+
+    pending = PendingIndex.objects.filter(failed_at=None)
+    for workspace_id in pending.values_list("workspace_id", flat=True).distinct():
+        drain.delay(workspace_id)
@@ -0,0 +1,141 @@
+"""OpenTelemetry tracing for search requests and the celery ingestion chain.
+
+Spans are exported to ``OTEL_EXPORTER_OTLP_ENDPOINT`` when it is set (e.g. a
+local collector or Jaeger on ``http://localhost:4318``) or appended as JSON
+lines to ``TRACE_FILE``. Without either, tracing is a no-op. The trace
+context travels in the celery message headers so a task and everything it
+enqueues show up in the trace of the request or task that started it.
+"""
+import contextvars
+import functools
+import logging
+import os
+
+from celery import signals
+from opentelemetry import context, propagate, trace
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+
+OTLP_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT")
+TRACE_FILE = os.getenv("TRACE_FILE")
+SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "poma")
+
+tracer = trace.get_tracer("poma")
+
+_configured = False
+
+
+def setup():
+    """Install the tracer provider, once per process."""
+    global _configured
+    if _configured or not (OTLP_ENDPOINT or TRACE_FILE):
+        return
+    _configured = True
+    provider = TracerProvider(resource=Resource.create({"service.name": SERVICE_NAME}))
+    if OTLP_ENDPOINT:
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import (
+            OTLPSpanExporter,
+        )
+
+        exporter = OTLPSpanExporter()
+    else:
+        exporter = ConsoleSpanExporter(
+            out=open(TRACE_FILE, "a"),
+            formatter=lambda span: span.to_json(indent=None) + "\n",
+        )
+    provider.add_span_processor(BatchSpanProcessor(exporter))
+    trace.set_tracer_provider(provider)
+    logging.info("Tracing enabled for %s", SERVICE_NAME)
+
+
+def span(name: str, **attributes):
+    """Context manager running the block inside a new child span."""
+    return tracer.start_as_current_span(name, attributes=attributes)
+
+
+def traced(name: str):
+    """Decorator running every call of the function inside a span."""
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with tracer.start_as_current_span(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def in_context(function):
+    """Bind function to the current trace context, for use in worker threads."""
+    ctx = contextvars.copy_context()
+    return lambda *args, **kwargs: ctx.copy().run(function, *args, **kwargs)
+
+
+def middleware(get_response):
+    """Django middleware starting a server span per request."""
+
+    def trace_request(request):
+        with tracer.start_as_current_span(
+            request.method,
+            context=propagate.extract(request.headers),
+            kind=trace.SpanKind.SERVER,
+            attributes={"http.method": request.method, "http.target": request.path},
+        ) as current:
+            response = get_response(request)
+            if request.resolver_match is not None:
+                current.update_name(f"{request.method} {request.resolver_match.route}")
+            current.set_attribute("http.status_code", response.status_code)
+            return response
+
+    return trace_request
+
+
+# -- celery ---------------------------------------------------------------------
+
+_task_spans = {}
+
+
+@signals.before_task_publish.connect
+def _inject_context(headers=None, **kwargs):
+    if headers is not None:
+        propagate.inject(headers)
+
+
+@signals.task_prerun.connect
+def _start_task_span(task_id=None, task=None, **kwargs):
+    carrier = {
+        key: value
+        for key in ("traceparent", "tracestate")
+        if (value := getattr(task.request, key, None))
+    }
+    # Eager tasks have no headers and simply nest under the caller's span.
+    parent = propagate.extract(carrier) if carrier else None
+    current = tracer.start_span(
+        f"task {task.name}",
+        context=parent,
+        kind=trace.SpanKind.CONSUMER,
+        attributes={"celery.task_id": task_id, "celery.task_name": task.name},
+    )
+    token = context.attach(trace.set_span_in_context(current))
+    _task_spans[task_id] = (current, token)
+
+
+@signals.task_failure.connect
+def _record_task_failure(task_id=None, exception=None, **kwargs):
+    if task_id in _task_spans and exception is not None:
+        current = _task_spans[task_id][0]
+        current.record_exception(exception)
+        current.set_status(trace.Status(trace.StatusCode.ERROR, str(exception)))
+
+
+@signals.task_postrun.connect
+def _end_task_span(task_id=None, state=None, **kwargs):
+    current, token = _task_spans.pop(task_id, (None, None))
+    if current is None:
+        return
+    current.set_attribute("celery.state", state or "UNKNOWN")
+    context.detach(token)
+    current.end()
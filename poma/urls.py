@@ -17,8 +17,10 @@ from django.conf import settings
 from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import path, include
+from poma.metrics import metrics_view
 
 urlpatterns = [
+    path("metrics", metrics_view, name="metrics"),
     path("admin/", admin.site.urls),
     path("accounts/", include("django.contrib.auth.urls")),
     path("__reload__/", include("django_browser_reload.urls")),
@@ -27,6 +29,7 @@ urlpatterns = [
 
 if settings.DEMO_USERNAME:
     urlpatterns = [
+        path("metrics", metrics_view, name="metrics"),
         path("", include("app.urls")),
     ]
 